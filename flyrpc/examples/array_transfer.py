@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Measures the time to send NumPy arrays to a server process on the same host, from the call until the server has
+# decoded them: as JSON lists, out-of-band through the socket, and through shared memory.
+
+from statistics import median
+from time import time, sleep
+
+import numpy as np
+
+from flyrpc.launch import launch_server
+from flyrpc.transceiver import MySocketServer
+from flyrpc.util import get_kwargs
+
+
+def run_server(host, port):
+    server = MySocketServer(host=host, port=port, threaded=True, name='ArrayServer')
+
+    def receive(array, t_sent):
+        server.received(t_sent=t_sent, t=time(), shape=list(np.shape(array)))
+
+    server.register_function(receive)
+
+    while not server.shutdown_flag.is_set():
+        server.process_queue(timeout=0.1)
+
+
+def measure(name, array, codecs, shared_memory, n_trials=20):
+    client = launch_server(__file__, codecs=codecs, shared_memory=shared_memory)
+    sleep(0.5)
+
+    times = []
+    for _ in range(n_trials):
+        client.receive(array=array, t_sent=time())
+        reply = client.queue.get()[0]['kwargs']
+        times.append(reply['t'] - reply['t_sent'])
+
+    client.shutdown()
+
+    print('  {:>24}: median {:8.2f} ms'.format(name, 1e3*median(times)))
+
+
+def main():
+    kwargs = get_kwargs()
+
+    if kwargs['port'] is not None:
+        # launched by main() below
+        run_server(host=kwargs['host'], port=kwargs['port'])
+        return
+
+    arrays = {'texture 1024x1024 float32': np.random.rand(1024, 1024).astype(np.float32),
+              'dot locations 10000x3 float32': np.random.randn(10000, 3).astype(np.float32)}
+
+    for array_name, array in arrays.items():
+        print('*** {} ***'.format(array_name))
+        measure('JSON lists', array, codecs=['json'], shared_memory=False)
+        measure('binary, socket', array, codecs=['binary'], shared_memory=False)
+        measure('binary, shared memory', array, codecs=['binary'], shared_memory=True)
+
+
+if __name__ == '__main__':
+    main()
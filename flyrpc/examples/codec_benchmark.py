@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Compares encode / decode throughput of the flyrpc codecs on representative load_stim payloads. NumPy arrays are
+# converted to lists by the JSON codec, and passed out-of-band without copying by the binary codec.
+
+from timeit import timeit
+
+from flyrpc.codec import codecs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def payloads():
+    """
+    :return: dict of payload name -> request list
+    """
+    result = {}
+
+    result['small load_stim'] = [{'name': 'load_stim', 'args': [], 'kwargs': {
+        'name': 'MovingPatch', 'width': 5, 'height': 5, 'sphere_radius': 1, 'color': [1.0, 1.0, 1.0, 1.0],
+        'theta': 0, 'phi': 0, 'angle': 0.0, 't': 1.7e9}}]
+
+    for length in [1000, 100000]:
+        tv_pairs = [[k/100, k % 360] for k in range(length)]
+        result['tv_pairs x{}'.format(length)] = [{'name': 'load_stim', 'args': [], 'kwargs': {
+            'name': 'MovingPatch', 'theta': {'name': 'tv_pairs', 'tv_pairs': tv_pairs, 'kind': 'linear'}}}]
+
+    if np is not None:
+        result['texture 512x512 uint8'] = [{'name': 'load_stim', 'args': [], 'kwargs': {
+            'name': 'TexturedSphere', 'texture': np.random.randint(0, 256, size=(512, 512), dtype=np.uint8)}}]
+        result['dot locations 10000x3 float32'] = [{'name': 'load_stim', 'args': [], 'kwargs': {
+            'name': 'DotField', 'positions': np.random.randn(10000, 3).astype(np.float32)}}]
+
+    return result
+
+
+def main():
+    for payload_name, request_list in payloads().items():
+        print('*** {} ***'.format(payload_name))
+        for codec in codecs.values():
+            # frame body as received
+            data = bytearray(b''.join(codec.encode(request_list)))
+            number = max(1, int(2e6 // len(data)))
+
+            encode_time = timeit(lambda: codec.encode(request_list), number=number) / number
+            decode_time = timeit(lambda: codec.decode(data), number=number) / number
+
+            print('  {:>6}: {:>9} bytes, encode {:9.1f} us ({:7.1f} MB/s), decode {:9.1f} us ({:7.1f} MB/s)'.format(
+                codec.name, len(data), 1e6*encode_time, 1e-6*len(data)/encode_time, 1e6*decode_time,
+                1e-6*len(data)/decode_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Measures how far apart several servers receive the same large request list, when it is written to them one after
+# the other (serialized for every server) and when it is written through a FanOut (serialized once, written
+# concurrently).
+
+from statistics import median
+from time import time, sleep
+
+from flyrpc.fanout import FanOut
+from flyrpc.launch import launch_server
+from flyrpc.transceiver import MySocketServer
+from flyrpc.util import get_kwargs
+
+
+def run_server(host, port):
+    server = MySocketServer(host=host, port=port, threaded=True, name='ReceiveServer')
+
+    def receive(trajectory):
+        server.received(t=time())
+
+    server.register_function(receive)
+
+    while not server.shutdown_flag.is_set():
+        server.process_queue(timeout=0.1)
+
+
+def measure(clients, write_request_list, name, n_trials=50, trajectory_length=100000):
+    request_list = [{'name': 'receive', 'args': [], 'kwargs': {'trajectory': [[k/100, k % 360] for k in range(trajectory_length)]}}]
+
+    spreads = []
+    latencies = []
+    for _ in range(n_trials):
+        t_sent = time()
+        write_request_list(request_list)
+        times = [client.queue.get()[0]['kwargs']['t'] for client in clients]
+        spreads.append(max(times) - min(times))
+        latencies.append(max(times) - t_sent)
+        sleep(0.05)
+
+    print('{}: receive skew median {:.3f} ms, max {:.3f} ms; last receive median {:.3f} ms'.format(
+        name, 1e3*median(spreads), 1e3*max(spreads), 1e3*median(latencies)))
+
+
+def main():
+    kwargs = get_kwargs()
+
+    if kwargs['port'] is not None:
+        # launched by main() below
+        run_server(host=kwargs['host'], port=kwargs['port'])
+        return
+
+    clients = [launch_server(__file__) for _ in range(3)]
+    sleep(0.5)
+
+    def write_sequential(request_list):
+        for client in clients:
+            client.write_request_list(request_list)
+
+    fanout = FanOut(clients)
+
+    measure(clients, write_sequential, 'sequential')
+    measure(clients, fanout.write_request_list, 'fan-out')
+
+    stats = fanout.send_stats()
+    print('fan-out send skew: mean {:.3f} ms, max {:.3f} ms'.format(1e3*stats['mean_skew'], 1e3*stats['max_skew']))
+
+    for client in clients:
+        client.shutdown()
+
+
+if __name__ == '__main__':
+    main()
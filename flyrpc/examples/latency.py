@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Measures the round-trip latency of commands to a server process, and the CPU time the server uses while idle,
+# for a server that polls its queue (timeout=0) and one that waits on it (timeout > 0).
+
+from statistics import median
+from time import time, sleep, process_time
+
+from flyrpc.launch import launch_server
+from flyrpc.transceiver import MySocketServer
+from flyrpc.util import get_kwargs
+
+
+def run_server(host, port, timeout):
+    server = MySocketServer(host=host, port=port, threaded=True, name='PingServer')
+
+    def ping(t_sent):
+        server.pong(t_sent=t_sent, cpu_time=process_time())
+
+    server.register_function(ping)
+
+    while not server.shutdown_flag.is_set():
+        server.process_queue(timeout=timeout)
+
+
+def measure(timeout, n_pings=200, interval=0.01):
+    client = launch_server(__file__, timeout=timeout)
+    sleep(0.5)
+
+    rtts = []
+    cpu_times = []
+    t_start = time()
+    for _ in range(n_pings):
+        client.ping(t_sent=time())
+        reply = client.queue.get()[0]['kwargs']
+        rtts.append(time() - reply['t_sent'])
+        cpu_times.append(reply['cpu_time'])
+        sleep(interval)
+    t_stop = time()
+
+    client.shutdown()
+
+    rtts = sorted(1e3*rtt for rtt in rtts)
+    cpu_load = (cpu_times[-1] - cpu_times[0]) / (t_stop - t_start)
+
+    print('timeout={}: round trip median {:.3f} ms, 99th percentile {:.3f} ms, server CPU load {:.1f}%'.format(
+        timeout, median(rtts), rtts[int(0.99*(len(rtts) - 1))], 100*cpu_load))
+
+
+def main():
+    kwargs = get_kwargs()
+
+    if kwargs['port'] is not None:
+        # launched by measure()
+        run_server(host=kwargs['host'], port=kwargs['port'], timeout=kwargs['timeout'])
+    else:
+        for timeout in [0, 0.1]:
+            measure(timeout)
+
+
+if __name__ == '__main__':
+    main()
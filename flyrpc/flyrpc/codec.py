@@ -0,0 +1,422 @@
+# Codecs for the length-prefixed wire format of flyrpc. A transceiver starts out with newline-delimited JSON and, if both
+# sides support it, switches to frames of a 4-byte big-endian length followed by the request list encoded with one of
+# the codecs below (see MyTransceiver.handle_wire_request).
+#
+# The binary codec is a compact tagged format in the spirit of msgpack. Besides the JSON types it keeps tuples and
+# bytes. Lists of floats or 64-bit ints, and lists of equal-length rows whose columns are all floats or all ints (e.g.
+# trajectories of [t, value] pairs), are packed as typed arrays.
+#
+# NumPy arrays, wherever they appear in the args and kwargs, are carried out-of-band: the encoded request list only
+# holds their dtype and shape, and their memory is written to the socket as is, after the rest of the frame. On the
+# receiving side they are views into the received frame (np.frombuffer), so they are neither copied into nor out of
+# the encoded request list. For peers on the same host, large arrays are instead written once into a file in shared
+# memory that the receiver maps and deletes. The sender keeps the paths of the files it created, and deletes those that
+# are left over when the receiver disconnects without having decoded them (see MyTransceiver.remove_shared_files).
+# Receivers only accept shared memory files on connections that negotiated shared memory, and only files named like
+# those of senders, directly in the shared memory directory, and of the expected size.
+# NumPy is only imported when an array is received.
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from array import array
+
+FRAME_HEADER = struct.Struct('!I')
+
+_UINT32 = struct.Struct('<I')
+_INT64 = struct.Struct('<q')
+_FLOAT64 = struct.Struct('<d')
+_UINT64 = struct.Struct('<Q')
+
+# lists at least this long are checked for the typed array encodings
+_MIN_PACKED_LENGTH = 8
+
+# out-of-band buffers start at multiples of this many bytes from the start of the frame body
+ALIGNMENT = 64
+
+# arrays at least this large are sent through shared memory when that is enabled
+SHARED_MEMORY_THRESHOLD = 2**20
+
+
+def shared_memory_dir():
+    # RAM-backed on Linux
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def is_numpy(obj):
+    return type(obj).__module__ == 'numpy'
+
+
+def _native_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _little_endian_bytes(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _padding(size):
+    return (-size) % ALIGNMENT
+
+
+class OutOfBand:
+    def __init__(self, shared_memory=False, shared_files=None):
+        """
+        Buffers of one frame that follow its inline part.
+        :param shared_memory: if True, large arrays are passed through shared memory files instead
+        :param shared_files: optional set to which the paths of the shared memory files are added
+        """
+        self.shared_memory = shared_memory
+        self.shared_files = shared_files
+        self.chunks = []
+        self.size = 0
+
+    def append(self, buffer):
+        """
+        :param buffer: bytes-like object, written to the socket without copying
+        """
+        padding = _padding(self.size)
+        if padding > 0:
+            self.chunks.append(bytes(padding))
+        self.chunks.append(buffer)
+        self.size += padding + memoryview(buffer).nbytes
+
+
+class OutOfBandReader:
+    def __init__(self, data, start, shared_memory=False):
+        """
+        :param data: memoryview of the frame body
+        :param start: position of the first out-of-band buffer
+        :param shared_memory: if True, arrays may be passed through shared memory files
+        """
+        self.data = data
+        self.pos = start
+        self.shared_memory = shared_memory
+
+    def take(self, nbytes):
+        self.pos += _padding(self.pos)
+        buffer = self.data[self.pos:self.pos+nbytes]
+        self.pos += nbytes
+        return buffer
+
+
+class JsonCodec:
+    name = 'json'
+
+    @staticmethod
+    def default(obj):
+        # NumPy arrays and scalars are sent as lists and Python numbers
+        if is_numpy(obj) and hasattr(obj, 'tolist'):
+            return obj.tolist()
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+    def encode(self, obj, shared_memory=False, shared_files=None):
+        return [json.dumps(obj, default=self.default).encode('utf-8')]
+
+    def decode(self, data, shared_memory=False):
+        return json.loads(bytes(data))
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode(self, obj, shared_memory=False, shared_files=None):
+        """
+        :param shared_memory: if True, arrays of at least SHARED_MEMORY_THRESHOLD bytes are written to shared memory
+        files that the receiver maps and deletes. Only for receivers on the same host.
+        :param shared_files: optional set to which the paths of the shared memory files are added, so that the sender
+        can delete the files that are never received
+        :return: list of bytes-like chunks of the frame body: the length of the inline part, the inline part, and the
+        padded out-of-band buffers
+        """
+        out = bytearray(4)
+        oob = OutOfBand(shared_memory=shared_memory, shared_files=shared_files)
+        self.encode_into(obj, out, oob)
+
+        _UINT32.pack_into(out, 0, len(out) - 4)
+        if oob.chunks:
+            out += bytes(_padding(len(out)))
+
+        return [out] + oob.chunks
+
+    def encode_into(self, obj, out, oob):
+        t = type(obj)
+
+        if t is str:
+            data = obj.encode('utf-8')
+            out += b's'
+            out += _UINT32.pack(len(data))
+            out += data
+        elif t is float:
+            out += b'd'
+            out += _FLOAT64.pack(obj)
+        elif t is int:
+            if -2**63 <= obj < 2**63:
+                out += b'i'
+                out += _INT64.pack(obj)
+            else:
+                data = str(obj).encode('ascii')
+                out += b'I'
+                out += _UINT32.pack(len(data))
+                out += data
+        elif t is bool:
+            out += b'T' if obj else b'F'
+        elif obj is None:
+            out += b'N'
+        elif t is list:
+            if len(obj) >= _MIN_PACKED_LENGTH and self.encode_packed(obj, out):
+                return
+            out += b'l'
+            out += _UINT32.pack(len(obj))
+            for item in obj:
+                self.encode_into(item, out, oob)
+        elif t is tuple:
+            out += b't'
+            out += _UINT32.pack(len(obj))
+            for item in obj:
+                self.encode_into(item, out, oob)
+        elif t is dict:
+            out += b'm'
+            out += _UINT32.pack(len(obj))
+            for key, value in obj.items():
+                self.encode_into(key, out, oob)
+                self.encode_into(value, out, oob)
+        elif t in (bytes, bytearray, memoryview):
+            data = memoryview(obj).cast('B')
+            out += b'b'
+            out += _UINT32.pack(len(data))
+            out += data
+        elif is_numpy(obj) and hasattr(obj, 'dtype'):
+            if obj.shape == ():
+                self.encode_into(obj.item(), out, oob)
+            else:
+                self.encode_array(obj, out, oob)
+        else:
+            raise TypeError('Cannot encode object of type {}'.format(t.__name__))
+
+    @staticmethod
+    def encode_packed(obj, out):
+        """
+        Encodes a homogeneous list as a typed array.
+        :return: True if the list was encoded, False if it has to be encoded item by item
+        """
+        first = type(obj[0])
+
+        if first is float:
+            if all(type(x) is float for x in obj):
+                out += b'D'
+                out += _UINT32.pack(len(obj))
+                out += _little_endian_bytes(array('d', obj))
+                return True
+        elif first is int:
+            if all(type(x) is int for x in obj):
+                try:
+                    values = array('q', obj)
+                except OverflowError:
+                    return False
+                out += b'L'
+                out += _UINT32.pack(len(obj))
+                out += _little_endian_bytes(values)
+                return True
+        elif first is list:
+            # rows of equal length, packed column by column, each column being all floats or all ints
+            width = len(obj[0])
+            if (width == 0) or (width > 255) or not all(type(x) is list and len(x) == width for x in obj):
+                return False
+
+            typecodes = bytearray()
+            columns = []
+            for column in zip(*obj):
+                if all(type(x) is float for x in column):
+                    typecodes += b'd'
+                    columns.append(array('d', column))
+                elif all(type(x) is int for x in column):
+                    try:
+                        columns.append(array('q', column))
+                    except OverflowError:
+                        return False
+                    typecodes += b'q'
+                else:
+                    return False
+
+            out += b'C'
+            out += _UINT32.pack(len(obj))
+            out += bytes([width])
+            out += typecodes
+            for column in columns:
+                out += _little_endian_bytes(column)
+            return True
+
+        return False
+
+    @staticmethod
+    def encode_array(obj, out, oob):
+        if obj.dtype.hasobject:
+            raise TypeError('Cannot encode NumPy arrays of Python objects')
+
+        # C order, copied only if the array is not contiguous already
+        if not obj.flags.c_contiguous:
+            obj = obj.copy()
+        buffer = obj.reshape(-1).view('u1')
+
+        use_shared_memory = oob.shared_memory and (obj.nbytes >= SHARED_MEMORY_THRESHOLD)
+
+        dtype = obj.dtype.str.encode('ascii')
+        out += b'S' if use_shared_memory else b'A'
+        out += bytes([len(dtype)])
+        out += dtype
+        out += bytes([obj.ndim])
+        for n in obj.shape:
+            out += _UINT64.pack(n)
+        out += _UINT64.pack(obj.nbytes)
+
+        if use_shared_memory:
+            fd, path = tempfile.mkstemp(prefix='flyrpc_', dir=shared_memory_dir())
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buffer)
+            if oob.shared_files is not None:
+                oob.shared_files.add(path)
+            path = path.encode('utf-8')
+            out += _UINT32.pack(len(path))
+            out += path
+        else:
+            oob.append(buffer)
+
+    def decode(self, data, shared_memory=False):
+        """
+        :param data: frame body. Arrays are views into it, so they are writable if it is a bytearray.
+        :param shared_memory: if True, arrays may be passed through shared memory files, which are mapped and deleted.
+        Only for connections that negotiated shared memory: otherwise, frames with such arrays are rejected.
+        """
+        data = memoryview(data)
+        inline_size = _UINT32.unpack_from(data, 0)[0]
+        end = 4 + inline_size
+        oob = OutOfBandReader(data, end + _padding(end), shared_memory=shared_memory)
+
+        obj, pos = self.decode_from(data, 4, oob)
+        if pos != end:
+            raise ValueError('{} bytes left over after decoding'.format(end - pos))
+        return obj
+
+    def decode_from(self, data, pos, oob):
+        """
+        :return: object encoded at position pos of the memoryview data, and the position following it
+        """
+        tag = data[pos]
+        pos += 1
+
+        if tag == 0x73:  # 's'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            return str(data[pos:pos+n], 'utf-8'), pos + n
+        elif tag == 0x64:  # 'd'
+            return _FLOAT64.unpack_from(data, pos)[0], pos + 8
+        elif tag == 0x69:  # 'i'
+            return _INT64.unpack_from(data, pos)[0], pos + 8
+        elif tag == 0x6d:  # 'm'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            obj = {}
+            for _ in range(n):
+                key, pos = self.decode_from(data, pos, oob)
+                obj[key], pos = self.decode_from(data, pos, oob)
+            return obj, pos
+        elif tag in (0x6c, 0x74):  # 'l', 't'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            obj = []
+            for _ in range(n):
+                item, pos = self.decode_from(data, pos, oob)
+                obj.append(item)
+            return (obj if tag == 0x6c else tuple(obj)), pos
+        elif tag == 0x4e:  # 'N'
+            return None, pos
+        elif tag == 0x54:  # 'T'
+            return True, pos
+        elif tag == 0x46:  # 'F'
+            return False, pos
+        elif tag == 0x44:  # 'D'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            return _native_array('d', data[pos:pos+8*n]).tolist(), pos + 8*n
+        elif tag == 0x4c:  # 'L'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            return _native_array('q', data[pos:pos+8*n]).tolist(), pos + 8*n
+        elif tag == 0x43:  # 'C'
+            n = _UINT32.unpack_from(data, pos)[0]
+            width = data[pos+4]
+            typecodes = str(data[pos+5:pos+5+width], 'ascii')
+            pos += 5 + width
+            columns = []
+            for typecode in typecodes:
+                columns.append(_native_array(typecode, data[pos:pos+8*n]).tolist())
+                pos += 8*n
+            return list(map(list, zip(*columns))), pos
+        elif tag == 0x62:  # 'b'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            return bytes(data[pos:pos+n]), pos + n
+        elif tag == 0x49:  # 'I'
+            n = _UINT32.unpack_from(data, pos)[0]
+            pos += 4
+            return int(str(data[pos:pos+n], 'ascii')), pos + n
+        elif tag in (0x41, 0x53):  # 'A', 'S'
+            if tag == 0x53 and not oob.shared_memory:
+                raise ValueError('Shared memory array at position {}, but shared memory is not enabled'.format(pos - 1))
+            return self.decode_array(data, pos, oob, shared_memory=(tag == 0x53))
+        else:
+            raise ValueError('Unknown tag {!r} at position {}'.format(chr(tag), pos - 1))
+
+    @staticmethod
+    def decode_array(data, pos, oob, shared_memory=False):
+        import numpy as np
+
+        n = data[pos]
+        dtype = np.dtype(str(data[pos+1:pos+1+n], 'ascii'))
+        pos += 1 + n
+
+        ndim = data[pos]
+        pos += 1
+        shape = tuple(_UINT64.unpack_from(data, pos + 8*k)[0] for k in range(ndim))
+        pos += 8*ndim
+
+        nbytes = _UINT64.unpack_from(data, pos)[0]
+        pos += 8
+
+        if shared_memory:
+            n = _UINT32.unpack_from(data, pos)[0]
+            path = str(data[pos+4:pos+4+n], 'utf-8')
+            pos += 4 + n
+
+            # only files created by a sender, so that a peer cannot have arbitrary files mapped and deleted
+            path = os.path.realpath(path)
+            directory, name = os.path.split(path)
+            if (directory != os.path.realpath(shared_memory_dir())) or not name.startswith('flyrpc_'):
+                raise ValueError('Not a flyrpc shared memory file: {}'.format(path))
+
+            # the mapping stays valid after the file is deleted, for as long as the array exists
+            with open(path, 'r+b') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size != nbytes:
+                    raise ValueError('Shared memory file {} has {} bytes, expected {}'.format(path, size, nbytes))
+                buffer = mmap.mmap(f.fileno(), nbytes)
+            os.remove(path)
+        else:
+            buffer = oob.take(nbytes)
+
+        return np.frombuffer(buffer, dtype=dtype, count=nbytes//dtype.itemsize).reshape(shape), pos
+
+
+# codecs by name, in order of preference
+codecs = {codec.name: codec for codec in [BinaryCodec(), JsonCodec()]}
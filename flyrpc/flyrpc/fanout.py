@@ -0,0 +1,98 @@
+# Writes the same request lists to several transceivers, e.g. the display clients of a stim server. Each request list
+# is serialized once per wire format in use, and every transceiver has its own writer thread, so the sockets are
+# written concurrently and the last transceiver does not wait for the others. The spread of the write completion times
+# across transceivers (send skew) is recorded for each request list. A write that fails is counted, and still completes
+# its request list, so that one broken transceiver does not stop the others.
+
+from collections import deque
+from queue import Queue
+from statistics import mean
+from threading import Lock
+from time import perf_counter
+
+from flyrpc.util import start_daemon_thread
+
+
+class FanOut:
+    def __init__(self, transceivers, max_records=1000):
+        """
+        :param transceivers: list of MyTransceiver objects to write to
+        :param max_records: number of recent request lists kept for the send statistics
+        """
+        self.transceivers = transceivers
+
+        # request list number -> (time written to the fan-out, completion times of the writes)
+        self.pending = {}
+        self.count = 0
+        self.lock = Lock()
+
+        # seconds, per request list: spread of the completion times, and time until the last write completed
+        self.send_skews = deque(maxlen=max_records)
+        self.send_latencies = deque(maxlen=max_records)
+
+        # number of writes that raised an exception
+        self.failed_writes = 0
+
+        self.queues = []
+        for transceiver in self.transceivers:
+            queue = Queue()
+            self.queues.append(queue)
+            start_daemon_thread(lambda transceiver=transceiver, queue=queue: self.write_loop(transceiver, queue))
+
+    def write_request_list(self, request_list):
+        if not self.transceivers:
+            return
+
+        encoded = {}
+        for transceiver in self.transceivers:
+            if transceiver.wire_format not in encoded:
+                encoded[transceiver.wire_format] = transceiver.encode_request_list(request_list)
+
+        with self.lock:
+            self.count += 1
+            self.pending[self.count] = (perf_counter(), [])
+            number = self.count
+
+        for queue in self.queues:
+            queue.put((number, request_list, encoded))
+
+    def write_loop(self, transceiver, queue):
+        while True:
+            number, request_list, encoded = queue.get()
+            try:
+                transceiver.write_request_list(request_list, encoded=encoded)
+            except Exception as e:
+                print('flyrpc: write of request list {} failed ({})'.format(number, e))
+                with self.lock:
+                    self.failed_writes += 1
+            self.record(number, perf_counter())
+
+    def record(self, number, t):
+        with self.lock:
+            start_time, times = self.pending[number]
+            times.append(t)
+
+            if len(times) == len(self.transceivers):
+                del self.pending[number]
+                self.send_skews.append(max(times) - min(times))
+                self.send_latencies.append(max(times) - start_time)
+
+    def send_stats(self):
+        """
+        :return: dict with the number of recent request lists, the mean and maximum send skew and latency (seconds),
+        and the number of failed writes
+        """
+        with self.lock:
+            skews = list(self.send_skews)
+            latencies = list(self.send_latencies)
+            failed_writes = self.failed_writes
+
+        if not skews:
+            return {'n': 0, 'failed_writes': failed_writes}
+
+        return {'n': len(skews),
+                'failed_writes': failed_writes,
+                'mean_skew': mean(skews),
+                'max_skew': max(skews),
+                'mean_latency': mean(latencies),
+                'max_latency': max(latencies)}
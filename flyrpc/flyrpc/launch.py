@@ -9,7 +9,12 @@ from flyrpc.util import find_free_port
 def fullpath(file):
     return os.path.realpath(os.path.expanduser(file))
 
-def launch_server(module_or_filename, new_env_vars=None, server_poll_timeout=10, server_poll_interval=0.1, **kwargs):
+def launch_server(module_or_filename, new_env_vars=None, server_poll_timeout=10, server_poll_interval=0.1, codecs=None,
+                  shared_memory=True, **kwargs):
+    """
+    :param codecs, shared_memory: wire format options of the returned client, see MySocketClient
+    :param kwargs: arguments of the server process, read there with flyrpc.util.get_kwargs
+    """
     # create list to hold command
     cmd = []
 
@@ -53,7 +58,7 @@ def launch_server(module_or_filename, new_env_vars=None, server_poll_timeout=10,
     server_poll_start = time()
     while (time() - server_poll_start) < server_poll_timeout:
         try:
-            return MySocketClient(host=kwargs['host'], port=kwargs['port'])
+            return MySocketClient(host=kwargs['host'], port=kwargs['port'], codecs=codecs, shared_memory=shared_memory)
         except ConnectionRefusedError:
             sleep(server_poll_interval)
     else:
@@ -1,10 +1,29 @@
-import socket, json, atexit
+import socket, json, atexit, os, traceback
 
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError
+from itertools import count
 from queue import Queue, Empty
-from threading import Event
+from threading import Event, Lock
 from json.decoder import JSONDecodeError
 
-from flyrpc.util import start_daemon_thread, stream_is_binary
+from flyrpc.codec import FRAME_HEADER, JsonCodec, codecs
+from flyrpc.util import start_daemon_thread, stream_is_binary, is_loopback
+
+# number of tracked shared memory files above which those already consumed by the receiver are forgotten
+MAX_SHARED_FILES = 256
+
+
+class RemoteError(Exception):
+    def __init__(self, message, error_type=None, remote_traceback=None):
+        """
+        Exception raised by a function called on the other side with call / call_async.
+        :param error_type: name of the exception class on the other side
+        :param remote_traceback: formatted traceback on the other side
+        """
+        super().__init__(message)
+        self.error_type = error_type
+        self.remote_traceback = remote_traceback
 
 
 class MyTransceiver:
@@ -13,6 +32,31 @@ class MyTransceiver:
         self.functions = {}
         self.outfile = None
         self.queue = Queue()
+        self.write_lock = Lock()
+
+        # calls made with call_async that wait for a response: request id -> Future
+        self.pending_calls = {}
+        self.call_ids = count()
+        self.call_lock = Lock()
+
+        # wire format: newline-delimited JSON while the codecs are None, length-prefixed frames afterwards
+        self.accepted_codecs = list(codecs.keys())
+        self.read_codec = None
+        self.write_codec = None
+
+        # large arrays are passed through shared memory if both sides are on the same host and agree to it
+        self.allow_shared_memory = True
+        self.local_peer = False
+        self.shared_memory = False
+
+        # paths of the shared memory files written by this side, deleted on disconnect and at exit unless the receiver
+        # has consumed them already
+        self.shared_files = set()
+        atexit.register(self.remove_shared_files)
+
+        # functions for which only the newest pending call is executed by process_queue
+        self.state_setters = set()
+        self.coalesced_counts = defaultdict(int)
 
         # create shutdown flag
         self.shutdown_flag = Event()
@@ -29,7 +73,9 @@ class MyTransceiver:
             return
 
         for request in request_list:
-            if isinstance(request, dict) and ('name' in request) and (request['name'] in self.functions):
+            if isinstance(request, dict) and ('id' in request):
+                self.handle_call(request)
+            elif isinstance(request, dict) and ('name' in request) and (request['name'] in self.functions):
                 # get function call parameters
                 function = self.functions[request['name']]
                 args = request.get('args', [])
@@ -38,21 +84,169 @@ class MyTransceiver:
                 # call function
                 function(*args, **kwargs)
 
-    def process_queue(self):
+    def handle_call(self, request):
+        """
+        Executes a request made with call_async, and sends back its return value or exception as a _response message.
+        """
+        response = {'id': request['id']}
+
+        try:
+            if request.get('name') not in self.functions:
+                raise NameError('Unknown function: {}'.format(request.get('name')))
+            function = self.functions[request['name']]
+            response['result'] = function(*request.get('args', []), **request.get('kwargs', {}))
+        except Exception as e:
+            response['error'] = str(e)
+            response['error_type'] = type(e).__name__
+            response['traceback'] = traceback.format_exc()
+
+        try:
+            self.write_request_list([{'name': '_response', 'kwargs': response}])
+        except (TypeError, ValueError) as e:
+            # the return value cannot be encoded
+            self.write_request_list([{'name': '_response', 'kwargs': {
+                'id': request['id'], 'error': 'Cannot send return value: {}'.format(e), 'error_type': type(e).__name__}}])
+
+    def call_async(self, name, *args, **kwargs):
+        """
+        Calls a function on the other side and returns a concurrent.futures.Future of its return value. If the function
+        raises an exception, the future raises a RemoteError. Responses are matched to calls by request id, so several
+        calls can be pending at once. Calls through __getattr__ remain one-way and do not wait for anything.
+        """
+        future = Future()
+        with self.call_lock:
+            call_id = next(self.call_ids)
+            self.pending_calls[call_id] = future
+
+        self.write_request_list([{'name': name, 'args': args, 'kwargs': kwargs, 'id': call_id}])
+
+        return future
+
+    def call(self, name, *args, timeout=None, **kwargs):
+        """
+        Calls a function on the other side and waits for its return value, see call_async.
+        :param timeout: seconds to wait for the response, None waits indefinitely. Raises
+        concurrent.futures.TimeoutError if it expires.
+        """
+        future = self.call_async(name, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def handle_response(self, request_list):
+        """
+        Resolves the future of a call_async call with a _response message.
+        :return: True if the request list was a response to a pending call of this transceiver
+        """
+        if not (isinstance(request_list, list) and (len(request_list) == 1) and isinstance(request_list[0], dict)):
+            return False
+        if request_list[0].get('name') != '_response':
+            return False
+
+        response = request_list[0].get('kwargs', {})
+        with self.call_lock:
+            future = self.pending_calls.pop(response.get('id'), None)
+        if future is None:
+            return False
+
+        if future.set_running_or_notify_cancel():
+            if 'error' in response:
+                future.set_exception(RemoteError(response['error'], error_type=response.get('error_type'),
+                                                 remote_traceback=response.get('traceback')))
+            else:
+                future.set_result(response.get('result'))
+
+        return True
+
+    def cancel_pending_calls(self):
+        # called when the connection is lost
+        with self.call_lock:
+            pending_calls, self.pending_calls = self.pending_calls, {}
+        for future in pending_calls.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError('Connection closed before the response was received'))
+
+    def get_pending(self, timeout=0):
+        """
+        :param timeout: seconds to wait for the first request list. 0 returns immediately, None waits indefinitely.
+        :return: list of all pending request lists
+        """
+        pending = []
+
+        try:
+            if timeout == 0:
+                pending.append(self.queue.get_nowait())
+            else:
+                pending.append(self.queue.get(timeout=timeout))
+        except Empty:
+            return pending
+
         while True:
             try:
-                request_list = self.queue.get_nowait()
+                pending.append(self.queue.get_nowait())
             except Empty:
                 break
+
+        return pending
+
+    def process_queue(self, timeout=0):
+        """
+        Handles all pending requests.
+
+        :param timeout: seconds to wait for a request if none is pending. 0 returns immediately, None waits
+        indefinitely. Loops that only serve requests should wait, rather than poll, to leave the CPU idle.
+        """
+        if self.state_setters:
+            self.process_queue_coalesced(timeout=timeout)
+            return
+
+        for request_list in self.get_pending(timeout=timeout):
             self.handle_request_list(request_list)
 
-    def register_function(self, function, name=None):
+    def process_queue_coalesced(self, timeout=0):
+        # collect all pending requests
+        requests = []
+        for request_list in self.get_pending(timeout=timeout):
+            if isinstance(request_list, list):
+                requests.extend(request_list)
+
+        # find the newest pending call of each state setter
+        latest = {}
+        for k, request in enumerate(requests):
+            if isinstance(request, dict) and (request.get('name') in self.state_setters):
+                latest[request['name']] = k
+
+        # drop state setter calls that are overwritten by a newer pending call. Calls made with call_async are always
+        # executed, since the caller waits for their response.
+        request_list = []
+        for k, request in enumerate(requests):
+            if isinstance(request, dict) and (request.get('name') in latest) and (latest[request['name']] != k) and \
+                    ('id' not in request):
+                self.coalesced_counts[request['name']] += 1
+                continue
+            request_list.append(request)
+
+        self.handle_request_list(request_list)
+
+    def register_function(self, function, name=None, state_setter=False):
+        """
+        :param function: function to call when a request with the given name is received
+        :param name: name of the request, defaults to the function name
+        :param state_setter: Boolean. If True, the function only sets state that is overwritten by its next call, so
+        process_queue executes only the newest pending call and counts the others in coalesced_counts. Calls made with
+        call_async are not dropped.
+        """
         if name is None:
             name = function.__name__
 
         assert name not in self.functions, 'Function "{}" already defined.'.format(name)
         self.functions[name] = function
 
+        if state_setter:
+            self.state_setters.add(name)
+
     def __getattr__(self, name):
         def f(*args, **kwargs):
             request = {'name': name, 'args': args, 'kwargs': kwargs}
@@ -66,22 +260,174 @@ class MyTransceiver:
 
         return json.loads(line)
 
-    def write_request_list(self, request_list):
+    @property
+    def wire_format(self):
+        """
+        Key under which request lists encoded for this transceiver can be shared with others. Frames with shared memory
+        files are consumed by their receiver, so they are never shared.
+        """
+        if self.write_codec is None:
+            return None
+        if self.shared_memory:
+            return (self.write_codec.name, id(self))
+        return self.write_codec.name
+
+    def encode_request_list(self, request_list):
+        """
+        :return: list of byte strings to write for the request list, in the current wire format
+        """
+        if self.write_codec is None:
+            return [(json.dumps(request_list, default=JsonCodec.default) + '\n').encode('utf-8')]
+
+        if len(self.shared_files) > MAX_SHARED_FILES:
+            self.forget_consumed_shared_files()
+
+        chunks = self.write_codec.encode(request_list, shared_memory=self.shared_memory, shared_files=self.shared_files)
+        return [FRAME_HEADER.pack(sum(memoryview(chunk).nbytes for chunk in chunks))] + chunks
+
+    def write_request_list(self, request_list, encoded=None):
+        """
+        :param encoded: optional dict of wire format -> request list encoded with encode_request_list, shared by
+        several transceivers so that the request list is encoded once (see flyrpc.fanout)
+        """
         if self.outfile is None:
             return
 
-        line = json.dumps(request_list) + '\n'
+        with self.write_lock:
+            if (encoded is not None) and (self.wire_format in encoded):
+                data = encoded[self.wire_format]
+            else:
+                data = self.encode_request_list(request_list)
 
-        if stream_is_binary(self.outfile):
-            line = line.encode('utf-8')
+            self.write_data(data)
 
+    def write_data(self, data):
+        # must be called with the write lock held
         try:
-            self.outfile.write(line)
+            for chunk in data:
+                self.outfile.write(chunk if stream_is_binary(self.outfile) else bytes(chunk).decode('utf-8'))
             self.outfile.flush()
         except BrokenPipeError:
             # will happen if the other side disconnected
             pass
 
+    def request_codecs(self, preferred_codecs):
+        """
+        Asks the other side to switch to length-prefixed frames, encoded with the first codec in preferred_codecs that
+        it supports. Until it answers, and if it does not support any of them, newline-delimited JSON is used.
+        The exchange is:
+            client -> server: _wire_hello (codecs, shared_memory), in JSON
+            server -> client: _wire_accept (codec, shared_memory), in JSON. The server writes frames from here on.
+            client -> server: _wire_switch, in JSON. The client writes frames from here on.
+        Shared memory is used only if both sides are on the same host, and only by the binary codec.
+        """
+        hello = {'codecs': preferred_codecs, 'shared_memory': self.shared_memory_possible()}
+        with self.write_lock:
+            self.write_data(self.encode_request_list([{'name': '_wire_hello', 'kwargs': hello}]))
+
+    def forget_consumed_shared_files(self):
+        # files deleted by the receiver no longer need to be tracked
+        self.shared_files.difference_update([path for path in list(self.shared_files) if not os.path.exists(path)])
+
+    def remove_shared_files(self):
+        """
+        Deletes the shared memory files written by this side that the receiver has not consumed, e.g. because it
+        disconnected before decoding them.
+        """
+        paths = list(self.shared_files)
+        self.shared_files.difference_update(paths)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def shared_memory_possible(self):
+        # shared memory files are deleted by the receiver while mapped, which needs POSIX semantics
+        return self.allow_shared_memory and self.local_peer and (os.name == 'posix')
+
+    def handle_wire_request(self, request_list):
+        """
+        Handles the messages of request_codecs.
+        :return: True if the request list was one of them
+        """
+        if not (isinstance(request_list, list) and (len(request_list) == 1) and isinstance(request_list[0], dict)):
+            return False
+
+        name = request_list[0].get('name')
+        kwargs = request_list[0].get('kwargs', {})
+
+        if name == '_wire_hello':
+            accepted = [codec for codec in kwargs.get('codecs', []) if codec in self.accepted_codecs]
+            codec = accepted[0] if accepted else None
+            shared_memory = bool(kwargs.get('shared_memory')) and self.shared_memory_possible()
+            reply = {'codec': codec, 'shared_memory': shared_memory}
+            with self.write_lock:
+                self.write_data(self.encode_request_list([{'name': '_wire_accept', 'kwargs': reply}]))
+                if codec is not None:
+                    self.write_codec = codecs[codec]
+                    self.shared_memory = shared_memory
+        elif name == '_wire_accept':
+            if kwargs.get('codec') is not None:
+                self.read_codec = codecs[kwargs['codec']]
+                with self.write_lock:
+                    self.write_data(self.encode_request_list([{'name': '_wire_switch'}]))
+                    self.write_codec = self.read_codec
+                    self.shared_memory = bool(kwargs.get('shared_memory'))
+        elif name == '_wire_switch':
+            self.read_codec = self.write_codec
+        else:
+            return False
+
+        return True
+
+    def read_request_lists(self, infile):
+        """
+        Yields the request lists read from a binary stream until it is closed. Messages that cannot be decoded are
+        reported and skipped.
+        """
+        while True:
+            if self.read_codec is None:
+                line = infile.readline()
+                if not line:
+                    return
+
+                try:
+                    request_list = self.parse_line(line)
+                except (JSONDecodeError, UnicodeDecodeError):
+                    print('flyrpc: dropped malformed line of {} bytes'.format(len(line)))
+                    continue
+
+                if self.handle_wire_request(request_list):
+                    continue
+            else:
+                header = infile.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+
+                # read into a bytearray, so that arrays decoded from the frame are writable views of it
+                length = FRAME_HEADER.unpack(header)[0]
+                payload = bytearray(length)
+                view = memoryview(payload)
+                received = 0
+                while received < length:
+                    n = infile.readinto(view[received:])
+                    if not n:
+                        return
+                    received += n
+
+                try:
+                    request_list = self.read_codec.decode(payload, shared_memory=self.shared_memory)
+                except Exception as e:
+                    print('flyrpc: dropped frame of {} bytes that could not be decoded ({})'.format(length, e))
+                    continue
+
+            # responses are delivered here, so that they do not wait for the queue to be processed
+            if self.handle_response(request_list):
+                continue
+
+            yield request_list
+
 '''
 import concurrent.futures
 
@@ -115,9 +461,19 @@ class MsiTransceiver(MyTransceiver):
 '''
 
 class MySocketClient(MyTransceiver):
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, codecs=None, shared_memory=True):
+        """
+        :param codecs: codecs to ask the server for, in order of preference (see request_codecs). Defaults to all
+        codecs in flyrpc.codec. An empty list keeps newline-delimited JSON without asking.
+        :param shared_memory: if False, large arrays are sent through the socket even if the server is on this host
+        """
         super().__init__()
 
+        self.allow_shared_memory = shared_memory
+
+        if codecs is None:
+            codecs = self.accepted_codecs
+
         # set defaults
         if host is None:
             host = '127.0.0.1'
@@ -136,23 +492,25 @@ class MySocketClient(MyTransceiver):
 
         atexit.register(cleanup)
 
-        self.infile = conn.makefile('r')
+        self.infile = conn.makefile('rb')
         self.outfile = conn.makefile('wb')
+        self.local_peer = is_loopback(conn)
 
         start_daemon_thread(self.loop)
 
+        if codecs:
+            self.request_codecs(codecs)
+
     def loop(self):
         try:
-            for line in self.infile:
-                try:
-                    request_list = self.parse_line(line)
-                except JSONDecodeError:
-                    continue
-
+            for request_list in self.read_request_lists(self.infile):
                 self.queue.put(request_list)
         except (OSError, ConnectionResetError):
             pass
 
+        self.cancel_pending_calls()
+        self.remove_shared_files()
+
 
 
 class MySocketServer(MyTransceiver):
@@ -210,16 +568,17 @@ class MySocketServer(MyTransceiver):
 
             print('{} accepted connection.'.format(self.name))
 
-            infile = conn.makefile('r')
-            self.outfile = conn.makefile('wb')
+            # every connection starts out with newline-delimited JSON
+            with self.write_lock:
+                self.read_codec = None
+                self.write_codec = None
+                self.shared_memory = False
+                self.local_peer = is_loopback(conn)
+                infile = conn.makefile('rb')
+                self.outfile = conn.makefile('wb')
 
             try:
-                for line in infile:
-                    try:
-                        request_list = self.parse_line(line)
-                    except JSONDecodeError:
-                        continue
-
+                for request_list in self.read_request_lists(infile):
                     if self.threaded:
                         self.queue.put(request_list)
                     else:
@@ -228,6 +587,8 @@ class MySocketServer(MyTransceiver):
                 pass
 
             print('{} dropped connection.'.format(self.name))
+            self.cancel_pending_calls()
+            self.remove_shared_files()
 
             if self.auto_stop:
                 self.shutdown_flag.set()
@@ -18,6 +18,9 @@ def find_free_port(host=''):
     s.bind((host, 0))
     return s.getsockname()[1]
 
+def is_loopback(conn):
+    return conn.getpeername()[0] in ['127.0.0.1', '::1']
+
 def get_kwargs():
     try:
         kwargs = json.loads(sys.argv[1])
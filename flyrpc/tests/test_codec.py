@@ -0,0 +1,195 @@
+import os
+import struct
+import tempfile
+
+import pytest
+
+from flyrpc.codec import BinaryCodec, JsonCodec, FRAME_HEADER, SHARED_MEMORY_THRESHOLD, shared_memory_dir
+
+
+REQUEST_LIST = [{'name': 'load_stim', 'args': [], 'kwargs': {
+    'name': 'MovingPatch', 'width': 5, 'height': 5.0, 'color': [1.0, 1.0, 1.0, 1.0], 'hold': True, 'angle': None,
+    'theta': {'name': 'tv_pairs', 'tv_pairs': [[k/100, k % 360] for k in range(100)], 'kind': 'linear'},
+    'label': 'unicode °', 'seeds': list(range(-5, 20))}}]
+
+
+def round_trip(codec, obj):
+    chunks = codec.encode(obj)
+    return codec.decode(bytearray(b''.join(bytes(chunk) for chunk in chunks)))
+
+
+@pytest.mark.parametrize('codec', [BinaryCodec(), JsonCodec()], ids=['binary', 'json'])
+def test_round_trip_request_list(codec):
+    assert round_trip(codec, REQUEST_LIST) == REQUEST_LIST
+
+
+@pytest.mark.parametrize('obj', [
+    0, -1, 2**63 - 1, -2**63, 2**100, -2**80, 1.5, float('inf'), '', 'text', True, False, None, [], {}, [[]],
+    [1.0]*8, list(range(8)), [2**70] + list(range(8)), [1, 2.0, 3, 4, 5, 6, 7, 8], [[1, 2.5]]*10,
+    [[1, 2], [3]]*5, [[2**64, 1]]*8, {'a': {'b': [None, 'c']}}, {1: 'int key'}])
+def test_binary_round_trip_values(obj):
+    decoded = round_trip(BinaryCodec(), obj)
+
+    assert decoded == obj
+    assert type(decoded) is type(obj)
+
+
+def test_binary_keeps_tuples_and_bytes():
+    obj = {'pair': (1, 'a'), 'data': b'\x00\x01\xff', 'nested': [(1.0, 2.0)]}
+
+    assert round_trip(BinaryCodec(), obj) == obj
+
+
+def test_binary_packs_trajectories():
+    tv_pairs = [[k/100, float(k)] for k in range(1000)]
+    size = sum(len(chunk) for chunk in BinaryCodec().encode(tv_pairs))
+
+    # two float64 columns and a short header
+    assert size < 2*8*1000 + 64
+
+
+def test_binary_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        BinaryCodec().encode({'x': object()})
+
+
+def test_binary_rejects_trailing_bytes():
+    data = bytearray(b''.join(BinaryCodec().encode([1, 2])))
+    data[0] += 1
+
+    with pytest.raises(ValueError):
+        BinaryCodec().decode(data + b'N')
+
+
+def test_frame_header():
+    assert FRAME_HEADER.pack(5) == b'\x00\x00\x00\x05'
+
+
+def test_binary_arrays_out_of_band():
+    np = pytest.importorskip('numpy')
+    texture = np.random.randint(0, 256, size=(64, 32), dtype=np.uint8)
+    positions = np.random.randn(3, 100).astype(np.float32)
+    transposed = np.arange(12, dtype='>i4').reshape(3, 4).T
+    obj = {'texture': texture, 'positions': [positions], 'transposed': transposed, 'scalar': np.float64(2.5)}
+
+    chunks = BinaryCodec().encode(obj)
+    decoded = BinaryCodec().decode(bytearray(b''.join(bytes(chunk) for chunk in chunks)))
+
+    # the array memory is written as is after the inline part, not copied into it
+    assert any(np.shares_memory(np.asarray(chunk), texture) for chunk in chunks[1:])
+    assert np.array_equal(decoded['texture'], texture)
+    assert np.array_equal(decoded['positions'][0], positions)
+    assert decoded['positions'][0].dtype == np.float32
+    assert np.array_equal(decoded['transposed'], transposed)
+    assert decoded['scalar'] == 2.5
+    assert decoded['texture'].flags.writeable
+
+
+def test_binary_arrays_through_shared_memory():
+    np = pytest.importorskip('numpy')
+    large = np.random.rand(SHARED_MEMORY_THRESHOLD // 8 + 1)
+    small = np.arange(10)
+    shared_files = set()
+
+    chunks = BinaryCodec().encode([large, small], shared_memory=True, shared_files=shared_files)
+    assert len(shared_files) == 1
+    path = next(iter(shared_files))
+    assert os.path.exists(path)
+
+    # only the small array is written to the socket
+    assert sum(memoryview(chunk).nbytes for chunk in chunks) < 1024
+
+    decoded = BinaryCodec().decode(bytearray(b''.join(bytes(chunk) for chunk in chunks)), shared_memory=True)
+    assert np.array_equal(decoded[0], large)
+    assert np.array_equal(decoded[1], small)
+
+    # the receiver deletes the file once it is mapped
+    assert not os.path.exists(path)
+
+
+def shared_memory_frame(path, n):
+    # frame body holding one float64 array of n elements, claimed to be in the shared memory file at path
+    path = path.encode('utf-8')
+    out = bytearray(4)
+    out += b'S' + bytes([3]) + b'<f8' + bytes([1]) + struct.pack('<Q', n) + struct.pack('<Q', 8*n)
+    out += struct.pack('<I', len(path)) + path
+    struct.pack_into('<I', out, 0, len(out) - 4)
+    return out
+
+
+@pytest.fixture
+def victim(tmp_path):
+    # a file of the size claimed by the forged frames
+    path = tmp_path / 'victim'
+    path.write_bytes(bytes(80))
+    return str(path)
+
+
+def test_binary_rejects_shared_memory_outside_directory(victim):
+    pytest.importorskip('numpy')
+
+    with pytest.raises(ValueError):
+        BinaryCodec().decode(shared_memory_frame(victim, 10), shared_memory=True)
+    assert os.path.exists(victim)
+
+
+def test_binary_rejects_shared_memory_symlink(victim):
+    pytest.importorskip('numpy')
+    link = os.path.join(shared_memory_dir(), 'flyrpc_test_{}'.format(os.getpid()))
+    os.symlink(victim, link)
+
+    try:
+        with pytest.raises(ValueError):
+            BinaryCodec().decode(shared_memory_frame(link, 10), shared_memory=True)
+        assert os.path.exists(victim)
+        assert os.path.lexists(link)
+    finally:
+        os.remove(link)
+
+
+def test_binary_rejects_shared_memory_without_prefix():
+    pytest.importorskip('numpy')
+    fd, path = tempfile.mkstemp(prefix='other_', dir=shared_memory_dir())
+    os.write(fd, bytes(80))
+    os.close(fd)
+
+    try:
+        with pytest.raises(ValueError):
+            BinaryCodec().decode(shared_memory_frame(path, 10), shared_memory=True)
+        assert os.path.exists(path)
+    finally:
+        os.remove(path)
+
+
+def test_binary_rejects_shared_memory_size_mismatch():
+    pytest.importorskip('numpy')
+    fd, path = tempfile.mkstemp(prefix='flyrpc_', dir=shared_memory_dir())
+    os.write(fd, bytes(80))
+    os.close(fd)
+
+    try:
+        with pytest.raises(ValueError):
+            BinaryCodec().decode(shared_memory_frame(path, 1000), shared_memory=True)
+        assert os.path.exists(path)
+    finally:
+        os.remove(path)
+
+
+def test_binary_rejects_shared_memory_unless_enabled():
+    np = pytest.importorskip('numpy')
+    shared_files = set()
+    chunks = BinaryCodec().encode([np.zeros(SHARED_MEMORY_THRESHOLD // 8)], shared_memory=True, shared_files=shared_files)
+    path = next(iter(shared_files))
+
+    try:
+        with pytest.raises(ValueError):
+            BinaryCodec().decode(bytearray(b''.join(bytes(chunk) for chunk in chunks)))
+        assert os.path.exists(path)
+    finally:
+        os.remove(path)
+
+
+def test_json_converts_arrays_to_lists():
+    np = pytest.importorskip('numpy')
+
+    assert round_trip(JsonCodec(), {'a': np.arange(3), 'b': np.float32(0.5)}) == {'a': [0, 1, 2], 'b': 0.5}
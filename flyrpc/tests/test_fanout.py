@@ -0,0 +1,78 @@
+from time import sleep
+
+from flyrpc.fanout import FanOut
+
+
+class FakeTransceiver:
+    def __init__(self, wire_format=None, fail=False, delay=0):
+        self.wire_format = wire_format
+        self.fail = fail
+        self.delay = delay
+        self.writes = []
+        self.encode_count = 0
+
+    def encode_request_list(self, request_list):
+        self.encode_count += 1
+        return [repr(request_list).encode('utf-8')]
+
+    def write_request_list(self, request_list, encoded=None):
+        sleep(self.delay)
+        if self.fail:
+            raise OSError('socket closed')
+        self.writes.append(encoded[self.wire_format])
+
+
+def wait_for_records(fanout, n, timeout=5.0):
+    for _ in range(int(timeout/0.01)):
+        if len(fanout.send_skews) >= n:
+            return
+        sleep(0.01)
+    raise TimeoutError
+
+
+def test_encoded_once_per_wire_format():
+    transceivers = [FakeTransceiver(), FakeTransceiver(), FakeTransceiver(wire_format='binary')]
+    fanout = FanOut(transceivers)
+
+    fanout.write_request_list([{'name': 'load_stim'}])
+    wait_for_records(fanout, 1)
+
+    assert sum(transceiver.encode_count for transceiver in transceivers) == 2
+    assert transceivers[0].writes[0] is transceivers[1].writes[0]
+    assert all(len(transceiver.writes) == 1 for transceiver in transceivers)
+
+
+def test_send_stats():
+    fanout = FanOut([FakeTransceiver(), FakeTransceiver(delay=0.02)])
+    assert fanout.send_stats() == {'n': 0, 'failed_writes': 0}
+
+    for _ in range(3):
+        fanout.write_request_list([{'name': 'start_stim'}])
+    wait_for_records(fanout, 3)
+
+    stats = fanout.send_stats()
+    assert stats['n'] == 3
+    assert stats['failed_writes'] == 0
+    assert 0.01 < stats['max_skew'] <= stats['max_latency']
+    assert stats['mean_skew'] <= stats['max_skew']
+    assert not fanout.pending
+
+
+def test_failed_write_is_recorded():
+    good = FakeTransceiver()
+    fanout = FanOut([FakeTransceiver(fail=True), good])
+
+    fanout.write_request_list([{'name': 'start_stim'}])
+    fanout.write_request_list([{'name': 'stop_stim'}])
+    wait_for_records(fanout, 2)
+
+    assert fanout.send_stats()['failed_writes'] == 2
+    assert len(good.writes) == 2
+    assert not fanout.pending
+
+
+def test_no_transceivers():
+    fanout = FanOut([])
+    fanout.write_request_list([{'name': 'start_stim'}])
+
+    assert fanout.send_stats()['n'] == 0
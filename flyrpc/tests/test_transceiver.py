@@ -0,0 +1,275 @@
+import os
+from queue import Queue
+from time import sleep
+
+import pytest
+
+from flyrpc import transceiver as transceiver_module
+from flyrpc.codec import codecs, FRAME_HEADER, SHARED_MEMORY_THRESHOLD
+from flyrpc.transceiver import MyTransceiver, MySocketServer, MySocketClient, RemoteError
+from flyrpc.util import start_daemon_thread
+
+
+def wait_until(condition, timeout=5.0):
+    for _ in range(int(timeout/0.01)):
+        if condition():
+            return
+        sleep(0.01)
+    raise TimeoutError
+
+
+class EchoServer:
+    """
+    Server on its own thread that sends every echo call back to the client as a reply call.
+    """
+    def __init__(self, accepted_codecs=None):
+        self.server = MySocketServer(port=0, threaded=True, auto_stop=False, name='TestServer')
+        if accepted_codecs is not None:
+            self.server.accepted_codecs = accepted_codecs
+        self.port = self.server.listener.getsockname()[1]
+
+        def echo(*args, **kwargs):
+            self.server.reply(*args, **kwargs)
+        self.server.register_function(echo)
+
+        start_daemon_thread(self.serve)
+
+    def serve(self):
+        while not self.server.shutdown_flag.is_set():
+            self.server.process_queue(timeout=0.05)
+
+    def close(self):
+        self.server.shutdown_flag.set()
+
+
+@pytest.fixture
+def echo_server():
+    servers = []
+
+    def make(**kwargs):
+        servers.append(EchoServer(**kwargs))
+        return servers[-1]
+
+    yield make
+
+    for server in servers:
+        server.close()
+
+
+def connect(server, **kwargs):
+    client = MySocketClient(port=server.port, **kwargs)
+    replies = Queue()
+    client.register_function(lambda *args, **kwargs: replies.put((list(args), kwargs)), name='reply')
+
+    def get_reply():
+        if replies.empty():
+            client.process_queue(timeout=5)
+        return replies.get_nowait()
+
+    return client, get_reply
+
+
+@pytest.mark.parametrize('codecs, codec_name', [(None, 'binary'), (['json'], 'json'), (['bogus', 'json'], 'json')])
+def test_negotiated_codec(echo_server, codecs, codec_name):
+    server = echo_server()
+    client, get_reply = connect(server, codecs=codecs)
+
+    wait_until(lambda: server.server.read_codec is not None)
+    assert client.write_codec.name == codec_name
+    assert client.read_codec.name == codec_name
+    assert server.server.write_codec.name == codec_name
+
+    client.echo(1, 'a', x=[[0.0, 1.0]]*10, y={'z': None})
+    assert get_reply() == ([1, 'a'], {'x': [[0.0, 1.0]]*10, 'y': {'z': None}})
+
+
+def test_no_codecs_keeps_json_lines(echo_server):
+    server = echo_server()
+    client, get_reply = connect(server, codecs=[])
+
+    client.echo(x=1)
+    assert get_reply() == ([], {'x': 1})
+    assert (client.write_codec, client.read_codec) == (None, None)
+    assert (server.server.write_codec, server.server.read_codec) == (None, None)
+
+
+def test_server_without_common_codec_keeps_json_lines(echo_server):
+    server = echo_server(accepted_codecs=[])
+    client, get_reply = connect(server, codecs=['binary'])
+
+    client.echo(x=2)
+    assert get_reply() == ([], {'x': 2})
+    assert (client.write_codec, client.read_codec) == (None, None)
+
+
+def test_requests_sent_during_negotiation_arrive_in_order(echo_server):
+    server = echo_server()
+    client, get_reply = connect(server)
+
+    for k in range(20):
+        client.echo(k)
+    assert [get_reply()[0][0] for _ in range(20)] == list(range(20))
+
+
+def large_array():
+    np = pytest.importorskip('numpy')
+    return np.random.rand(SHARED_MEMORY_THRESHOLD // 8 + 1)
+
+
+def shared_memory_transceiver():
+    transceiver = MyTransceiver()
+    transceiver.write_codec = codecs['binary']
+    transceiver.shared_memory = True
+    return transceiver
+
+
+def test_unconsumed_shared_files_are_removed():
+    transceiver = shared_memory_transceiver()
+    transceiver.encode_request_list([{'name': 'load_stim', 'kwargs': {'texture': large_array()}}])
+
+    paths = list(transceiver.shared_files)
+    assert len(paths) == 1 and os.path.exists(paths[0])
+
+    transceiver.remove_shared_files()
+    assert not os.path.exists(paths[0])
+    assert not transceiver.shared_files
+
+
+def test_consumed_shared_files_are_forgotten(monkeypatch):
+    monkeypatch.setattr(transceiver_module, 'MAX_SHARED_FILES', 2)
+    transceiver = shared_memory_transceiver()
+    receiver = MyTransceiver()
+    receiver.read_codec = codecs['binary']
+
+    for _ in range(4):
+        chunks = transceiver.encode_request_list([{'name': 'load_stim', 'args': [large_array()]}])
+        receiver.read_codec.decode(bytearray(b''.join(bytes(chunk) for chunk in chunks[1:])), shared_memory=True)
+
+    assert len(transceiver.shared_files) == 1
+    transceiver.remove_shared_files()
+
+
+def test_array_through_shared_memory(echo_server):
+    np = pytest.importorskip('numpy')
+    server = echo_server()
+    client, get_reply = connect(server)
+    wait_until(lambda: server.server.read_codec is not None)
+    assert client.shared_memory
+
+    array = large_array()
+    received = Queue()
+    server.server.functions['echo'] = lambda texture: received.put(texture)
+    client.echo(texture=array)
+
+    assert np.array_equal(received.get(timeout=5), array)
+    assert not any(os.path.exists(path) for path in client.shared_files)
+
+
+def test_shared_memory_frame_dropped_unless_negotiated(echo_server):
+    server = echo_server()
+    client, get_reply = connect(server, shared_memory=False)
+    wait_until(lambda: server.server.read_codec is not None)
+    assert not server.server.shared_memory
+
+    # a frame referring to a shared memory file, although the connection did not agree to use shared memory
+    shared_files = set()
+    chunks = codecs['binary'].encode([{'name': 'echo', 'args': [large_array()]}], shared_memory=True,
+                                     shared_files=shared_files)
+    path = next(iter(shared_files))
+    with client.write_lock:
+        client.write_data([FRAME_HEADER.pack(sum(memoryview(chunk).nbytes for chunk in chunks))] + chunks)
+
+    try:
+        # the frame is dropped and the connection keeps working
+        client.echo('after')
+        assert get_reply() == (['after'], {})
+        assert os.path.exists(path)
+    finally:
+        os.remove(path)
+
+
+class LoopbackTransceiver(MyTransceiver):
+    """
+    Transceiver whose outgoing request lists are queued as its own incoming ones, for testing without sockets.
+    """
+    def __init__(self):
+        super().__init__()
+        self.outfile = True
+
+    def write_request_list(self, request_list, encoded=None):
+        if self.handle_response(request_list):
+            return
+        self.queue.put(request_list)
+
+
+def test_state_setter_calls_are_coalesced():
+    transceiver = LoopbackTransceiver()
+    values = []
+    transceiver.register_function(values.append, name='set_value', state_setter=True)
+    others = []
+    transceiver.register_function(others.append, name='log')
+
+    for k in range(5):
+        transceiver.set_value(k)
+        transceiver.log(k)
+    transceiver.process_queue()
+
+    assert values == [4]
+    assert others == list(range(5))
+    assert transceiver.coalesced_counts['set_value'] == 4
+
+
+def test_calls_to_state_setters_are_not_coalesced():
+    transceiver = LoopbackTransceiver()
+    values = []
+    transceiver.register_function(lambda value: values.append(value) or value, name='set_value', state_setter=True)
+
+    transceiver.set_value(0)
+    futures = [transceiver.call_async('set_value', k) for k in range(1, 4)]
+    transceiver.set_value(4)
+    transceiver.process_queue()
+
+    # every call is executed and answered; the one-way call before them is overwritten
+    assert [future.result(timeout=1) for future in futures] == [1, 2, 3]
+    assert values == [1, 2, 3, 4]
+    assert transceiver.coalesced_counts['set_value'] == 1
+
+
+def test_call_returns_result_and_raises_remote_error(echo_server):
+    server = echo_server()
+
+    def divide(a, b):
+        return a / b
+    server.server.register_function(divide)
+
+    client, get_reply = connect(server)
+    assert client.call('divide', 6, b=3, timeout=5) == 2.0
+
+    with pytest.raises(RemoteError) as excinfo:
+        client.call('divide', 1, 0, timeout=5)
+    assert excinfo.value.error_type == 'ZeroDivisionError'
+    assert 'ZeroDivisionError' in excinfo.value.remote_traceback
+
+    with pytest.raises(RemoteError) as excinfo:
+        client.call('no_such_function', timeout=5)
+    assert excinfo.value.error_type == 'NameError'
+
+
+def test_concurrent_calls_are_matched_by_id(echo_server):
+    server = echo_server()
+    server.server.register_function(lambda x: 2*x, name='double')
+    client, get_reply = connect(server)
+
+    futures = [client.call_async('double', k) for k in range(20)]
+
+    assert [future.result(timeout=5) for future in futures] == [2*k for k in range(20)]
+    assert not client.pending_calls
+
+
+def test_pending_calls_fail_when_connection_closes():
+    transceiver = MyTransceiver()
+    future = transceiver.call_async('anything')
+    transceiver.cancel_pending_calls()
+
+    with pytest.raises(ConnectionError):
+        future.result(timeout=1)
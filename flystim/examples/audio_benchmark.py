@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Measures audio and visual onset latency and jitter for paired start_stim commands sent through MultiStimServer.
+# The speaker server runs against a virtual output device by default, so no audio hardware is needed:
+#   python audio_benchmark.py                    (null device)
+#   python audio_benchmark.py --device out.wav   (records the output to a WAV file)
+#   python audio_benchmark.py --device default   (system audio output)
+
+import numpy as np
+
+from argparse import ArgumentParser
+from time import time, sleep
+
+from flyrpc.multicall import MyMultiCall
+from flystim.stim_server import launch_stim_server
+from flystim.screen import Screen
+
+
+class Reports:
+    def __init__(self, manager):
+        self.audio_timing = []
+        self.audio_onsets = []
+        self.stim_onsets = []
+        self.onset_stats = {}
+
+        manager.register_function(lambda **kwargs: self.audio_timing.append(kwargs), name='report_audio_timing')
+        manager.register_function(lambda **kwargs: self.audio_onsets.append(kwargs), name='report_audio_onset')
+        manager.register_function(lambda **kwargs: self.stim_onsets.append(kwargs), name='report_stim_onset')
+        manager.register_function(lambda stats: self.onset_stats.update(stats), name='report_onset_stats')
+
+    def clear(self):
+        self.audio_timing.clear()
+        self.audio_onsets.clear()
+        self.stim_onsets.clear()
+
+
+def run_trial(manager, configuration, lead):
+    """
+    Sends one pair of audio / visual start_stim commands.
+
+    :param configuration: 'separate' (two commands), 'multicall' (one message), 'scheduled' (one message, audio
+    scheduled lead seconds ahead) or 'server' (one message, both scheduled lead seconds ahead by the stim server)
+    :return: time at which the commands were sent
+    """
+    t_sent = time()
+
+    if configuration == 'separate':
+        manager.start_stim(device='speaker')
+        manager.start_stim()
+    else:
+        multicall = MyMultiCall(manager)
+        if configuration == 'scheduled':
+            multicall.start_stim(device='speaker', start_time=t_sent + lead)
+        else:
+            multicall.start_stim(device='speaker')
+        multicall.start_stim()
+        multicall()
+
+    return t_sent
+
+
+def describe(name, values):
+    values = 1e3*np.array(values)
+    if len(values) == 0:
+        print('  {}: no data'.format(name))
+        return
+    print('  {}: median {:.2f} ms, std {:.2f} ms, 5-95% [{:.2f}, {:.2f}] ms (n={})'.format(
+        name, np.median(values), np.std(values), np.percentile(values, 5), np.percentile(values, 95), len(values)))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--device', default='null', help="'null', a WAV file path, or 'default' for the system output")
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--lead', type=float, default=0.05, help='seconds of lead time for scheduled starts')
+    args = parser.parse_args()
+
+    audio_device = None if args.device == 'default' else args.device
+    manager = launch_stim_server(Screen(fullscreen=False, server_number=0, id=0, vsync=True), audio_device=audio_device)
+    reports = Reports(manager)
+    manager.launch_device(name='speaker')
+    sleep(5)
+
+    for configuration in ['separate', 'multicall', 'scheduled', 'server']:
+        manager.set_start_lead(start_lead=args.lead if configuration == 'server' else None)
+
+        audio_latency = []
+        audio_onset_latency = []
+        visual_latency = []
+        av_offset = []
+
+        for _ in range(args.trials):
+            manager.load_stim('sine_song', duration=0.2, device='speaker')
+            manager.load_stim('MovingPatch', width=30, height=30, color=1)
+            sleep(0.5)
+            manager.process_queue()
+            reports.clear()
+
+            t_sent = run_trial(manager, configuration, args.lead)
+            sleep(0.5)
+
+            manager.stop_stim(device='speaker')
+            manager.stop_stim()
+            sleep(0.2)
+            manager.process_queue()
+
+            if reports.audio_timing and reports.stim_onsets:
+                audio_time = reports.audio_timing[0]['output_time']
+                visual_time = reports.stim_onsets[0]['onset_time']
+                audio_latency.append(audio_time - t_sent)
+                visual_latency.append(visual_time - t_sent)
+                av_offset.append(audio_time - visual_time)
+            if reports.audio_onsets:
+                audio_onset_latency.append(reports.audio_onsets[0]['onset_time'] - t_sent)
+
+        print('*** {} ***'.format(configuration))
+        describe('audio output latency', audio_latency)
+        describe('audio first sample latency (virtual device)', audio_onset_latency)
+        describe('visual first frame latency', visual_latency)
+        describe('audio - visual onset', av_offset)
+
+    # offsets of the achieved onsets from the scheduled start times, collected by the stim server
+    manager.get_onset_stats()
+    sleep(0.5)
+    manager.process_queue()
+    for device_name, stats in reports.onset_stats.items():
+        print('{} onset - scheduled time: mean {:.2f} ms, std {:.2f} ms (n={})'.format(
+            device_name, 1e3*stats['mean'], 1e3*stats['std'], stats['n']))
+
+
+if __name__ == '__main__':
+    main()
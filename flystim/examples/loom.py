@@ -23,15 +23,17 @@ def main():
                         'amplitude': 1,
                         'offset': 1}
 
-    manager.load_stim(name='MovingSpot', radius=loom_trajectory, sphere_radius=1, color=color_trajectory, theta=0, phi=0, hold=True)
-
-    sleep(1)
+    # wait until the screen has loaded the stimulus
+    manager.call('load_stim', name='MovingSpot', radius=loom_trajectory, sphere_radius=1, color=color_trajectory, theta=0, phi=0, hold=True, timeout=10)
 
     manager.start_stim()
     sleep(4)
 
-    manager.stop_stim(print_profile=True)
-    sleep(1)
+    # frame statistics of each screen
+    for stats in manager.call('get_frame_stats', timeout=1):
+        print('{} frames rendered, first at {}'.format(stats['n_frames'], stats['first_frame_time']))
+
+    manager.call('stop_stim', print_profile=True, timeout=10)
 
 if __name__ == '__main__':
     main()
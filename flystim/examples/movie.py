@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+from flystim.stim_server import launch_stim_server
+from flystim.screen import Screen
+
+import os.path
+import tempfile
+import numpy as np
+from time import sleep
+
+def main():
+    # write a (T, H, W) uint8 movie of a drifting noise pattern; it is memory-mapped by the display, not loaded
+    file_path = os.path.join(tempfile.gettempdir(), 'flystim_movie.npy')
+    np.random.seed(0)
+    frame = (255*np.random.uniform(size=(64, 128))).astype(np.uint8)
+    movie = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.uint8, shape=(120, 64, 128))
+    for t in range(movie.shape[0]):
+        movie[t] = np.roll(frame, t, axis=1)
+    movie.flush()
+    del movie
+
+    manager = launch_stim_server(Screen(fullscreen=False, server_number=0, id=0, vsync=True))
+
+    manager.load_stim(name='MoviePlayback', file_path=file_path, frame_rate=30, loop=True, surface='cylinder',
+                      cylinder_height=4)
+
+    sleep(0.5)
+
+    manager.start_stim()
+    sleep(8)
+
+    manager.stop_stim(print_profile=True)
+    sleep(0.5)
+
+if __name__ == '__main__':
+    main()
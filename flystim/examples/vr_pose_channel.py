@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+from flystim.stim_server import launch_stim_server
+from flystim.screen import Screen
+from flystim.pose import launch_simulated_tracker
+
+from time import sleep
+
+def main():
+    manager = launch_stim_server(Screen(fullscreen=False, server_number=0, id=0, vsync=True))
+
+    # simulated tracker writing the fly pose into shared memory at 500 Hz
+    tracker = launch_simulated_tracker(rate=500, duration=10, radius=0.1, angular_velocity=45)
+    manager.set_pose_channel()
+
+    manager.load_stim(name='ConstantBackground', color=[0.5, 0.5, 0.5, 1.0], side_length=100)
+    manager.load_stim(name='Floor', color=[0.5, 0.5, 0.5, 1.0], z_level=-0.25, side_length=5, hold=True)
+    manager.load_stim(name='Forest', color=[0, 0, 0, 1], cylinder_radius=0.05, cylinder_height=0.2,
+                      cylinder_locations=[[+0.5, 0, 0], [-0.5, 0, 0], [0, +0.5, 0], [0, -0.5, 0]], hold=True)
+
+    sleep(0.5)
+
+    manager.start_stim()
+    sleep(8)
+
+    # prints frame rate and tracker-to-render latency statistics
+    manager.stop_stim(print_profile=True)
+    manager.set_pose_channel(enabled=False)
+    sleep(0.5)
+
+    tracker.wait()
+
+if __name__ == '__main__':
+    main()
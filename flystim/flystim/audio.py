@@ -1,11 +1,19 @@
 import sys
-import pyaudio
-from time import sleep, time
+import json
+import inspect
+import wave
+from collections import deque, OrderedDict
+from threading import Lock, Event
+from time import sleep, time, perf_counter
 import numpy as np
 
+from flystim.trajectory import make_as_trajectory, return_for_time_t
 from flyrpc.transceiver import MySocketServer
-from flyrpc.util import get_kwargs
+from flyrpc.util import get_kwargs, start_daemon_thread
 
+# pyaudio.paContinue, returned by the stream callback. PyAudio is only imported for hardware output, so the virtual
+# output devices (see VirtualStream) work without it.
+PA_CONTINUE = 0
 
 def sine_song(sr, volume=1.0, duration=1.0, freq=225.0):
     t = np.linspace(0, duration, round(duration * sr))
@@ -25,45 +33,561 @@ def pulse_song(sr, volume=1.0, duration=1.0, freq=125.0, pcycle=0.016, ncycle=0.
     t = t - np.mean(t)
     y = np.exp(-t ** 2 / K) * np.cos(2 * np.pi * freq * t)
 
-    samples = np.zeros(seg * cycles)
-    for i in range(cycles):
-        samples[seg * i:seg * (i + 1)] = y
-    samples = np.delete(samples, slice(0, int(seg / 4)))
+    # repeat the pulse template, dropping the leading quarter of the first cycle
+    samples = np.tile(y, cycles)[int(seg / 4):]
     samples = volume * samples
     return np.floor(samples * 2 ** 15).astype(np.int16)
 
 
+def sine_blocks(sr, block_size=256, duration=None, freq=225.0, volume=1.0):
+    """
+    Sine tone synthesized block by block, with a continuous phase across blocks.
+
+    :param sr: sample rate, Hz
+    :param block_size: samples per block
+    :param duration: seconds, or None to play until stopped
+    :param freq: Hz. Can be a trajectory dict (see flystim.trajectory), interpolated linearly within each block.
+    :param volume: amplitude, 0 to 1. Can be a trajectory dict.
+    :return: generator of float blocks, in -1 to 1. The last block may be shorter.
+    """
+    freq = make_as_trajectory(freq)
+    volume = make_as_trajectory(volume)
+    n_samples = None if duration is None else int(round(duration * sr))
+
+    # preallocated block buffers, reused for every block
+    ramp = np.arange(1, block_size + 1) / block_size
+    phases = np.zeros(block_size)
+    amplitudes = np.zeros(block_size)
+    block = np.zeros(block_size)
+
+    phase = 0.0
+    f_start = float(return_for_time_t(freq, 0))
+    a_start = float(return_for_time_t(volume, 0))
+
+    start = 0
+    while (n_samples is None) or (start < n_samples):
+        t_end = (start + block_size) / sr
+        f_end = float(return_for_time_t(freq, t_end))
+        a_end = float(return_for_time_t(volume, t_end))
+
+        # phase of each sample, accumulated from the instantaneous frequency
+        np.multiply(ramp, f_end - f_start, out=phases)
+        phases += f_start
+        np.cumsum(phases, out=phases)
+        phases *= 2 * np.pi / sr
+        phases += phase
+        phase = phases[-1] % (2 * np.pi)
+
+        np.multiply(ramp, a_end - a_start, out=amplitudes)
+        amplitudes += a_start
+
+        np.sin(phases, out=block)
+        block *= amplitudes
+
+        f_start, a_start = f_end, a_end
+
+        n = block_size if n_samples is None else min(block_size, n_samples - start)
+        start += block_size
+        yield block[:n]
+
+
+class SoundCache:
+    def __init__(self, max_bytes=64*2**20):
+        """
+        LRU cache of rendered sounds, so that sounds repeated across epochs are only synthesized once.
+
+        :param max_bytes: memory budget for cached sounds
+        """
+        self.max_bytes = max_bytes
+
+        # key -> sound, least recently used first
+        self.sounds = OrderedDict()
+        self.n_bytes = 0
+
+        # profiling
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, sr, **kwargs):
+        """
+        :param name: name of the sound generator in this module, e.g. 'sine_song'
+        :param sr: sample rate, Hz
+        :param kwargs: generator parameters
+        :return: read-only int16 array of samples
+        """
+        key = (name, json.dumps(kwargs, sort_keys=True), sr)
+
+        if key in self.sounds:
+            self.hits += 1
+            self.sounds.move_to_end(key)
+            return self.sounds[key]
+
+        self.misses += 1
+        sound = getattr(sys.modules[__name__], name)(sr=sr, **kwargs)
+        sound.flags.writeable = False
+
+        self.sounds[key] = sound
+        self.n_bytes += sound.nbytes
+
+        # evict least recently used sounds, keeping the new one
+        while self.n_bytes > self.max_bytes and len(self.sounds) > 1:
+            self.n_bytes -= self.sounds.popitem(last=False)[1].nbytes
+
+        return sound
+
+
+class Track:
+    def __init__(self, sound, sr, pan=0.0, gain=1.0, offset=0.0, fade_in=0.0, fade_out=0.0, channels=2):
+        """
+        One sound playing in the Mixer.
+
+        :param sound: int16 samples, mono (n,) or stereo (n, 2)
+        :param sr: sample rate, Hz
+        :param pan: -1 (left) to +1 (right), between the first two output channels. Mono sounds play at full level on
+        both channels at 0. Ignored for mono output.
+        :param gain: amplitude scale factor
+        :param offset: seconds from the start of playback to the first sample of this track
+        :param fade_in: seconds of linear fade in
+        :param fade_out: seconds of linear fade out
+        :param channels: number of output channels of the mixer. Channels after the first two are silent.
+        """
+        self.sound = sound
+        self.length = len(sound)
+        if channels == 1:
+            self.channel_gains = (gain,)
+        else:
+            self.channel_gains = (gain*min(1.0, 1.0 - pan), gain*min(1.0, 1.0 + pan)) + (0.0,)*(channels - 2)
+        self.fade_in = fade_in*sr
+        self.fade_out = fade_out*sr
+
+        # index of the next sample to play, negative during the offset
+        self.position = -int(round(offset*sr))
+
+    def mix(self, mixer, begin, end):
+        """
+        Adds the next samples of this track into mixer.mix[begin:end], using the mixer's preallocated buffers.
+
+        :return: index in the mix at which the track ended, or None if it is still playing
+        """
+        # silence until the track starts
+        skip = min(max(-self.position, 0), end - begin)
+        self.position += skip
+        begin += skip
+
+        n = min(end - begin, self.length - self.position)
+        if n > 0:
+            sound = self.read(n)
+            n = len(sound)
+
+        if n > 0:
+            # gain envelope of the samples being mixed
+            index, env, tmp = mixer.index[:n], mixer.env[:n], mixer.tmp[:n]
+            np.add(mixer.ramp[:n], self.position, out=index)
+            env.fill(1.0)
+            if self.fade_in > 0:
+                np.divide(index, self.fade_in, out=tmp)
+                np.minimum(env, tmp, out=env)
+            if self.fade_out > 0:
+                np.subtract(self.length, index, out=tmp)
+                np.divide(tmp, self.fade_out, out=tmp)
+                np.minimum(env, tmp, out=env)
+
+            for channel, channel_gain in enumerate(self.channel_gains):
+                if channel_gain == 0:
+                    continue
+                samples = sound if sound.ndim == 1 else sound[:, channel % sound.shape[1]]
+                np.multiply(samples, env, out=tmp)
+                np.multiply(tmp, channel_gain, out=tmp)
+                np.add(mixer.mix[begin:begin+n, channel], tmp, out=mixer.mix[begin:begin+n, channel])
+
+            self.position += n
+            begin += n
+
+        if self.position >= self.length:
+            return begin
+        return None
+
+    def read(self, n):
+        """
+        :return: the next n samples of the track, or fewer if it ends sooner
+        """
+        return self.sound[self.position:self.position+n]
+
+
+class GeneratorTrack(Track):
+    def __init__(self, blocks, sr, duration=None, **kwargs):
+        """
+        Track whose samples are synthesized on demand, so its memory use does not depend on its duration.
+
+        :param blocks: generator of float sample blocks, in -1 to 1, e.g. sine_blocks
+        :param sr: sample rate, Hz
+        :param duration: seconds, or None if the track plays until its generator ends or it is stopped
+        :param kwargs: track settings, see Track
+        """
+        self.blocks = blocks
+        self.block = np.zeros(0)
+        self.block_position = 0
+        self.staging = np.zeros(0)
+
+        super().__init__(sound=self.staging, sr=sr, **kwargs)
+        self.length = float('inf') if duration is None else int(round(duration * sr))
+
+    def read(self, n):
+        if len(self.staging) < n:
+            self.staging = np.zeros(n)
+
+        filled = 0
+        while filled < n:
+            if self.block_position >= len(self.block):
+                try:
+                    self.block = next(self.blocks)
+                except StopIteration:
+                    # the generator ended before the nominal duration
+                    self.length = self.position + filled
+                    break
+                self.block_position = 0
+
+            k = min(n - filled, len(self.block) - self.block_position)
+            np.multiply(self.block[self.block_position:self.block_position+k], 2**15, out=self.staging[filled:filled+k])
+            filled += k
+            self.block_position += k
+
+        return self.staging[:filled]
+
+
+class Mixer:
+    def __init__(self, channels=2, frames_per_buffer=256):
+        """
+        Mixes concurrently playing tracks into one output buffer. All buffers are preallocated, so mixing does not
+        allocate on the audio thread.
+
+        :param channels: number of output channels
+        :param frames_per_buffer: initial buffer size, grown if a larger buffer is requested
+        """
+        self.channels = channels
+
+        # groups of tracks: playing now, and queued to play after the current group ends
+        self.tracks = []
+        self.queued = deque()
+
+        self.allocate(frames_per_buffer)
+
+    def allocate(self, frame_count):
+        self.mix = np.zeros((frame_count, self.channels))
+        self.out = np.zeros((frame_count, self.channels), dtype=np.int16)
+        self.ramp = np.arange(frame_count, dtype=float)
+        self.index = np.zeros(frame_count)
+        self.env = np.zeros(frame_count)
+        self.tmp = np.zeros(frame_count)
+
+    def clear(self, frame_count):
+        if len(self.ramp) < frame_count:
+            self.allocate(frame_count)
+        self.mix[:frame_count] = 0
+
+    def fill(self, begin, end):
+        """
+        Mixes the playing tracks into mix[begin:end], moving on to queued groups when all playing tracks ended.
+        """
+        while True:
+            still_playing = []
+            ended_at = begin
+            for track in self.tracks:
+                track_end = track.mix(self, begin, end)
+                if track_end is None:
+                    still_playing.append(track)
+                    ended_at = end
+                else:
+                    ended_at = max(ended_at, track_end)
+            self.tracks = still_playing
+
+            if self.tracks or (not self.queued) or (ended_at >= end):
+                return
+
+            self.tracks = self.queued.popleft()
+            begin = ended_at
+
+    def output(self, frame_count):
+        """
+        :return: (frame_count, channels) int16 view of the mix, valid until the next call
+        """
+        mix = self.mix[:frame_count]
+        np.clip(mix, -2**15, 2**15 - 1, out=mix)
+        self.out[:frame_count] = mix
+        return self.out[:frame_count]
+
+    def start(self, tracks):
+        self.tracks = tracks
+        self.queued.clear()
+
+    def queue(self, tracks):
+        if self.tracks:
+            self.queued.append(tracks)
+        else:
+            self.tracks = tracks
+
+    def stop(self):
+        self.tracks = []
+        self.queued.clear()
+
+
+class VirtualStream:
+    def __init__(self, callback, sr, channels, frames_per_buffer, file_path=None, latency=0.01):
+        """
+        Stand-in for a PyAudio output stream, for benchmarking without audio hardware. A thread calls the stream
+        callback at the real-time buffer rate, with DAC times a fixed latency after the call, and the output is
+        discarded or written to a WAV file. The DAC time of the first sample of each sound is recorded in onsets.
+
+        :param callback: PyAudio stream callback
+        :param sr: sample rate, Hz
+        :param channels: number of output channels
+        :param frames_per_buffer: samples per callback
+        :param file_path: WAV file receiving the output, or None to discard it
+        :param latency: seconds from each callback to the DAC time of its first sample
+        """
+        self.callback = callback
+        self.sr = sr
+        self.frames_per_buffer = frames_per_buffer
+        self.latency = latency
+
+        self.wav = None
+        if file_path is not None:
+            self.wav = wave.open(file_path, 'wb')
+            self.wav.setnchannels(channels)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(sr)
+
+        # DAC times of the first nonzero sample after silence
+        self.onsets = deque()
+        self.silent = True
+
+        self.running = Event()
+
+    def start_stream(self):
+        self.running.set()
+        start_daemon_thread(self.run)
+
+    def stop_stream(self):
+        self.running.clear()
+
+    def close(self):
+        self.running.clear()
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+    def get_output_latency(self):
+        return self.latency
+
+    def run(self):
+        period = self.frames_per_buffer / self.sr
+        next_time = perf_counter()
+        while self.running.is_set():
+            now = perf_counter()
+            time_info = {'input_buffer_adc_time': 0, 'current_time': now, 'output_buffer_dac_time': now + self.latency}
+            data, flag = self.callback(None, self.frames_per_buffer, time_info, 0)
+
+            samples = np.frombuffer(data, dtype=np.int16)
+            nonzero = np.flatnonzero(samples)
+            if self.silent and len(nonzero) > 0:
+                frame = nonzero[0] // (len(samples) // self.frames_per_buffer)
+                self.onsets.append(time() - now + time_info['output_buffer_dac_time'] + frame / self.sr)
+            self.silent = (len(nonzero) == 0)
+
+            if self.wav is not None:
+                self.wav.writeframes(data)
+
+            # keep the buffer rate of a real device
+            next_time += period
+            sleep(max(0, next_time - perf_counter()))
+
+
 class AudioPlay:
 
-    def __init__(self, sample_rate=44100):
-        self.sr = sample_rate
-        self.speaker = pyaudio.PyAudio()
-        self.soundTrack = None
+    def __init__(self, sample_rate=44100, frames_per_buffer=256, channels=2, device=None):
+        """
+        Plays sounds through one persistent output stream. Samples are mixed by the stream callback, on the audio
+        thread, so commands only swap the tracks being played and never block on playback.
+
+        :param sample_rate: Hz
+        :param frames_per_buffer: samples per callback. Commands take effect within one buffer period.
+        :param channels: number of output channels, 2 for stereo
+        :param device: None for the default audio output, 'null' for a virtual device that discards the output, or the
+        path of a WAV file for a virtual device that records it (see VirtualStream)
+        """
+        # released by close, also if the stream could not be opened
+        self.speaker = None
         self.stream = None
 
+        self.sr = sample_rate
+        self.frames_per_buffer = frames_per_buffer
+
+        # tracks loaded by load_stim, as keyword arguments of Track, waiting to be started or queued
+        self.loaded_tracks = []
+        self.sound_cache = SoundCache()
+
+        # playback state, shared with the audio thread
+        self.lock = Lock()
+        self.mixer = Mixer(channels=channels, frames_per_buffer=frames_per_buffer)
+
+        # tracks waiting for their scheduled start: (tracks, start_time, command_time)
+        self.scheduled = None
+
+        # (command_time, scheduled_time, output_time) of each play, in the time.time() clock
+        self.play_log = deque()
+
+        # offset from the stream clock to the time.time() clock, smallest of recent estimates
+        self.clock_offsets = deque(maxlen=64)
+
+        # seconds, used if the host API does not report DAC times
+        self.output_latency = 0
+
+        if device is None:
+            import pyaudio
+            self.speaker = pyaudio.PyAudio()
+            self.stream = self.speaker.open(format=pyaudio.paInt16,
+                                            channels=channels,
+                                            rate=self.sr,
+                                            output=True,
+                                            frames_per_buffer=frames_per_buffer,
+                                            stream_callback=self.callback)
+        else:
+            self.stream = VirtualStream(self.callback, sr=self.sr, channels=channels, frames_per_buffer=frames_per_buffer,
+                                        file_path=None if device == 'null' else device)
+        self.stream.start_stream()
+        self.output_latency = self.stream.get_output_latency()
+
     def __del__(self):
-        self.speaker.terminate()
+        self.close()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.speaker is not None:
+            self.speaker.terminate()
+            self.speaker = None
+
+    def callback(self, in_data, frame_count, time_info, status):
+        # time at which the first sample of this buffer reaches the DAC, in the time.time() clock
+        self.clock_offsets.append(time() - time_info['current_time'])
+        dac_time = time_info['output_buffer_dac_time']
+        if dac_time == 0:
+            # not reported by all host APIs
+            dac_time = time_info['current_time'] + self.output_latency
+        dac_time += min(self.clock_offsets)
+
+        with self.lock:
+            self.mixer.clear(frame_count)
+
+            # sample of this buffer at which the scheduled tracks start, if they start in this buffer
+            start = None
+            if self.scheduled is not None:
+                tracks, start_time, command_time = self.scheduled
+                if start_time is None:
+                    start = 0
+                else:
+                    start = max(int(round((start_time - dac_time)*self.sr)), 0)
+                    if start >= frame_count:
+                        start = None
+
+            if start is None:
+                self.mixer.fill(0, frame_count)
+            else:
+                self.mixer.fill(0, start)
 
-    def load_stim(self, name, **kwargs):
-        stim = getattr(sys.modules[__name__], name)
-        kwargs['sr'] = self.sr
-        self.soundTrack = stim(**kwargs)
-        self.stream = self.speaker.open(format=pyaudio.paInt16,
-                                        channels=1,
-                                        rate=self.sr,
-                                        output=True)
+                self.mixer.start(tracks)
+                self.scheduled = None
+                self.play_log.append((command_time, start_time, dac_time + start/self.sr))
 
+                self.mixer.fill(start, frame_count)
 
+            out = self.mixer.output(frame_count)
 
-    def start_stim(self):
+        # the preallocated output buffer is passed as is, without copying it into a bytes object. PyAudio copies it
+        # before the next callback. It does not accept memoryviews.
+        return out, PA_CONTINUE
+
+    def load_stim(self, name, hold=False, pan=0.0, gain=1.0, offset=0.0, fade_in=0.0, fade_out=0.0, **kwargs):
+        """
+        Loads a sound to be played by start_stim or queue_stim.
+
+        :param name: name of the sound generator in this module, e.g. 'sine_song', or of a block generator such as
+        'sine_blocks', which is synthesized during playback instead of being rendered in advance
+        :param hold: if True, the sound is added as another track to the sounds already loaded, otherwise it
+        replaces them
+        :param pan, gain, offset, fade_in, fade_out: track settings, see Track
+        :param kwargs: generator parameters
+        """
+        if hold is False:
+            self.loaded_tracks = []
+
+        track_kwargs = dict(sr=self.sr, pan=pan, gain=gain, offset=offset, fade_in=fade_in, fade_out=fade_out,
+                            channels=self.mixer.channels)
+
+        if inspect.isgeneratorfunction(getattr(sys.modules[__name__], name)):
+            # synthesized block by block during playback
+            track_kwargs['blocks'] = (name, kwargs)
+            track_kwargs['duration'] = kwargs.get('duration')
+            self.loaded_tracks.append(track_kwargs)
+        else:
+            sound = self.sound_cache.get(name, sr=self.sr, **kwargs)
+            if len(sound) > 0:
+                track_kwargs['sound'] = sound
+                self.loaded_tracks.append(track_kwargs)
+
+    def make_tracks(self):
+        tracks = []
+        for track_kwargs in self.loaded_tracks:
+            if 'blocks' in track_kwargs:
+                # start a new generator for each play
+                name, kwargs = track_kwargs['blocks']
+                kwargs = dict({'block_size': self.frames_per_buffer}, **kwargs)
+                blocks = getattr(sys.modules[__name__], name)(sr=self.sr, **kwargs)
+                tracks.append(GeneratorTrack(**dict(track_kwargs, blocks=blocks)))
+            else:
+                tracks.append(Track(**track_kwargs))
+        return tracks
+
+    def start_stim(self, t=None, start_time=None):
+        """
+        Plays the loaded tracks, replacing whatever is playing.
+
+        :param t: time at which the command was received by the stim server, in the time.time() clock
+        :param start_time: time at which the first sample should leave the DAC, in the time.time() clock. The sound
+        starts at the sample matching this time, or as soon as possible if it is None or already past.
+        """
         print('command executed to speaker at %s' % time())
-        if (self.soundTrack is not None) and (len(self.soundTrack) > 0):
-            self.stream.write(self.soundTrack, num_frames=len(self.soundTrack))
+        if self.loaded_tracks:
+            tracks = self.make_tracks()
+            with self.lock:
+                self.scheduled = (tracks, start_time, t)
+
+    def queue_stim(self):
+        """
+        Plays the loaded tracks after the tracks already playing or queued.
+        """
+        if self.loaded_tracks:
+            tracks = self.make_tracks()
+            with self.lock:
+                self.mixer.queue(tracks)
 
     def stop_stim(self):
-        self.soundTrack = None
-        self.stream.stop_stream()
-        self.stream.close()
+        self.loaded_tracks = []
+        with self.lock:
+            self.mixer.stop()
+            self.scheduled = None
+
+    def pop_play_log(self):
+        """
+        :return: list of dicts with command_time, scheduled_time and output_time of the plays since the last call
+        """
+        records = []
+        while self.play_log:
+            command_time, scheduled_time, output_time = self.play_log.popleft()
+            records.append({'command_time': command_time, 'scheduled_time': scheduled_time, 'output_time': output_time})
+        return records
 
 
 def main():
@@ -74,15 +598,28 @@ def main():
     server = MySocketServer(host=kwargs['host'], port=kwargs['port'], threaded=True, auto_stop=True, name='speaker')
 
     # launch application
-    audio = AudioPlay(sample_rate=44100)
+    audio = AudioPlay(sample_rate=44100, device=kwargs['device'])
 
     # register functions
     server.register_function(audio.load_stim)
     server.register_function(audio.start_stim)
+    server.register_function(audio.queue_stim)
     server.register_function(audio.stop_stim)
 
-    while True:
-        server.process_queue()
+    # wait for commands instead of polling, so the speaker process is idle between commands
+    while not server.shutdown_flag.is_set():
+        server.process_queue(timeout=0.1)
+
+        # report when each sound actually reached the DAC
+        for record in audio.pop_play_log():
+            print('speaker output at %s (scheduled %s)' % (record['output_time'], record['scheduled_time']))
+            server.report_audio_timing(**record)
+
+        # first samples seen by a virtual output device
+        while isinstance(audio.stream, VirtualStream) and audio.stream.onsets:
+            server.report_audio_onset(onset_time=audio.stream.onsets.popleft())
+
+    audio.close()
 
 
 if __name__ == '__main__':
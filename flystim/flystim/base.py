@@ -10,12 +10,59 @@ See flystim.stimuli for available child stimulus classes. Overwrite methods in c
 """
 
 import moderngl
+import numpy as np
+
+from flystim.util import frustum_planes
+from flystim.images import ImageCache
+
+# maximum number of subscreens that can be drawn with a single instanced draw call
+MAX_SUBSCREENS = 8
+
+# GL_CLIP_DISTANCE0, used to restrict each instance to its own subscreen viewport
+GL_CLIP_DISTANCE0 = 0x3000
+
+# vertex shader code shared by all stimulus programs: project(vert) maps a world position to clip space, either with
+# Mvp or, for single-pass rendering of all subscreens, with the perspective and viewport of the subscreen instance
+PROJECTION_SHADER = '''
+            uniform mat4 Mvp;
+
+            // single-pass rendering of all subscreens, one instance per subscreen
+            uniform bool instanced;
+            uniform mat4 instance_mvp[{max_subscreens}];
+            uniform vec4 instance_viewport[{max_subscreens}];
+
+            out float gl_ClipDistance[4];
+
+            vec4 project(vec3 vert) {{
+                if (instanced) {{
+                    vec4 pos = instance_mvp[gl_InstanceID] * vec4(vert, 1.0);
+
+                    // clip to the frustum of this subscreen
+                    gl_ClipDistance[0] = pos.w + pos.x;
+                    gl_ClipDistance[1] = pos.w - pos.x;
+                    gl_ClipDistance[2] = pos.w + pos.y;
+                    gl_ClipDistance[3] = pos.w - pos.y;
+
+                    // map the subscreen clip volume into its viewport on the display
+                    vec4 vp = instance_viewport[gl_InstanceID];
+                    return vec4(pos.x*vp.x + vp.z*pos.w, pos.y*vp.y + vp.w*pos.w, pos.z, pos.w);
+                }} else {{
+                    gl_ClipDistance[0] = 1.0;
+                    gl_ClipDistance[1] = 1.0;
+                    gl_ClipDistance[2] = 1.0;
+                    gl_ClipDistance[3] = 1.0;
+
+                    return Mvp * vec4(vert, 1.0);
+                }}
+            }}
+'''.format(max_subscreens=MAX_SUBSCREENS)
 
 
 class BaseProgram:
     def __init__(self, screen, num_tri=500):
         """
         :param screen: Object containing screen size information
+        :param num_tri: initial number of triangles reserved in the VBO, grown as needed in paint_at
         """
         # set screen
         self.screen = screen
@@ -24,6 +71,14 @@ class BaseProgram:
         self.texture = None
         self.draw_mode = 'TRIANGLES' # TRIANGLES, POINTS
         self.point_size = 2 # pixels on screen, only for POINTS draw_mode
+        self.image_cache = None # flystim.images.ImageCache, set by the display
+        self.vbo = None
+        self.vao = None
+
+        # skip drawing to subscreens whose view frustum does not contain the stim object
+        self.frustum_culling = True
+        self.n_drawn = 0
+        self.n_culled = 0
 
     def initialize(self, ctx):
         """
@@ -40,31 +95,58 @@ class BaseProgram:
         else:
             self.prog['use_texture'].value = False
 
+        self.prog['instanced'].value = False
+
     def configure(self, *args, **kwargs):
         pass
 
-    def paint_at(self, t, viewports, perspectives, fly_position=[0, 0, 0], fly_heading=[0, 0]):
+    def paint_at(self, t, viewports, perspectives, fly_position=[0, 0, 0], fly_heading=[0, 0], instanced=False, planes=None):
         """
         :param t: current time in seconds
         :param viewports: list of viewport arrays for each subscreen - (xmin, ymin, width, height) in display device pixels
         :param perspectives: list of perspective matrices for each subscreen, generated using perspective.GenPerspective and subscreen corners
         :param fly_position: x, y, z position of fly (meters)
+        :param instanced: if True, draw all subscreens with one instanced draw call. ctx.viewport must cover the whole display.
+        :param planes: list of frustum planes (util.frustum_planes) of each perspective matrix. Computed here if None.
         """
         self.eval_at(t, fly_position=fly_position, fly_heading=fly_heading) # update any stim objects that depend on fly position
 
-        data = self.stim_object.data # get stim object vertex data
-        self.update_vertex_objects()
-
-        if self.use_texture:
-            vertices = len(data) // 9
+        # test each part of the stim object against the view frustum of each subscreen, before uploading any vertices
+        if self.frustum_culling:
+            if planes is None:
+                planes = [frustum_planes(p) for p in perspectives]
+            visible_parts = self.stim_object.visible_parts(planes)
+            visible = list(np.any(visible_parts, axis=0))
         else:
-            vertices = len(data) // 7
+            visible = [True for p in perspectives]
+        self.n_drawn += sum(visible)
+        self.n_culled += len(visible) - sum(visible)
+
+        if not any(visible):
+            return
+
+        if self.frustum_culling:
+            # only upload the parts visible on at least one subscreen
+            keep = np.any(visible_parts, axis=1)
+            if np.all(keep):
+                vertices = self.write_vertex_objects()
+            else:
+                vertices = self.write_vertex_objects(self.stim_object.select_parts(keep))
+        else:
+            vertices = self.write_vertex_objects()
 
-        # write data to VBO
-        self.vbo.write(data.astype('f4'))
+        if instanced and 1 < len(viewports) <= MAX_SUBSCREENS:
+            # one instance per visible subscreen
+            self.render_instanced(vertices,
+                                  [vp for vp, v in zip(viewports, visible) if v],
+                                  [p for p, v in zip(perspectives, visible) if v])
+            return
 
         # Render to each subscreen
         for v_ind, vp in enumerate(viewports):
+            if not visible[v_ind]:
+                continue
+
             # set the perspective matrix
             self.prog['Mvp'].write(perspectives[v_ind])
             # set the viewport
@@ -77,6 +159,82 @@ class BaseProgram:
             elif self.draw_mode == 'TRIANGLES':
                 self.vao.render(mode=moderngl.TRIANGLES, vertices=vertices)
 
+    def render_instanced(self, vertices, viewports, perspectives):
+        """
+        Render to all subscreens with one draw call. Each instance uses the perspective matrix of its subscreen, then
+        is mapped into the subscreen viewport (within the current full-display viewport) and clipped to it.
+        """
+        display_x, display_y, display_width, display_height = self.ctx.viewport
+
+        # (x scale, y scale, x offset, y offset) in NDC of each subscreen viewport
+        viewport_transforms = np.zeros((MAX_SUBSCREENS, 4), dtype='f4')
+        for v_ind, (x, y, width, height) in enumerate(viewports):
+            viewport_transforms[v_ind] = (width/display_width,
+                                          height/display_height,
+                                          2*(x - display_x + width/2)/display_width - 1,
+                                          2*(y - display_y + height/2)/display_height - 1)
+
+        mvp_data = b''.join(perspectives) + bytes(64*(MAX_SUBSCREENS - len(perspectives)))
+
+        self.prog['instanced'].value = True
+        self.prog['instance_mvp'].write(mvp_data)
+        self.prog['instance_viewport'].write(viewport_transforms.tobytes())
+
+        for plane in range(4):
+            self.ctx.enable_direct(GL_CLIP_DISTANCE0 + plane)
+
+        if self.draw_mode == 'POINTS':
+            self.ctx.point_size = self.point_size
+            self.vao.render(mode=moderngl.POINTS, vertices=vertices, instances=len(viewports))
+        elif self.draw_mode == 'TRIANGLES':
+            self.vao.render(mode=moderngl.TRIANGLES, vertices=vertices, instances=len(viewports))
+
+        for plane in range(4):
+            self.ctx.disable_direct(GL_CLIP_DISTANCE0 + plane)
+
+        self.prog['instanced'].value = False
+
+    def write_vertex_objects(self, stim_object=None):
+        """
+        Creates the VBO and VAO for this frame and writes the stim object vertex data into them.
+
+        :param stim_object: GlVertices to write, self.stim_object if None
+        :return: number of vertices to draw
+        """
+        if stim_object is None:
+            stim_object = self.stim_object
+        data = stim_object.data # get stim object vertex data
+
+        if self.use_texture:
+            vertices = len(data) // 9
+        else:
+            vertices = len(data) // 7
+
+        # grow the VBO reservation to fit the stim object
+        self.num_tri = max(self.num_tri, -(-vertices // 3))
+        self.update_vertex_objects()
+
+        # write data to VBO
+        self.vbo.write(data.astype('f4'))
+
+        return vertices
+
+    def release_vertex_objects(self):
+        """
+        Releases the VBO and VAO created for this frame. Nothing is created for a frame in which the stim is culled.
+        """
+        if self.vbo is not None:
+            self.vbo.release()
+            self.vao.release()
+            self.vbo = None
+            self.vao = None
+
+    def release(self):
+        """
+        Releases GL objects owned by the stimulus, when it is removed from the display.
+        """
+        self.prog.release()
+
     def update_vertex_objects(self):
         if self.use_texture:
             # 3 points, 9 values (3 for vert, 4 for color, 2 for tex_coords), 4 bytes per value
@@ -101,6 +259,15 @@ class BaseProgram:
 
         self.texture.use()
 
+    def add_image_texture_gl(self, image_path):
+        """
+        Uses a preprocessed, mipmapped image texture from the display's image cache.
+        """
+        if self.image_cache is None:
+            self.image_cache = ImageCache(self.ctx)
+        self.texture = self.image_cache.get_texture(image_path)
+        self.texture.use()
+
     def update_texture_gl(self, texture_image):
         self.texture.write(data=texture_image.tobytes())
 
@@ -125,13 +292,12 @@ class BaseProgram:
 
             out vec4 v_color;
             out vec2 v_tex_coord;
-
-            uniform mat4 Mvp;
-
+            ''' + PROJECTION_SHADER + '''
             void main() {
                 v_color = in_color;
                 v_tex_coord = in_tex_coord;
-                gl_Position = Mvp * vec4(in_vert, 1.0);
+
+                gl_Position = project(in_vert);
             }
         '''
         return vertex_shader
@@ -0,0 +1,187 @@
+# Renders the fly-centered scene once per frame into a cubemap, then warps it onto each subscreen.
+# The six cube faces are stored side by side in one 2D atlas texture (3 x 2 faces), since ModernGL cannot attach
+# individual cubemap faces to a framebuffer.
+
+import moderngl
+import numpy as np
+
+from flystim.perspective import GenPerspective
+from flystim.util import rotx, rotz
+
+
+# (major axis, s axis, t axis) of each face, in the OpenGL cubemap face order +x, -x, +y, -y, +z, -z
+CUBE_FACES = [((+1, 0, 0), (0, 0, -1), (0, -1, 0)),
+              ((-1, 0, 0), (0, 0, +1), (0, -1, 0)),
+              ((0, +1, 0), (+1, 0, 0), (0, 0, +1)),
+              ((0, -1, 0), (+1, 0, 0), (0, 0, -1)),
+              ((0, 0, +1), (+1, 0, 0), (0, -1, 0)),
+              ((0, 0, -1), (-1, 0, 0), (0, -1, 0))]
+
+
+class CubemapProgram:
+    def __init__(self, screen):
+        # save settings
+        self.screen = screen
+
+        # initialize settings
+        self.enabled = False
+        self.face_size = 512
+        self.size = None
+
+        # screen corners (pa, pb, pc) of a 90 degree face of a unit cube around the fly
+        self.face_corners = []
+        for ma, sc, tc in CUBE_FACES:
+            ma, sc, tc = np.array(ma), np.array(sc), np.array(tc)
+            self.face_corners.append((ma - sc - tc, ma + sc - tc, ma - sc + tc))
+
+    def initialize(self, ctx):
+        """
+        :param ctx: ModernGL context
+        """
+
+        # save context
+        self.ctx = ctx
+
+        # create OpenGL program
+        self.prog = self.create_prog()
+
+        # create VBO to represent vertex positions
+        pts = np.array([-1, -1, 1, -1, -1, 1, 1, 1]) # fill the viewport
+        vbo = self.ctx.buffer(pts.astype('f4').tobytes())
+
+        # create vertex array object
+        self.vao = self.ctx.simple_vertex_array(self.prog, vbo, 'pos')
+
+    def configure(self, enabled=True, face_size=512):
+        """
+        :param enabled: Boolean. If True, render the scene into a cubemap and warp it onto each subscreen.
+        :param face_size: resolution (pixels) of each cube face
+        """
+        self.enabled = enabled
+        self.face_size = int(face_size)
+
+    def create_prog(self):
+        return self.ctx.program(
+            vertex_shader='''
+                #version 330
+
+                in vec2 pos;
+                out vec2 uv;
+
+                void main() {
+                    uv = 0.5*(pos + 1.0);
+                    gl_Position = vec4(pos, 0.0, 1.0);
+                }
+            ''',
+            fragment_shader='''
+                #version 330
+
+                in vec2 uv;
+
+                // subscreen corners relative to the fly, rotated by the fly heading
+                uniform vec3 pa;
+                uniform vec3 pb;
+                uniform vec3 pc;
+                uniform bool horizontal_flip;
+
+                uniform sampler2D atlas;
+                uniform float face_size;
+
+                out vec4 out_color;
+
+                vec2 atlas_coord(vec3 d) {
+                    vec3 a = abs(d);
+                    int face;
+                    float ma, sc, tc;
+
+                    if ((a.x >= a.y) && (a.x >= a.z)) {
+                        ma = a.x;
+                        if (d.x > 0) { face = 0; sc = -d.z; tc = -d.y; } else { face = 1; sc = d.z; tc = -d.y; }
+                    } else if (a.y >= a.z) {
+                        ma = a.y;
+                        if (d.y > 0) { face = 2; sc = d.x; tc = d.z; } else { face = 3; sc = d.x; tc = -d.z; }
+                    } else {
+                        ma = a.z;
+                        if (d.z > 0) { face = 4; sc = d.x; tc = -d.y; } else { face = 5; sc = -d.x; tc = -d.y; }
+                    }
+
+                    // keep samples half a texel inside the face to avoid bleeding across atlas tiles
+                    float half_texel = 0.5/face_size;
+                    vec2 st = clamp(0.5*(vec2(sc, tc)/ma + 1.0), half_texel, 1.0 - half_texel);
+
+                    return (vec2(face % 3, face / 3) + st) / vec2(3.0, 2.0);
+                }
+
+                void main() {
+                    float u = horizontal_flip ? 1.0 - uv.x : uv.x;
+                    vec3 direction = pa + u*(pb - pa) + uv.y*(pc - pa);
+
+                    out_color = vec4(texture(atlas, atlas_coord(direction)).rgb, 1.0);
+                }
+            '''
+        )
+
+    def use_atlas_fbo(self):
+        """
+        Binds (and clears) the framebuffer holding the six cube faces.
+        """
+        size = (3*self.face_size, 2*self.face_size)
+        if size != self.size:
+            if self.size is not None:
+                self.atlas_fbo.release()
+                self.atlas_texture.release()
+                self.atlas_depth.release()
+            self.atlas_texture = self.ctx.texture(size=size, components=4)
+            self.atlas_texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
+            self.atlas_depth = self.ctx.depth_renderbuffer(size)
+            self.atlas_fbo = self.ctx.framebuffer(color_attachments=[self.atlas_texture], depth_attachment=self.atlas_depth)
+            self.size = size
+
+        self.atlas_fbo.use()
+        self.atlas_fbo.clear(0, 0, 0, 1)
+        self.ctx.viewport = (0, 0, size[0], size[1])
+
+    @property
+    def face_viewports(self):
+        return [((face % 3)*self.face_size, (face // 3)*self.face_size, self.face_size, self.face_size) for face in range(6)]
+
+    def get_face_perspectives(self, fly_pos):
+        """
+        :param fly_pos: (x, y, z) position of fly, meters
+        :return: list of world-aligned perspective matrices, one per cube face
+        """
+        return [GenPerspective(pa=pa, pb=pb, pc=pc, fly_pos=fly_pos).matrix for pa, pb, pc in self.face_corners]
+
+    def warp(self, target, viewports, theta, phi):
+        """
+        Draws each subscreen of the screen into target by sampling the cubemap along the view direction of each pixel.
+
+        :param target: framebuffer to draw the subscreens into
+        :param viewports: list of subscreen viewports, in the same order as screen.subscreens
+        :param theta: fly heading angle along azimuth, radians
+        :param phi: fly heading angle along elevation, as passed to framework.get_perspective
+        """
+        target.use()
+
+        self.prog['horizontal_flip'].value = self.screen.horizontal_flip
+        self.prog['face_size'].value = self.face_size
+        self.prog['atlas'].value = 1
+        self.atlas_texture.use(location=1)
+
+        self.ctx.disable(moderngl.DEPTH_TEST)
+        for subscreen, viewport in zip(self.screen.subscreens, viewports):
+            # rotate the subscreen by the fly heading, matching framework.get_perspective
+            for name in ['pa', 'pb', 'pc']:
+                corner = rotx(rotz(np.array(getattr(subscreen, name), dtype=float), theta), np.radians(phi))
+                self.prog[name].value = tuple(corner)
+
+            self.ctx.viewport = viewport
+            self.vao.render(mode=moderngl.TRIANGLE_STRIP)
+        self.ctx.enable(moderngl.DEPTH_TEST)
+
+    def read(self):
+        """
+        :return: (2*face_size, 3*face_size, 4) uint8 array of the cube face atlas, faces ordered +x, -x, +y (bottom row)
+        and -y, +z, -z (top row)
+        """
+        return np.frombuffer(self.atlas_texture.read(), dtype=np.uint8).reshape(self.size[1], self.size[0], 4)
@@ -0,0 +1,108 @@
+# Devices driven by the stim server alongside the screens, e.g. speakers or LED drivers. Each device type names the
+# module run as its process and the commands that process serves. Device processes are launched on first use, and
+# each device has its own outbound queue and writer thread, so a device that is slow to launch or to read its socket
+# does not hold up the stim server or the other devices.
+
+import importlib.util
+import logging
+from queue import Queue
+
+from flyrpc.launch import launch_server
+from flyrpc.util import start_daemon_thread
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceType:
+    def __init__(self, module, commands):
+        """
+        :param module: name of the module run as the device process, e.g. 'flystim.audio'. Its main() gets the launch
+        arguments through flyrpc.util.get_kwargs and serves the commands.
+        :param commands: names of the functions registered by the device process
+        """
+        self.module = module
+        self.commands = commands
+
+
+# device type name -> DeviceType
+device_types = {}
+
+
+def register_device_type(name, module, commands):
+    """
+    Makes a device type available to the stim server, see DeviceType.
+    """
+    device_types[name] = DeviceType(module=module, commands=commands)
+
+
+register_device_type('speaker', module='flystim.audio', commands=['load_stim', 'start_stim', 'queue_stim', 'stop_stim'])
+
+
+class Device:
+    def __init__(self, name, device_type, on_connect=None, on_reject=None, **launch_kwargs):
+        """
+        :param name: name used in the device field of requests
+        :param device_type: name of a registered device type
+        :param on_connect: function called with this Device once its process has been launched
+        :param on_reject: function called with each request and the reason, for requests that cannot be delivered
+        because the device process could not be launched
+        :param launch_kwargs: arguments passed to the device process
+        """
+        if device_type not in device_types:
+            raise ValueError('Unknown device type: {}'.format(device_type))
+
+        self.name = name
+        self.device_type = device_types[device_type]
+        self.on_connect = on_connect
+        self.on_reject = on_reject
+        self.launch_kwargs = launch_kwargs
+
+        # client of the device process, None until it is launched
+        self.client = None
+
+        # reason the last launch failed. Requests are then rejected until a launch is requested again.
+        self.launch_error = None
+
+        # outbound request lists; None only asks for the process to be launched
+        self.queue = Queue()
+        start_daemon_thread(self.write_loop)
+
+    def supports(self, command):
+        return command in self.device_type.commands
+
+    def launch(self):
+        """
+        Launches the device process in the background, if that has not happened yet. Also retries a failed launch.
+        """
+        self.queue.put(None)
+
+    def write_request_list(self, request_list):
+        self.queue.put(request_list)
+
+    def write_loop(self):
+        while True:
+            request_list = self.queue.get()
+
+            if (self.client is None) and ((self.launch_error is None) or (request_list is None)):
+                try:
+                    # resolve the module file without importing it, since its dependencies may only be needed there
+                    spec = importlib.util.find_spec(self.device_type.module)
+                    if spec is None:
+                        raise ImportError('No module named {}'.format(self.device_type.module))
+                    self.client = launch_server(spec.origin, **self.launch_kwargs)
+                except Exception as e:
+                    logger.exception('Could not launch device %s', self.name)
+                    self.launch_error = 'Could not launch device {}: {}'.format(self.name, e)
+                else:
+                    self.launch_error = None
+                    if self.on_connect is not None:
+                        self.on_connect(self)
+
+            if request_list is None:
+                continue
+
+            if self.client is not None:
+                self.client.write_request_list(request_list)
+            elif self.on_reject is not None:
+                for request in request_list:
+                    self.on_reject(request, self.launch_error)
@@ -1,4 +1,4 @@
-from PyQt5 import QtOpenGL, QtWidgets
+from PyQt5 import QtOpenGL, QtWidgets, QtGui
 
 import time
 import sys
@@ -12,9 +12,14 @@ from skimage.transform import downscale_local_mean
 
 from flystim import stimuli
 from flystim.trajectory import make_as_trajectory, return_for_time_t
+from flystim.util import frustum_planes
 
 from flystim.perspective import GenPerspective
 from flystim.square import SquareProgram
+from flystim.subframe import SubframeProgram
+from flystim.cubemap import CubemapProgram
+from flystim.pose import PoseChannel
+from flystim.images import ImageCache
 from flystim.screen import Screen
 from math import radians
 
@@ -52,10 +57,23 @@ class StimDisplay(QtOpenGL.QGLWidget):
         # stimulus state
         self.stim_started = False
         self.stim_start_time = None
+        self.stim_onset_reported = False
+        self.stim_scheduled_time = None
+        self.pending_start = None
+
+        # stimulus clock: 'wall' uses time.time(), 'frame' advances by one refresh period per presented frame
+        self.set_clock_mode('wall')
+        self.reset_frame_clock()
 
         # profiling information
         self.profile_frame_times = []
 
+        # index of the frame being drawn, counted from startup
+        self.frame_index = 0
+
+        # epoch schedule executed on frame boundaries (see run_epoch)
+        self.epoch_schedule = None
+
         # save handles to screen and server
         self.screen = screen
         self.server = server
@@ -68,9 +86,19 @@ class StimDisplay(QtOpenGL.QGLWidget):
         # make program for rendering the corner square
         self.square_program = SquareProgram(screen=screen)
 
+        # make program for packing temporal sub-frames into one video frame (pattern mode projectors)
+        self.subframe_program = SubframeProgram(screen=screen)
+
         # initialize background color
         self.idle_background = 0.5
 
+        # draw all subscreens with one instanced draw call per stimulus
+        self.instanced_subscreens = False
+
+        # make program for rendering the scene into a cubemap and warping it onto the subscreens
+        self.cubemap_program = CubemapProgram(screen=screen)
+        self.cubemap_frames = []
+
         # set the closed-loop parameters
         self.set_global_fly_pos(0, 0, 0)
         self.set_global_theta_offset(0) # deg -> radians
@@ -81,6 +109,11 @@ class StimDisplay(QtOpenGL.QGLWidget):
         self.fly_y_trajectory = None
         self.fly_theta_trajectory = None
 
+        # shared-memory fly pose channel for closed-loop VR
+        self.pose_channel = None
+        self.pose_timestamp = None
+        self.pose_latencies = []
+
     def initializeGL(self):
         # get OpenGL context
         self.ctx = moderngl.create_context() # TODO: can we make this run headless in render_movie_mode?
@@ -90,17 +123,176 @@ class StimDisplay(QtOpenGL.QGLWidget):
         # initialize square program
         self.square_program.initialize(self.ctx)
 
+        # initialize sub-frame packing program
+        self.subframe_program.initialize(self.ctx)
+
+        # initialize cubemap program
+        self.cubemap_program.initialize(self.ctx)
+
+        # the widget is now on its screen, so the refresh period can be taken from that display
+        self.frame_period = 1.0/self.get_refresh_rate()
+
+        # textures of image-based stimuli, kept on the GPU across stimuli
+        self.image_cache = ImageCache(self.ctx)
+
     def get_stim_time(self, t):
         stim_time = 0
 
         if self.stim_started:
-            stim_time += t - self.stim_start_time
+            if self.clock_mode == 'frame':
+                # frame_count is None until the first frame after start_stim has been presented
+                stim_time += (self.frame_count or 0) * self.frame_period
+            else:
+                stim_time += t - self.stim_start_time
 
         return stim_time
 
+    def get_frame_stats(self, frame_times=False):
+        """
+        :param frame_times: if True, include the render time of each frame since start_stim
+        :return: dict with the frame counter of the display, the start time of the current stimulus, its number of
+        rendered frames, the render times of its first and last frame, and its missed frames (frame clock mode only)
+        """
+        stats = {'frame_index': self.frame_index,
+                 'stim_started': self.stim_started,
+                 'stim_start_time': self.stim_start_time,
+                 'n_frames': len(self.profile_frame_times),
+                 'first_frame_time': self.profile_frame_times[0] if self.profile_frame_times else None,
+                 'last_frame_time': self.profile_frame_times[-1] if self.profile_frame_times else None,
+                 'missed_frames': self.missed_frames}
+
+        if frame_times:
+            stats['frame_times'] = list(self.profile_frame_times)
+
+        return stats
+
+    def reset_frame_clock(self):
+        self.frame_count = None
+        self.last_frame_time = None
+        self.missed_frames = 0
+
+    def advance_frame_clock(self, t):
+        """
+        Advance the frame-locked stimulus clock by one presented frame. Call once per paintGL.
+
+        Missed vsyncs are detected from the wall-clock interval since the previous frame. With the 'compensate' policy
+        the clock jumps ahead by the number of missed frames, so that stimulus time stays locked to real time on
+        multiples of the refresh period. With the 'skip' policy the clock always advances by exactly one period and
+        missed frames are only counted.
+
+        :param t: wall-clock time of the current frame
+        """
+        if self.frame_count is None:
+            # first frame after start_stim is presented at stim time 0
+            self.frame_count = 0
+        else:
+            n_elapsed = max(1, int(round((t - self.last_frame_time) / self.frame_period)))
+            self.missed_frames += n_elapsed - 1
+            if self.missed_frame_policy == 'compensate':
+                self.frame_count += n_elapsed
+            else:
+                self.frame_count += 1
+
+        self.last_frame_time = t
+
+    def read_pose_channel(self):
+        pose = self.pose_channel.read()
+        if pose is None:
+            return
+
+        seq, x, y, z, heading, timestamp = pose
+        self.set_global_fly_pos(x, y, z)
+        self.set_global_theta_offset(heading)
+        self.pose_timestamp = timestamp
+
+    def update_epoch_schedule(self, t):
+        """
+        Starts / stops the stimulus at the first frame at or after the scheduled transition times, then reports the
+        frame indices and times actually used to the client.
+
+        :param t: time of the current frame
+        """
+        schedule = self.epoch_schedule
+
+        if (schedule['stim_start_frame'] is None) and (t >= schedule['stim_start_time']):
+            self.start_stim(t, append_stim_frames=schedule['append_stim_frames'])
+            if schedule['corner_square']:
+                self.start_corner_square()
+            schedule['stim_start_frame'] = self.frame_index
+            schedule['stim_start_frame_time'] = t
+
+        if (schedule['stim_start_frame'] is not None) and (t >= schedule['stim_stop_time']):
+            self.stop_stim(print_profile=schedule['print_profile'])
+            if schedule['corner_square']:
+                self.black_corner_square()
+            schedule['stim_stop_frame'] = self.frame_index
+            schedule['stim_stop_frame_time'] = t
+
+            self.epoch_schedule = None
+            self.server.report_epoch_timing(screen_name=self.screen.name,
+                                            epoch_id=schedule['epoch_id'],
+                                            stim_start_frame=schedule['stim_start_frame'],
+                                            stim_stop_frame=schedule['stim_stop_frame'],
+                                            stim_start_time=schedule['stim_start_frame_time'],
+                                            stim_stop_time=schedule['stim_stop_frame_time'],
+                                            scheduled_stim_start_time=schedule['stim_start_time'],
+                                            scheduled_stim_stop_time=schedule['stim_stop_time'],
+                                            epoch_end_time=schedule['epoch_end_time'])
+
     def clear_viewport(self, viewport):
         self.ctx.clear(red=self.idle_background, green=self.idle_background, blue=self.idle_background, alpha=1.0, viewport=viewport)
 
+    def paint_stim_list(self, stim_time):
+        """
+        Render all stimuli in stim_list at the given stimulus time into the currently bound framebuffer.
+        """
+        if self.use_fly_trajectory:
+            self.set_global_fly_pos(return_for_time_t(self.fly_x_trajectory, stim_time),
+                                    return_for_time_t(self.fly_y_trajectory, stim_time),
+                                    0)
+            self.set_global_theta_offset(return_for_time_t(self.fly_theta_trajectory, stim_time))  # deg -> radians
+
+        if self.cubemap_program.enabled and self.stim_started:
+            # render the scene once into the world-aligned cube faces around the fly, then warp onto each subscreen
+            target = self.ctx.fbo
+            self.cubemap_program.use_atlas_fbo()
+            viewports = self.cubemap_program.face_viewports
+            perspectives = self.cubemap_program.get_face_perspectives(self.global_fly_pos)
+        else:
+            # For each subscreen associated with this screen: get the perspective matrix
+            viewports = self.subscreen_viewports
+            perspectives = [get_perspective(self.global_fly_pos, self.global_theta_offset, self.global_phi_offset, x.pa, x.pb, x.pc, self.screen.horizontal_flip) for x in self.screen.subscreens]
+
+            # instanced rendering maps each subscreen into the full-display viewport
+            if self.instanced_subscreens:
+                self.ctx.viewport = self.display_viewport
+
+        # view frustum of each subscreen, shared by all stimuli for culling
+        planes = [frustum_planes(p) for p in perspectives]
+
+        for stim in self.stim_list:
+            if self.stim_started:
+                stim.paint_at(stim_time,
+                              viewports,
+                              perspectives,
+                              fly_position=self.global_fly_pos.copy(),
+                              fly_heading=[self.global_theta_offset+0, self.global_phi_offset+0],
+                              instanced=self.instanced_subscreens,
+                              planes=planes)
+            else:
+                [self.clear_viewport(viewport=x) for x in self.subscreen_viewports]
+
+        if self.cubemap_program.enabled and self.stim_started:
+            self.cubemap_program.warp(target, self.subscreen_viewports, self.global_theta_offset, self.global_phi_offset)
+
+            if self.append_stim_frames:
+                self.cubemap_frames.append(self.cubemap_program.read()[:, :, 2])
+
+        # clear the buffer objects
+        for stim in self.stim_list:
+            if self.stim_started:
+                stim.release_vertex_objects()
+
     def paintGL(self):
         # t0 = time.time() # benchmarking
 
@@ -111,10 +303,23 @@ class StimDisplay(QtOpenGL.QGLWidget):
         # handle RPC input
         self.server.process_queue()
 
+        # read the newest fly pose from the tracker
+        if self.pose_channel is not None:
+            self.read_pose_channel()
+
+        # execute any epoch transitions due at this frame
+        if self.epoch_schedule is not None:
+            self.update_epoch_schedule(time.time())
+
+        # start a stimulus scheduled for this frame
+        if (self.pending_start is not None) and (time.time() >= self.pending_start['start_time']):
+            self.start_stim(**self.pending_start)
+
         # get display size and set viewports
         display_width = self.width()*self.devicePixelRatio()
         display_height = self.height()*self.devicePixelRatio()
 
+        self.display_viewport = (0, 0, display_width, display_height)
         self.subscreen_viewports = [sub.get_viewport(display_width, display_height) for sub in self.screen.subscreens]
         # Get viewport for corner square
         self.square_program.set_viewport(display_width, display_height)
@@ -123,24 +328,17 @@ class StimDisplay(QtOpenGL.QGLWidget):
         # draw the stimulus
         if self.stim_list:
             t = time.time()
-            if self.use_fly_trajectory:
-                self.set_global_fly_pos(return_for_time_t(self.fly_x_trajectory, self.get_stim_time(t)),
-                                        return_for_time_t(self.fly_y_trajectory, self.get_stim_time(t)),
-                                        0)
-                self.set_global_theta_offset(return_for_time_t(self.fly_theta_trajectory, self.get_stim_time(t)))  # deg -> radians
-
-            # For each subscreen associated with this screen: get the perspective matrix
-            perspectives = [get_perspective(self.global_fly_pos, self.global_theta_offset, self.global_phi_offset, x.pa, x.pb, x.pc, self.screen.horizontal_flip) for x in self.screen.subscreens]
-
-            for stim in self.stim_list:
-                if self.stim_started:
-                    stim.paint_at(self.get_stim_time(t),
-                                  self.subscreen_viewports,
-                                  perspectives,
-                                  fly_position=self.global_fly_pos.copy(),
-                                  fly_heading=[self.global_theta_offset+0, self.global_phi_offset+0])
-                else:
-                    [self.clear_viewport(viewport=x) for x in self.subscreen_viewports]
+            if self.stim_started and self.clock_mode == 'frame':
+                self.advance_frame_clock(t)
+
+            if self.subframe_program.enabled:
+                # evaluate the scene at each sub-frame time and pack it into its channel / bit-plane of this frame
+                for subframe in range(self.subframe_program.n_subframes):
+                    self.subframe_program.use_scene_fbo(display_width, display_height)
+                    self.paint_stim_list(self.get_stim_time(t) + subframe*self.frame_period/self.subframe_program.n_subframes)
+                    self.subframe_program.pack(subframe, display_width, display_height)
+            else:
+                self.paint_stim_list(self.get_stim_time(t))
 
             self.profile_frame_times.append(t)
         else:
@@ -153,11 +351,18 @@ class StimDisplay(QtOpenGL.QGLWidget):
         self.ctx.finish()
         self.update()
 
-        # clear the buffer objects
-        for stim in self.stim_list:
-            if self.stim_started:
-                stim.vbo.release()
-                stim.vao.release()
+        # report when the first frame of the stimulus was drawn
+        if self.stim_started and self.profile_frame_times and not self.stim_onset_reported:
+            self.server.report_stim_onset(screen_name=self.screen.name, command_time=self.stim_start_time,
+                                          render_time=self.profile_frame_times[0], onset_time=time.time(),
+                                          scheduled_time=self.stim_scheduled_time)
+            self.stim_onset_reported = True
+
+        # log tracker-to-render latency of the pose used for this frame
+        if self.stim_started and (self.pose_timestamp is not None):
+            self.pose_latencies.append(time.time() - self.pose_timestamp)
+
+        self.frame_index += 1
 
         if self.stim_started:
             # print('paintGL {:.2f} ms'.format((time.time()-t0)*1000)) #benchmarking
@@ -193,24 +398,70 @@ class StimDisplay(QtOpenGL.QGLWidget):
 
         stim = getattr(stimuli, name)(screen=self.screen)
         stim.initialize(self.ctx)
+        stim.image_cache = self.image_cache
         stim.kwargs = kwargs
         stim.configure(**stim.kwargs) # Configure stim on load
         self.stim_list.append(stim)
 
-    def start_stim(self, t, append_stim_frames=False):
+    def run_epoch(self, t, pre_time, stim_time, tail_time=0, start_time=None, append_stim_frames=False, print_profile=False, corner_square=True, epoch_id=None):
+        """
+        Run an entire epoch from a single command. The stimulus is started and stopped on the first frame boundary at or
+        after start_time + pre_time and start_time + pre_time + stim_time, and the frame indices and times actually
+        used are sent back to the client as a report_epoch_timing message.
+
+        :param t: time at which the command was received by the stim server, used as start_time by default
+        :param pre_time: seconds from start_time to stimulus onset
+        :param stim_time: stimulus duration, seconds
+        :param tail_time: seconds after stimulus offset, reported back as epoch_end_time
+        :param start_time: time at which the epoch starts, in the time.time() clock
+        :param append_stim_frames: see start_stim
+        :param print_profile: see stop_stim
+        :param corner_square: Boolean. If True, toggle the corner square during the stimulus and make it black after.
+        :param epoch_id: returned in the report, so the client can tell it apart from reports of other epochs
+        """
+        if start_time is None:
+            start_time = t
+
+        self.epoch_schedule = {'stim_start_time': start_time + pre_time,
+                               'stim_stop_time': start_time + pre_time + stim_time,
+                               'epoch_end_time': start_time + pre_time + stim_time + tail_time,
+                               'append_stim_frames': append_stim_frames,
+                               'print_profile': print_profile,
+                               'corner_square': corner_square,
+                               'epoch_id': epoch_id,
+                               'stim_start_frame': None,
+                               'stim_start_frame_time': None,
+                               'stim_stop_frame': None,
+                               'stim_stop_frame_time': None}
+
+    def start_stim(self, t=None, append_stim_frames=False, start_time=None):
         """
         Start the stimulus animation, using the given time as t=0.
 
         :param t: Time corresponding to t=0 of the animation
         :param append_stim_frames: bool, append frames to stim_frames list, for saving stim movie. May affect performance.
+        :param start_time: scheduled start, used instead of t as t=0. If it is in the future, the animation starts at
+        the first frame drawn at or after it. Used by the stim server to start several devices together.
         """
+        if start_time is not None:
+            if start_time > time.time():
+                self.pending_start = {'start_time': start_time, 'append_stim_frames': append_stim_frames}
+                return
+            t = start_time
+
         print('command executed to screen at %s' % time.time())
         self.profile_frame_times = []
+        self.pose_latencies = []
         self.stim_frames = []
+        self.cubemap_frames = []
         self.append_stim_frames = append_stim_frames
 
         self.stim_started = True
         self.stim_start_time = t
+        self.stim_onset_reported = False
+        self.stim_scheduled_time = start_time
+        self.pending_start = None
+        self.reset_frame_clock()
 
     def stop_stim(self, print_profile=False):
         """
@@ -220,7 +471,7 @@ class StimDisplay(QtOpenGL.QGLWidget):
         self.ctx.clear_samplers()
 
         for stim in self.stim_list:
-            stim.prog.release()
+            stim.release()
 
         # print profiling information if applicable
         if (print_profile):
@@ -234,6 +485,21 @@ class StimDisplay(QtOpenGL.QGLWidget):
                 if print_profile:
                     print('*** ' + stim_names + ' ***')
                     print(fps_data.describe(percentiles=[0.01, 0.05, 0.1, 0.9, 0.95, 0.99]))
+                    if self.clock_mode == 'frame':
+                        print('missed frames: {} ({})'.format(self.missed_frames, self.missed_frame_policy))
+                    n_drawn = sum(stim.n_drawn for stim in self.stim_list)
+                    n_culled = sum(stim.n_culled for stim in self.stim_list)
+                    print('subscreen draws: {} drawn, {} culled'.format(n_drawn, n_culled))
+                    for stim in self.stim_list:
+                        if isinstance(stim, stimuli.MoviePlayback):
+                            print('movie frames uploaded late: {}'.format(stim.stream.late_uploads))
+                    if self.image_cache.hits + self.image_cache.misses > 0:
+                        print('image cache: {} hits, {} misses, {:.1f} MB resident'.format(self.image_cache.hits, self.image_cache.misses, self.image_cache.n_bytes/2**20))
+                    if self.server.coalesced_counts:
+                        print('coalesced messages: {}'.format(dict(self.server.coalesced_counts)))
+                    if self.pose_latencies:
+                        print('tracker-to-render latency (ms):')
+                        print((1e3*pd.Series(self.pose_latencies)).describe(percentiles=[0.01, 0.05, 0.5, 0.95, 0.99]))
                     print('*** end of statistics ***')
 
 
@@ -242,8 +508,12 @@ class StimDisplay(QtOpenGL.QGLWidget):
 
         self.stim_started = False
         self.stim_start_time = None
+        self.stim_scheduled_time = None
+        self.pending_start = None
 
         self.profile_frame_times = []
+        self.pose_latencies = []
+        self.reset_frame_clock()
 
         self.use_fly_trajectory = False
         self.fly_x_trajectory = None
@@ -266,6 +536,84 @@ class StimDisplay(QtOpenGL.QGLWidget):
         np.save(file_path, mov)
         print('Downsampled from {} to {} and saved to {}'.format(pre_size, mov.shape, file_path), flush=True)
 
+    def set_clock_mode(self, mode, refresh_rate=None, missed_frame_policy=None):
+        """
+        Select how stimulus time is computed.
+
+        :param mode: 'wall' (default) uses wall-clock time since start_stim. 'frame' advances stimulus time by exactly
+        one refresh period per presented frame, giving regular temporal sampling.
+        :param refresh_rate: Hz, display refresh rate used by the 'frame' clock and the sub-frame spacing. Defaults to
+        the refresh rate reported by the display showing this widget.
+        :param missed_frame_policy: 'compensate' (default) or 'skip'. See advance_frame_clock.
+        """
+        if missed_frame_policy is None:
+            missed_frame_policy = 'compensate'
+
+        assert mode in ['wall', 'frame'], 'Unknown clock mode: {}'.format(mode)
+        assert missed_frame_policy in ['compensate', 'skip'], 'Unknown missed frame policy: {}'.format(missed_frame_policy)
+
+        self.clock_mode = mode
+        self.refresh_rate = refresh_rate
+        self.frame_period = 1.0/self.get_refresh_rate()
+        self.missed_frame_policy = missed_frame_policy
+
+    def get_refresh_rate(self):
+        """
+        :return: Hz, refresh rate set with set_clock_mode, otherwise that of the display showing this widget (60 Hz if
+        the display does not report one)
+        """
+        if self.refresh_rate is not None:
+            return self.refresh_rate
+
+        window = self.windowHandle()
+        qt_screen = window.screen() if window is not None else QtGui.QGuiApplication.primaryScreen()
+        if (qt_screen is None) or (qt_screen.refreshRate() <= 0):
+            return 60.0
+
+        return qt_screen.refreshRate()
+
+    def set_subframe_mode(self, n_subframes=1, channel_order='RGB'):
+        """
+        Render the scene at several sub-frame times per video frame and pack them into the color channels or
+        bit-planes of the output frame, for projectors running a DLPC350 pattern sequence (see flystim.dlpc350).
+        Sub-frames are spaced by the display refresh period (see set_clock_mode), divided by n_subframes.
+
+        :param n_subframes: 1 (off), 3 (8-bit per channel), 6, 12 or 24 (1-bit planes)
+        :param channel_order: order in which the pattern sequence displays the color channels
+        """
+        self.subframe_program.configure(n_subframes=n_subframes, channel_order=channel_order)
+
+    def set_instanced_subscreens(self, enabled=True):
+        """
+        Draw each stimulus to all subscreens with a single instanced draw call, using per-instance perspective matrices
+        and clip planes, instead of one draw call per subscreen. Applies to screens with up to
+        flystim.base.MAX_SUBSCREENS subscreens.
+
+        :param enabled: Boolean
+        """
+        self.instanced_subscreens = enabled
+
+    def set_cubemap_mode(self, enabled=True, face_size=512):
+        """
+        Render the fly-centered scene once per frame into a cubemap, then produce each subscreen with a warp pass that
+        uses the subscreen pa/pb/pc geometry. Scene cost no longer depends on the number of subscreens.
+
+        :param enabled: Boolean
+        :param face_size: resolution (pixels) of each cube face
+        """
+        self.cubemap_program.configure(enabled=enabled, face_size=face_size)
+
+    def save_cubemap_movie(self, file_path):
+        """
+        Save the cube face atlas (blue channel) of each frame as a 3D np array, a rig-independent record of what the
+        fly saw. Must be used with append_stim_frames in start_stim and with cubemap mode enabled.
+
+        :param file_path: full file path of saved array
+        """
+        mov = np.stack(self.cubemap_frames, axis=2)
+        np.save(file_path, mov)
+        print('Saved cubemap movie with shape {} to {}'.format(mov.shape, file_path), flush=True)
+
     def start_corner_square(self):
         """
         Start toggling the corner square.
@@ -325,6 +673,23 @@ class StimDisplay(QtOpenGL.QGLWidget):
 
         self.idle_background = color
 
+    def set_pose_channel(self, path=None, enabled=True):
+        """
+        Read the fly pose at the start of every frame from a shared-memory channel written by a tracker process
+        (see flystim.pose), instead of waiting for set_global_fly_pos / set_global_theta_offset commands.
+        Tracker-to-render latency is printed with the profile in stop_stim.
+
+        :param path: file backing the pose channel, defaults to flystim.pose.default_pose_path()
+        :param enabled: Boolean. If False, close the channel.
+        """
+        if self.pose_channel is not None:
+            self.pose_channel.close()
+            self.pose_channel = None
+        self.pose_timestamp = None
+
+        if enabled:
+            self.pose_channel = PoseChannel(path=path)
+
     def set_global_fly_pos(self, x, y, z):
         self.global_fly_pos = np.array([x, y, z], dtype=float)
 
@@ -412,18 +777,26 @@ def main():
     server.register_function(stim_display.load_stim)
     server.register_function(stim_display.start_stim)
     server.register_function(stim_display.stop_stim)
+    server.register_function(stim_display.run_epoch)
     server.register_function(stim_display.save_rendered_movie)
+    server.register_function(stim_display.set_clock_mode)
+    server.register_function(stim_display.set_subframe_mode)
+    server.register_function(stim_display.set_instanced_subscreens)
+    server.register_function(stim_display.set_cubemap_mode)
+    server.register_function(stim_display.save_cubemap_movie)
     server.register_function(stim_display.start_corner_square)
     server.register_function(stim_display.stop_corner_square)
     server.register_function(stim_display.white_corner_square)
     server.register_function(stim_display.black_corner_square)
-    server.register_function(stim_display.set_corner_square)
+    server.register_function(stim_display.set_corner_square, state_setter=True)
     server.register_function(stim_display.show_corner_square)
     server.register_function(stim_display.hide_corner_square)
     server.register_function(stim_display.set_idle_background)
-    server.register_function(stim_display.set_global_fly_pos)
-    server.register_function(stim_display.set_global_theta_offset)
-    server.register_function(stim_display.set_global_phi_offset)
+    server.register_function(stim_display.set_pose_channel)
+    server.register_function(stim_display.set_global_fly_pos, state_setter=True)
+    server.register_function(stim_display.set_global_theta_offset, state_setter=True)
+    server.register_function(stim_display.set_global_phi_offset, state_setter=True)
+    server.register_function(stim_display.get_frame_stats)
 
     # display the stimulus
     if screen.fullscreen:
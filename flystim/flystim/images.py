@@ -0,0 +1,128 @@
+# Image assets for image-based stimuli. Source images are decoded once into preprocessed uint8 arrays, persisted as
+# sidecar .npy files, and the display keeps recently used images resident on the GPU as mipmapped textures.
+
+import os
+import tempfile
+from collections import OrderedDict
+
+import moderngl
+import numpy as np
+
+
+def decode_iml(image_path, shape=(1024, 1536), crop_width=1024):
+    """
+    Decodes a van Hateren .iml natural image (big-endian uint16) into a uint8 array scaled to its maximum.
+
+    :param image_path: path to the .iml file
+    :param shape: (height, width) of the image
+    :param crop_width: number of columns to keep, from the left
+    """
+    img = np.fromfile(image_path, dtype='>u2').reshape(shape)
+    img = np.uint8(255*(img / np.max(img)))
+    return np.ascontiguousarray(img[:, :crop_width])
+
+
+def sidecar_path(image_path):
+    """
+    :return: path of the preprocessed copy of an image, next to the source image
+    """
+    return os.path.splitext(image_path)[0] + '.u8.npy'
+
+
+def save_sidecar(path, img):
+    """
+    Writes the preprocessed image to a temporary file in the same directory, then renames it onto path, so that a
+    reader never sees a partially written sidecar.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.flystim_', suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_image(image_path):
+    """
+    Returns the preprocessed uint8 image, decoding the source image only if there is no up-to-date sidecar file.
+    The sidecar is written next to the source image, or to the temporary directory if that is not writable.
+    """
+    candidates = [sidecar_path(image_path),
+                  os.path.join(tempfile.gettempdir(), 'flystim_images', os.path.basename(sidecar_path(image_path)))]
+
+    for path in candidates:
+        if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(image_path):
+            try:
+                return np.load(path)
+            except (ValueError, OSError):
+                # truncated or corrupt sidecar: decode again and replace it
+                continue
+
+    img = decode_iml(image_path)
+
+    for path in candidates:
+        try:
+            save_sidecar(path, img)
+            break
+        except OSError:
+            continue
+
+    return img
+
+
+class ImageCache:
+    def __init__(self, ctx, max_bytes=256*2**20):
+        """
+        :param ctx: ModernGL context
+        :param max_bytes: GPU memory budget for cached textures, including mipmaps
+        """
+        self.ctx = ctx
+        self.max_bytes = max_bytes
+
+        # image path -> (texture, size in bytes), least recently used first
+        self.textures = OrderedDict()
+        self.n_bytes = 0
+
+        # profiling
+        self.hits = 0
+        self.misses = 0
+
+    def get_texture(self, image_path):
+        """
+        :return: mipmapped single-channel texture of the preprocessed image
+        """
+        key = os.path.realpath(image_path)
+
+        if key in self.textures:
+            self.hits += 1
+            self.textures.move_to_end(key)
+            return self.textures[key][0]
+
+        self.misses += 1
+        img = load_image(image_path)
+
+        texture = self.ctx.texture(size=(img.shape[1], img.shape[0]), components=1, data=img.tobytes())
+        texture.build_mipmaps()
+        texture.filter = (moderngl.LINEAR_MIPMAP_LINEAR, moderngl.LINEAR)
+
+        # a full mipmap chain adds one third to the base level
+        n_bytes = img.nbytes*4//3
+        self.textures[key] = (texture, n_bytes)
+        self.n_bytes += n_bytes
+
+        # evict least recently used textures, keeping the new one
+        while self.n_bytes > self.max_bytes and len(self.textures) > 1:
+            old_texture, old_bytes = self.textures.popitem(last=False)[1]
+            old_texture.release()
+            self.n_bytes -= old_bytes
+
+        return texture
+
+    def release(self):
+        for texture, _ in self.textures.values():
+            texture.release()
+        self.textures.clear()
+        self.n_bytes = 0
@@ -0,0 +1,105 @@
+# Streams frames of a (T, H, W) uint8 movie from disk into a ring of textures, without loading the movie into RAM.
+# Frames are copied into pixel buffer objects and uploaded to the ring one or more frames before they are shown, so the
+# texture transfer overlaps with rendering of the current frame.
+
+import os.path
+
+import moderngl
+import numpy as np
+
+
+def open_movie(file_path, dataset='movie'):
+    """
+    :param file_path: .npy file, memory-mapped, or .h5/.hdf5 file, read frame by frame
+    :param dataset: name of the (T, H, W) dataset in an HDF5 file
+    :return: (T, H, W) array-like of uint8 frames
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if extension == '.npy':
+        movie = np.load(file_path, mmap_mode='r')
+    elif extension in ['.h5', '.hdf5']:
+        import h5py
+        movie = h5py.File(file_path, 'r')[dataset]
+    else:
+        raise ValueError('Unknown movie file type: {}'.format(file_path))
+
+    assert len(movie.shape) == 3, 'Movie must have shape (T, H, W), got {}'.format(movie.shape)
+    assert movie.dtype == np.uint8, 'Movie must be uint8, got {}'.format(movie.dtype)
+
+    return movie
+
+
+class MovieStream:
+    def __init__(self, ctx, movie, frames_ahead=2, texture_interpolation='LINEAR'):
+        """
+        :param ctx: ModernGL context
+        :param movie: (T, H, W) array-like of uint8 frames, see open_movie
+        :param frames_ahead: number of frames uploaded ahead of the one being shown
+        :param texture_interpolation: 'LINEAR' or 'NEAREST'
+        """
+        self.ctx = ctx
+        self.movie = movie
+        self.n_frames, self.height, self.width = movie.shape
+        self.frames_ahead = frames_ahead
+
+        # one texture and one pixel buffer object per ring slot
+        ring_size = frames_ahead + 1
+        self.textures = [self.ctx.texture(size=(self.width, self.height), components=1) for _ in range(ring_size)]
+        self.pbos = [self.ctx.buffer(reserve=self.width*self.height) for _ in range(ring_size)]
+        self.slot_frames = [None for _ in range(ring_size)]
+
+        for texture in self.textures:
+            if texture_interpolation == 'NEAREST':
+                texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+            else:
+                texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
+
+        # profiling: frames that were not uploaded ahead of time
+        self.late_uploads = 0
+
+        # fill the ring with the first frames. The first frame cannot have been uploaded ahead, so it is not counted.
+        self.use(0)
+        self.late_uploads = 0
+
+    def upload(self, frame, keep):
+        """
+        Copies a frame into the ring, replacing a slot whose frame is not in keep.
+        """
+        slot = next(i for i, f in enumerate(self.slot_frames) if f not in keep)
+
+        # discard the previous contents so the driver does not wait for the last transfer out of this buffer
+        self.pbos[slot].orphan()
+        self.pbos[slot].write(np.ascontiguousarray(self.movie[frame]))
+        self.textures[slot].write(self.pbos[slot])
+        self.slot_frames[slot] = frame
+
+    def use(self, frame, loop=False, location=0):
+        """
+        Binds the texture holding the given frame, and uploads the following frames that are not in the ring yet.
+
+        :param frame: index of the movie frame to show
+        :param loop: if True, frame indices wrap around the end of the movie, otherwise the last frame is held
+        :param location: texture unit
+        """
+        if loop:
+            wanted = [(frame + ahead) % self.n_frames for ahead in range(self.frames_ahead + 1)]
+        else:
+            frame = int(np.clip(frame, 0, self.n_frames - 1))
+            wanted = [f for f in range(frame, frame + self.frames_ahead + 1) if f < self.n_frames]
+
+        if wanted[0] not in self.slot_frames:
+            self.late_uploads += 1
+            self.upload(wanted[0], keep=wanted)
+
+        self.textures[self.slot_frames.index(wanted[0])].use(location=location)
+
+        for f in wanted[1:]:
+            if f not in self.slot_frames:
+                self.upload(f, keep=wanted)
+
+    def release(self):
+        for texture in self.textures:
+            texture.release()
+        for pbo in self.pbos:
+            pbo.release()
@@ -0,0 +1,158 @@
+"""
+Shared-memory fly pose channel for closed-loop VR.
+
+A tracker process writes the fly pose (x, y, z, heading, timestamp) into a small memory-mapped file, and every display
+process reads the newest pose at the start of each frame. This bypasses the socket relay through the stim server.
+Consistency between the single writer and any number of readers is kept with a seqlock: the writer makes the
+sequence number odd while it writes and even when the record is complete, and readers retry if the sequence number
+was odd or changed while they were reading. A reader that still finds no consistent record returns the last complete
+one it read.
+
+A simulated tracker, useful for testing, can be run with launch_simulated_tracker.
+"""
+
+import sys, os.path, json, atexit, mmap, struct, subprocess, tempfile
+
+from time import sleep, time
+from math import sin, cos, pi
+
+from flyrpc.util import get_kwargs
+
+# sequence number, then x, y, z (meters), heading (degrees), timestamp (seconds since epoch)
+POSE_FORMAT = '<Q5d'
+POSE_SIZE = struct.calcsize(POSE_FORMAT)
+
+
+def default_pose_path():
+    return os.path.join(tempfile.gettempdir(), 'flystim_pose')
+
+
+class PoseChannel:
+    def __init__(self, path=None, max_read_attempts=1000):
+        """
+        :param path: file backing the shared memory. Created (zero-filled) if it does not exist.
+        :param max_read_attempts: number of times a reader retries while the record is being written
+        """
+        if path is None:
+            path = default_pose_path()
+
+        # make sure the backing file exists and has the right size
+        if not os.path.isfile(path) or os.path.getsize(path) < POSE_SIZE:
+            with open(path, 'wb') as f:
+                f.write(bytes(POSE_SIZE))
+
+        self.path = path
+        self.max_read_attempts = max_read_attempts
+
+        # reader-side: newest complete record read so far
+        self.last_record = None
+
+        self.file = open(path, 'r+b')
+        self.buf = mmap.mmap(self.file.fileno(), POSE_SIZE)
+
+        # writer-side sequence number
+        self.seq = struct.unpack_from('<Q', self.buf, 0)[0]
+        if self.seq % 2 == 1:
+            self.seq += 1
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def write(self, x, y, z, heading, timestamp=None):
+        """
+        :param x, y, z: fly position, meters
+        :param heading: fly heading along azimuth, degrees (as in set_global_theta_offset)
+        :param timestamp: time at which the pose was measured, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time()
+
+        # mark the record as being written
+        struct.pack_into('<Q', self.buf, 0, self.seq + 1)
+        struct.pack_into('<5d', self.buf, 8, x, y, z, heading, timestamp)
+
+        # mark the record as complete
+        self.seq += 2
+        struct.pack_into('<Q', self.buf, 0, self.seq)
+
+    def read(self):
+        """
+        :return: (seq, x, y, z, heading, timestamp) of the newest complete record. If no consistent record could be
+        read within max_read_attempts, the last complete record read before, or None if there is none or nothing has
+        been written yet.
+        """
+        for _ in range(self.max_read_attempts):
+            seq_start = struct.unpack_from('<Q', self.buf, 0)[0]
+            if seq_start % 2 == 1:
+                continue
+
+            record = struct.unpack_from(POSE_FORMAT, self.buf, 0)
+
+            seq_end = struct.unpack_from('<Q', self.buf, 0)[0]
+            if seq_start == seq_end == record[0]:
+                if seq_start > 0:
+                    self.last_record = record
+                return self.last_record
+
+        return self.last_record
+
+
+def launch_simulated_tracker(path=None, **kwargs):
+    """
+    Launches a subprocess that writes a simulated fly trajectory into the pose channel.
+
+    :param path: file backing the pose channel
+    :param kwargs: see run_simulated_tracker
+    :return: Popen object of the tracker process
+    """
+    if path is None:
+        path = default_pose_path()
+    kwargs['path'] = path
+
+    # create the backing file before the tracker and the displays try to open it
+    PoseChannel(path=path).close()
+
+    proc = subprocess.Popen(args=[os.path.realpath(sys.executable), os.path.realpath(__file__), json.dumps(kwargs)])
+    atexit.register(proc.terminate)
+
+    return proc
+
+
+def run_simulated_tracker(path=None, rate=None, duration=None, radius=None, angular_velocity=None):
+    """
+    Writes poses of a fly walking on a circle around the origin, facing along its direction of travel.
+
+    :param path: file backing the pose channel
+    :param rate: Hz, tracker update rate
+    :param duration: seconds to run for, or None to run forever
+    :param radius: meters, radius of the circular path
+    :param angular_velocity: degrees/sec around the circle
+    """
+    if rate is None:
+        rate = 500
+    if radius is None:
+        radius = 0.05
+    if angular_velocity is None:
+        angular_velocity = 90
+
+    channel = PoseChannel(path=path)
+
+    t0 = time()
+    while (duration is None) or (time() - t0 < duration):
+        angle = angular_velocity*(time() - t0)
+        channel.write(x=radius*cos(angle*pi/180), y=radius*sin(angle*pi/180), z=0, heading=angle)
+        sleep(1.0/rate)
+
+    channel.close()
+
+
+def main():
+    kwargs = get_kwargs()
+
+    run_simulated_tracker(path=kwargs['path'], rate=kwargs['rate'], duration=kwargs['duration'],
+                          radius=kwargs['radius'], angular_velocity=kwargs['angular_velocity'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import numpy as np
 from numpy import matlib
 from math import radians
-from .util import rotx, roty, rotz, translate, scale, rotate
+from .util import rotx, roty, rotz, translate, scale, rotate, tessellation_steps
 
 class GlVertices:
     def __init__(self, vertices=None, colors=None, tex_coords=None):
@@ -9,7 +9,22 @@ class GlVertices:
         self.colors = colors
         self.tex_coords = tex_coords
 
+        # (first vertex, number of vertices, center, radius) of each object combined with add, for frustum culling
+        self.parts = []
+
     def add(self, obj):
+        # record the bounding sphere of each added object, so that parts outside the view can be skipped
+        sphere = obj.bounding_sphere
+        if sphere is not None:
+            if self.vertices is None:
+                first = 0
+            else:
+                first = self.vertices.shape[1]
+                if not self.parts:
+                    # vertices that were not added as parts form the first part
+                    self.parts = [(0, first) + self.bounding_sphere]
+            self.parts = self.parts + [(first, obj.vertices.shape[1]) + sphere]
+
         # add vertices
         if self.vertices is None:
             self.vertices = obj.vertices
@@ -61,6 +76,54 @@ class GlVertices:
         return GlVertices(vertices=self.vertices, colors=self.colors, tex_coords=new_tex_coords)
 
 
+    @property
+    def bounding_sphere(self):
+        """
+        :return: (center, radius) of a sphere enclosing all vertices, or None if there are no vertices
+        """
+        if self.vertices is None or self.vertices.shape[1] == 0:
+            return None
+
+        lo = np.min(self.vertices, axis=1)
+        hi = np.max(self.vertices, axis=1)
+        center = (lo + hi)/2
+        radius = np.max(np.linalg.norm(self.vertices - center[:, np.newaxis], axis=0))
+        return center, radius
+
+    def visible_parts(self, planes):
+        """
+        :param planes: list of frustum planes (see util.frustum_planes), one per subscreen
+        :return: n_parts x n_subscreens boolean array, False where a part lies entirely outside the frustum of a subscreen.
+            The parts are the objects combined with add, or the whole object if it was not built with add.
+        """
+        if self.parts:
+            centers = np.array([part[2] for part in self.parts])
+            radii = np.array([part[3] for part in self.parts])
+        else:
+            sphere = self.bounding_sphere
+            if sphere is None:
+                return np.zeros((0, len(planes)), dtype=bool)
+            centers = np.array([sphere[0]])
+            radii = np.array([sphere[1]])
+
+        planes = np.array(planes)
+        distances = np.einsum('spk,nk->nsp', planes[:, :, :3], centers) + planes[:, :, 3]
+        return np.all(distances >= -radii[:, np.newaxis, np.newaxis], axis=2)
+
+    def select_parts(self, keep):
+        """
+        :param keep: boolean array, one entry per part
+        :return: GlVertices containing only the kept parts
+        """
+        firsts = np.array([part[0] for part in self.parts], dtype=int)[keep]
+        counts = np.array([part[1] for part in self.parts], dtype=int)[keep]
+
+        # vertex indices first, first+1, ..., first+count-1 of each kept part
+        columns = np.arange(np.sum(counts)) + np.repeat(firsts - np.cumsum(counts) + counts, counts)
+        return GlVertices(vertices=self.vertices[:, columns],
+                          colors=self.colors[:, columns],
+                          tex_coords=None if self.tex_coords is None else self.tex_coords[:, columns])
+
     @property
     def data(self):
         if self.tex_coords is not None:
@@ -138,8 +201,9 @@ class GlSphericalRect(GlVertices):
                  height=20,  # degrees, phi
                  sphere_radius=1,  # meters
                  color=[1, 1, 1, 1],  # [r,g,b,a] or single value for monochrome, alpha = 1
-                 n_steps_x=6,
-                 n_steps_y=6):
+                 n_steps_x=None,  # None: chosen from angular size and max_error
+                 n_steps_y=None,
+                 max_error=0.1):  # degrees, max. deviation of the tessellated patch outline, seen from the sphere center
         super().__init__()
         if type(color) is not list:
             if type(color) is tuple:
@@ -147,6 +211,12 @@ class GlSphericalRect(GlVertices):
             else:
                 color = [color, color, color, 1]
 
+        # top and bottom edges lie on circles of constant elevation, the sides on great circles
+        if n_steps_x is None:
+            n_steps_x = tessellation_steps(width, 90 - min(height/2, 90), max_error=max_error, min_steps=2)
+        if n_steps_y is None:
+            n_steps_y = tessellation_steps(height, 90, max_error=max_error, min_steps=2)
+
         d_theta = (1/n_steps_x) * radians(width)
         d_phi = (1/n_steps_y) * radians(height)
         for rr in range(n_steps_y):
@@ -230,7 +300,8 @@ class GlSphericalCirc(GlVertices):
                  sphere_radius=1,  # meters
                  color=[1, 1, 1, 1],  # [r,g,b,a] or single value for monochrome, alpha = 1
                  sphere_location=(0, 0, 0),  # (x,y,z) meters. (0,0,0) is center of sphere
-                 n_steps=36):
+                 n_steps=None,  # None: chosen from angular size and max_error
+                 max_error=0.1):  # degrees, max. deviation of the tessellated outline, seen from the sphere center
         super().__init__()
         if type(color) is not list:
             if type(color) is tuple:
@@ -238,6 +309,9 @@ class GlSphericalCirc(GlVertices):
             else:
                 color = [color, color, color, 1]
 
+        if n_steps is None:
+            n_steps = tessellation_steps(360, circle_radius, max_error=max_error, min_steps=8)
+
         v_center = self.sphericalToCartesian((sphere_radius, np.pi/2, np.pi/2))
 
         angles = np.linspace(0, 2*np.pi, n_steps+1)
@@ -268,7 +342,8 @@ class GlSphericalRing(GlVertices):
                  sphere_radius=1,  # meters
                  color=[1, 1, 1, 1],  # [r,g,b,a] or single value for monochrome, alpha = 1
                  sphere_location=(0, 0, 0),  # (x,y,z) meters. (0,0,0) is center of sphere
-                 n_steps=36):
+                 n_steps=None,  # None: chosen from angular size and max_error
+                 max_error=0.1):  # degrees, max. deviation of the tessellated outline, seen from the sphere center
         super().__init__()
         if type(color) is not list:
             if type(color) is tuple:
@@ -276,6 +351,9 @@ class GlSphericalRing(GlVertices):
             else:
                 color = [color, color, color, 1]
 
+        if n_steps is None:
+            n_steps = tessellation_steps(360, max(inner_radius, outer_radius), max_error=max_error, min_steps=8)
+
         v_center = self.sphericalToCartesian((sphere_radius, np.pi/2, np.pi/2))
 
         angles = np.linspace(0, 2*np.pi, n_steps+1)
@@ -342,10 +420,11 @@ class GlCylinder(GlVertices):
                  cylinder_location=(0, 0, 0),  # (x,y,z) meters. (0,0,0) is center of cylinder (r = 0 and z = height/2)
                  cylinder_angular_extent=360,  # degrees
                  color=[1, 1, 1, 1],  # [r,g,b,a] or single value for monochrome, alpha = 1
-                 n_faces=32,
+                 n_faces=None,  # None: chosen from angular size and max_error, for a viewer on the cylinder axis
                  alpha_by_face=None,
                  texture=False,
-                 texture_shift=(0, 0)):  # (u,v) coordinates to translate texture on shape. + is right, up.
+                 texture_shift=(0, 0),  # (u,v) coordinates to translate texture on shape. + is right, up.
+                 max_error=0.1):  # degrees, max. deviation of the tessellated rims, seen from the cylinder center
 
         super().__init__()
         if type(color) is not list:
@@ -354,6 +433,14 @@ class GlCylinder(GlVertices):
             else:
                 color = [color, color, color, 1]
 
+        if n_faces is None:
+            if alpha_by_face is not None:
+                n_faces = len(alpha_by_face)
+            else:
+                # the rims lie on circles of constant elevation around the viewer
+                rim_elevation = np.degrees(np.arctan2(cylinder_height/2, cylinder_radius))
+                n_faces = tessellation_steps(cylinder_angular_extent, 90 - rim_elevation, max_error=max_error, min_steps=8, max_steps=128)
+
         if alpha_by_face is None:
             alpha_by_face = color[3]*np.ones(n_faces)
 
@@ -1,15 +1,19 @@
 import platform
 
+from collections import defaultdict
+from statistics import mean, pstdev
+from threading import Lock
 from time import time, sleep
 
 import flystim.framework
-import flystim.audio
+from flystim.devices import Device
 from flystim.screen import Screen
 from flystim.util import listify
 
+from flyrpc.fanout import FanOut
 from flyrpc.transceiver import MySocketServer
 from flyrpc.launch import launch_server
-from flyrpc.util import get_kwargs
+from flyrpc.util import get_kwargs, start_daemon_thread
 
 
 def launch_screen(screen):
@@ -28,16 +32,51 @@ def launch_screen(screen):
     return launch_server(flystim.framework, screen=screen.serialize(), new_env_vars=new_env_vars)
 
 
+def relay_to_client(server, device, on_report=None):
+    """
+    Forwards messages sent upstream by a display or device process (e.g. epoch timing reports) to the client
+    connected to the server.
+    :param server: StimServer or MultiStimServer
+    :param device: client object of the display or device process
+    :param on_report: optional function called with each request list, returning the request list to forward or None
+    to forward nothing
+    """
+    def relay():
+        while True:
+            request_list = device.queue.get()
+            if on_report is not None:
+                request_list = on_report(request_list)
+            if request_list is not None:
+                server.write_request_list(request_list)
+
+    start_daemon_thread(relay)
+
+
 
 class StimServer(MySocketServer):
-    time_stamp_commands = ['start_stim', 'pause_stim', 'update_stim']
+    time_stamp_commands = ['start_stim', 'pause_stim', 'update_stim', 'run_epoch']
+
+    # commands executed by the stim server itself rather than forwarded
+    server_commands = ['get_screen_names']
 
     def __init__(self, screens, host=None, port=None, auto_stop=None):
         # call super constructor
         super().__init__(host=host, port=port, threaded=False, auto_stop=auto_stop)
 
         # launch screens
+        self.screen_names = [screen.name for screen in screens]
         self.clients = [launch_screen(screen=screen) for screen in screens]
+        for client in self.clients:
+            relay_to_client(self, client)
+        self.fanout = FanOut(self.clients)
+
+        self.register_function(self.get_screen_names)
+
+    def get_screen_names(self):
+        """
+        :return: names of the screens, e.g. to know which screens report epoch timing
+        """
+        return self.screen_names
 
     def handle_request_list(self, request_list):
         # make sure that request list is actually a list...
@@ -46,28 +85,205 @@ class StimServer(MySocketServer):
 
         # pre-process the request list as necessary
         # split the request into two part, one for screen clients, one for other modules
+        screen_requests = []
         for request in request_list:
+            if isinstance(request, dict) and (request.get('name') in self.server_commands):
+                if 'id' in request:
+                    self.handle_call(request)
+                else:
+                    self.functions[request['name']](*request.get('args', []), **request.get('kwargs', {}))
+                continue
+
+            screen_requests.append(request)
             if isinstance(request, dict) and ('name' in request) and (request['name'] in self.time_stamp_commands):
                 if 'kwargs' not in request:
                     request['kwargs'] = {}
                 request['kwargs']['t'] = time()
 
         # send modified request list to clients
-        for client in self.clients:
-            client.write_request_list(request_list)
+        if screen_requests:
+            self.fanout.write_request_list(screen_requests)
 
 
 class MultiStimServer(MySocketServer):
-    time_stamp_commands = ['start_stim', 'pause_stim', 'update_stim']
-
-    def __init__(self, screens, host=None, port=None, auto_stop=None):
+    time_stamp_commands = ['start_stim', 'pause_stim', 'update_stim', 'run_epoch']
+
+    # commands executed by the stim server itself rather than forwarded
+    server_commands = ['set_start_lead', 'get_onset_stats', 'launch_device', 'get_send_stats', 'get_screen_names']
+
+    def __init__(self, screens, host=None, port=None, auto_stop=None, audio_device=None, start_lead=None, devices=None):
+        """
+        :param audio_device: output device of the speaker server, see flystim.audio.AudioPlay. Only used if devices is
+        None.
+        :param start_lead: seconds, see set_start_lead
+        :param devices: dict of device name -> dict with the device type (see flystim.devices) under 'type' and the
+        arguments of the device process. Requests with a device kwarg are routed to the device of that name. Defaults
+        to a single speaker.
+        """
         # call super constructor
         super().__init__(host=host, port=port, threaded=False, auto_stop=auto_stop)
 
+        # scheduled starts: per-device offsets (seconds) of the achieved onset from the target time
+        self.start_lead = start_lead
+        self.onset_offsets = defaultdict(list)
+
+        # responses of the screens to calls made with call_async, combined into one response per call:
+        # request id -> {screen index: response}
+        self.screen_responses = {}
+        self.screen_responses_lock = Lock()
+
         # launch screens
+        self.screen_names = [screen.name for screen in screens]
         self.clients = [launch_screen(screen=screen) for screen in screens]
-        self.device = launch_server(flystim.audio)
+        for k, client in enumerate(self.clients):
+            relay_to_client(self, client, on_report=lambda request_list, k=k: self.on_screen_report(request_list, k))
+        self.fanout = FanOut(self.clients)
+
+        # devices are launched on first use
+        if devices is None:
+            devices = {'speaker': {'type': 'speaker', 'device': audio_device}}
+        self.devices = {}
+        for name, config in devices.items():
+            launch_kwargs = {key: value for key, value in config.items() if key != 'type'}
+            self.devices[name] = Device(name=name, device_type=config['type'], on_connect=self.relay_device,
+                                        on_reject=self.reject, **launch_kwargs)
+
+        self.register_function(self.set_start_lead)
+        self.register_function(self.get_onset_stats)
+        self.register_function(self.launch_device)
+        self.register_function(self.get_send_stats)
+        self.register_function(self.get_screen_names)
+
+    def get_screen_names(self):
+        """
+        :return: names of the screens, e.g. to know which screens report epoch timing
+        """
+        return self.screen_names
+
+    def relay_device(self, device):
+        def on_report(request_list):
+            self.record_onsets(request_list, device_name=device.name)
+            return request_list
+
+        relay_to_client(self, device.client, on_report=on_report)
+
+    def on_screen_report(self, request_list, screen_index):
+        """
+        Forwards messages from a screen to the client, except responses to calls, which are held until all screens have
+        responded and then forwarded as one response. Its result is the list of results of the screens, in the order
+        of the screens, or the first error.
+        """
+        self.record_onsets(request_list)
+
+        if not (isinstance(request_list, list) and (len(request_list) == 1) and isinstance(request_list[0], dict)):
+            return request_list
+        if request_list[0].get('name') != '_response':
+            return request_list
+
+        response = request_list[0].get('kwargs', {})
+        with self.screen_responses_lock:
+            if response.get('id') not in self.screen_responses:
+                return request_list
+            responses = self.screen_responses[response['id']]
+            responses[screen_index] = response
+            if len(responses) < len(self.clients):
+                return None
+            del self.screen_responses[response['id']]
+
+        return [{'name': '_response', 'kwargs': self.combine_responses(response['id'], responses)}]
+
+    def combine_responses(self, call_id, responses):
+        """
+        :param responses: dict of screen index -> response
+        """
+        for k in sorted(responses):
+            if 'error' in responses[k]:
+                return responses[k]
+
+        return {'id': call_id, 'result': [responses[k].get('result') for k in sorted(responses)]}
+
+    def reject(self, request, message):
+        # requests made with call_async get the reason as an error response
+        print(message)
+        if 'id' in request:
+            self.write_request_list([{'name': '_response', 'kwargs': {
+                'id': request['id'], 'error': message, 'error_type': 'ValueError'}}])
+
+    def launch_device(self, name=None):
+        """
+        Launches a device process ahead of its first command, or all of them if name is None.
+        """
+        for device_name, device in self.devices.items():
+            if (name is None) or (device_name == name):
+                device.launch()
+
+    def set_start_lead(self, start_lead=None):
+        """
+        :param start_lead: seconds. If not None, all start_stim commands in one request list (screens and devices)
+        get the common target start_time = now + start_lead, unless they specify their own. Each device starts at
+        that time and acknowledges its achieved onset. None starts each device as soon as it gets the command.
+        """
+        self.start_lead = start_lead
+
+    def record_onsets(self, request_list, device_name=None):
+        if not isinstance(request_list, list):
+            return
 
+        for request in request_list:
+            if not isinstance(request, dict):
+                continue
+            kwargs = request.get('kwargs', {})
+            if kwargs.get('scheduled_time') is None:
+                continue
+
+            if request.get('name') == 'report_stim_onset':
+                self.onset_offsets[kwargs['screen_name']].append(kwargs['onset_time'] - kwargs['scheduled_time'])
+            elif request.get('name') == 'report_audio_timing':
+                self.onset_offsets[device_name].append(kwargs['output_time'] - kwargs['scheduled_time'])
+
+    def get_onset_stats(self, reset=False):
+        """
+        Sends per-device statistics of onset offsets from the scheduled start times (seconds) to the client, as a
+        report_onset_stats message, and prints them.
+        :param reset: if True, clear the collected offsets afterwards
+        :return: the statistics, so that they are also the result of call or call_async
+        """
+        stats = {}
+        for device_name, offsets in self.onset_offsets.items():
+            if offsets:
+                stats[device_name] = {'n': len(offsets),
+                                      'mean': mean(offsets),
+                                      'std': pstdev(offsets),
+                                      'min': min(offsets),
+                                      'max': max(offsets)}
+                print('{} onset offset: mean {:.2f} ms, std {:.2f} ms, range [{:.2f}, {:.2f}] ms (n={})'.format(
+                    device_name, 1e3*stats[device_name]['mean'], 1e3*stats[device_name]['std'],
+                    1e3*stats[device_name]['min'], 1e3*stats[device_name]['max'], len(offsets)))
+
+        if reset:
+            self.onset_offsets.clear()
+
+        self.write_request_list([{'name': 'report_onset_stats', 'kwargs': {'stats': stats}}])
+
+        return stats
+
+    def get_send_stats(self):
+        """
+        Sends statistics of the writes of recent request lists to the screens (see flyrpc.fanout.FanOut.send_stats)
+        to the client, as a report_send_stats message, and prints them.
+        :return: the statistics, so that they are also the result of call or call_async
+        """
+        stats = self.fanout.send_stats()
+        if stats['n'] > 0:
+            print('screen send skew: mean {:.3f} ms, max {:.3f} ms; send latency: mean {:.3f} ms, max {:.3f} ms (n={})'.format(
+                1e3*stats['mean_skew'], 1e3*stats['max_skew'], 1e3*stats['mean_latency'], 1e3*stats['max_latency'],
+                stats['n']))
+        if stats['failed_writes'] > 0:
+            print('failed writes to screens: {}'.format(stats['failed_writes']))
+
+        self.write_request_list([{'name': 'report_send_stats', 'kwargs': {'stats': stats}}])
+
+        return stats
 
     def handle_request_list(self, request_list):
         # make sure that request list is actually a list...
@@ -76,29 +292,61 @@ class MultiStimServer(MySocketServer):
 
         # pre-process the request list as necessary
         screen_requests = []
-        device_requests = []
+        device_requests = defaultdict(list)
+
+        # common target time of the start commands in this request list
+        t = time()
+        start_time = None if self.start_lead is None else t + self.start_lead
 
         for request in request_list:
-            if isinstance(request, dict) and ('kwargs' in request) and ('device' in request['kwargs']) and (request['kwargs']['device'] == 'speaker'):
-                request['kwargs'].pop('device')
-                device_requests.append(request)
-            else:
-                if isinstance(request, dict) and ('name' in request) and (request['name'] in self.time_stamp_commands):
-                    if 'kwargs' not in request:
-                        request['kwargs'] = {}
-                    request['kwargs']['t'] = time()
+            if isinstance(request, dict) and (request.get('name') in self.server_commands):
+                if 'id' in request:
+                    self.handle_call(request)
+                else:
+                    self.functions[request['name']](*request.get('args', []), **request.get('kwargs', {}))
+                continue
+
+            # screens and devices receive the same time stamp, so their start times share one clock
+            if isinstance(request, dict) and ('name' in request) and (request['name'] in self.time_stamp_commands):
+                if 'kwargs' not in request:
+                    request['kwargs'] = {}
+                request['kwargs']['t'] = t
+
+                if (request['name'] == 'start_stim') and (start_time is not None):
+                    request['kwargs'].setdefault('start_time', start_time)
+
+            # route by the device kwarg; requests without one go to the screens
+            device_name = None
+            if isinstance(request, dict) and isinstance(request.get('kwargs'), dict):
+                device_name = request['kwargs'].pop('device', None)
+
+            if device_name is None:
                 screen_requests.append(request)
+            elif device_name not in self.devices:
+                self.reject(request, 'Unknown device: {}'.format(device_name))
+            elif not self.devices[device_name].supports(request.get('name')):
+                self.reject(request, 'Device {} does not support {}'.format(device_name, request.get('name')))
+            else:
+                device_requests[device_name].append(request)
+
+        # calls to the screens get one combined response, see on_screen_report
+        for request in screen_requests:
+            if isinstance(request, dict) and ('id' in request):
+                if self.clients:
+                    with self.screen_responses_lock:
+                        self.screen_responses[request['id']] = {}
+                else:
+                    self.write_request_list([{'name': '_response', 'kwargs': {'id': request['id'], 'result': []}}])
 
         # send modified request list to clients
         if screen_requests:
-            for client in self.clients:
-                client.write_request_list(screen_requests)
+            self.fanout.write_request_list(screen_requests)
 
-        if device_requests:
-            self.device.write_request_list(device_requests)
+        for device_name, requests in device_requests.items():
+            self.devices[device_name].write_request_list(requests)
 
 
-def launch_stim_server(screen_or_screens=None):
+def launch_stim_server(screen_or_screens=None, audio_device=None, start_lead=None, devices=None):
     # set defaults
     if screen_or_screens is None:
         screen_or_screens = []
@@ -110,15 +358,17 @@ def launch_stim_server(screen_or_screens=None):
     screens = [screen.serialize() for screen in screens]
 
     # run the server
-    return launch_server(__file__, screens=screens)
+    return launch_server(__file__, screens=screens, audio_device=audio_device, start_lead=start_lead, devices=devices)
 
-def run_stim_server(host=None, port=None, auto_stop=None, screens=None):
+def run_stim_server(host=None, port=None, auto_stop=None, screens=None, audio_device=None, start_lead=None,
+                    devices=None):
     # set defaults
     if screens is None:
         screens = []
 
     # instantiate the server
-    server = MultiStimServer(screens=screens, host=host, port=port, auto_stop=auto_stop)
+    server = MultiStimServer(screens=screens, host=host, port=port, auto_stop=auto_stop, audio_device=audio_device,
+                             start_lead=start_lead, devices=devices)
 
     # launch the server
     server.loop()
@@ -134,7 +384,8 @@ def main():
     screens = [Screen.deserialize(screen) for screen in screens]
 
     # run the server
-    run_stim_server(host=kwargs['host'], port=kwargs['port'], auto_stop=kwargs['auto_stop'], screens=screens)
+    run_stim_server(host=kwargs['host'], port=kwargs['port'], auto_stop=kwargs['auto_stop'], screens=screens,
+                    audio_device=kwargs['audio_device'], start_lead=kwargs['start_lead'], devices=kwargs['devices'])
 
 if __name__ == '__main__':
     main()
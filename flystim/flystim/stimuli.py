@@ -7,10 +7,11 @@ Each class is is derived from flystim.base.BaseProgram, which handles the GL con
 
 import numpy as np
 import os
-import array
-from flystim.base import BaseProgram
+from flystim.base import BaseProgram, PROJECTION_SHADER
+from flystim.util import rotate, hash_uint32
 from flystim.trajectory import make_as_trajectory, return_for_time_t
 import flystim.distribution as distribution
+from flystim.movie import open_movie, MovieStream
 from flystim import GlSphericalRect, GlCylinder, GlCube, GlQuad, GlSphericalCirc, GlVertices, GlSphericalPoints, \
                     GlSphericalTexturedRect, GlSphericalRing
 import copy
@@ -96,8 +97,7 @@ class MovingSpot(BaseProgram):
         # TODO: is there a way to make this object once in configure then update with radius in eval_at?
         self.stim_object = GlSphericalCirc(circle_radius=radius,
                                            sphere_radius=self.sphere_radius,
-                                           color=color,
-                                           n_steps=36).rotate(np.radians(theta) + fly_heading[0], np.radians(phi) + fly_heading[1], 0).translate(fly_position.copy())
+                                           color=color).rotate(np.radians(theta) + fly_heading[0], np.radians(phi) + fly_heading[1], 0).translate(fly_position.copy())
 
 
 class MovingRing(BaseProgram):
@@ -135,8 +135,7 @@ class MovingRing(BaseProgram):
         self.stim_object = GlSphericalRing(inner_radius=inner_radius,
                                            outer_radius=outer_radius,
                                            sphere_radius=self.sphere_radius,
-                                           color=color,
-                                           n_steps=36).rotate(np.radians(theta) + fly_heading[0], np.radians(phi) + fly_heading[1], 0).translate(fly_position.copy())
+                                           color=color).rotate(np.radians(theta) + fly_heading[0], np.radians(phi) + fly_heading[1], 0).translate(fly_position.copy())
 
 
 class MovingPatch(BaseProgram):
@@ -721,21 +720,15 @@ class HorizonCylinder(TexturedCylinder):
             load_image = False
 
         if load_image:
-            with open(image_path, 'rb') as handle:
-                s = handle.read()
-            arr = array.array('H', s)
-            arr.byteswap()
-            img = np.array(arr, dtype='uint16').reshape(1024, 1536)
-            img = np.uint8(255*(img / np.max(img)))
-            img = img[:, :1024]
+            # decoded once into a sidecar file, and kept on the GPU by the display's image cache
+            self.add_image_texture_gl(image_path)
 
         else:
             # use a dummy texture
             np.random.seed(0)
             face_colors = np.random.uniform(size=(128, 128))
             img = (255*face_colors).astype(np.uint8)
-
-        self.add_texture_gl(img, texture_interpolation='LINEAR')
+            self.add_texture_gl(img, texture_interpolation='LINEAR')
 
         self.stim_template = GlCylinder(cylinder_height=self.cylinder_height,
                                         cylinder_radius=self.cylinder_radius,
@@ -748,9 +741,87 @@ class HorizonCylinder(TexturedCylinder):
         self.stim_object = copy.copy(self.stim_template).translate(cyl_position)
 
 
+class MoviePlayback(BaseProgram):
+    def __init__(self, screen):
+        super().__init__(screen=screen)
+        self.use_texture = True
+        self.stream = None
+
+    def configure(self, file_path, frame_rate=30, loop=False, dataset='movie', surface='cylinder', frames_ahead=2,
+                  texture_interpolation='LINEAR', color=[1, 1, 1, 1], cylinder_radius=1, cylinder_height=10,
+                  cylinder_angular_extent=360, width=60, height=60, sphere_radius=1,
+                  corners=[[-1, 1, -1], [1, 1, -1], [1, 1, 1], [-1, 1, 1]], theta=0, phi=0, angle=0):
+        """
+        Plays a precomputed (T, H, W) uint8 movie at a fixed frame rate, independent of the display rate.
+
+        The movie file is memory-mapped (.npy) or read frame by frame (.h5/.hdf5), and frames are streamed into a ring
+        of textures frames_ahead frames before they are shown, so the movie does not have to fit in RAM.
+
+        :param file_path: path to the movie file
+        :param frame_rate: Hz, movie frames per second
+        :param loop: if True, the movie restarts after its last frame, otherwise the last frame is held
+        :param dataset: name of the movie dataset in an HDF5 file
+        :param surface: 'cylinder' (around the fly), 'patch' (rectangle on a sphere around the fly) or 'quad'
+        :param frames_ahead: number of frames uploaded ahead of the one being shown
+        :param texture_interpolation: 'LINEAR' or 'NEAREST'
+        :param color: [r,g,b,a] color applied to the movie, which is monochrome
+        :param cylinder_radius, cylinder_height: meters, for surface='cylinder'
+        :param cylinder_angular_extent: degrees, for surface='cylinder'
+        :param width, height: degrees, for surface='patch'
+        :param sphere_radius: meters, for surface='patch'
+        :param corners: (x, y, z) corners of the quad (meters), counterclockwise from bottom left, for surface='quad'
+        :param theta, phi, angle: degrees, rotation of the surface (yaw, pitch, roll). Can be trajectory dicts.
+        """
+        if type(color) is not list:
+            if type(color) is tuple:
+                color = list(color)
+            else:
+                color = [color, color, color, 1]
+
+        self.frame_rate = frame_rate
+        self.loop = loop
+        self.color = color
+        self.theta = make_as_trajectory(theta)
+        self.phi = make_as_trajectory(phi)
+        self.angle = make_as_trajectory(angle)
+
+        if self.stream is not None:
+            self.stream.release()
+        self.stream = MovieStream(self.ctx, open_movie(file_path, dataset=dataset), frames_ahead=frames_ahead,
+                                  texture_interpolation=texture_interpolation)
+
+        if surface == 'cylinder':
+            self.stim_template = GlCylinder(cylinder_height=cylinder_height,
+                                            cylinder_radius=cylinder_radius,
+                                            cylinder_angular_extent=cylinder_angular_extent,
+                                            color=self.color,
+                                            texture=True)
+        elif surface == 'patch':
+            self.stim_template = GlSphericalTexturedRect(width=width,
+                                                         height=height,
+                                                         sphere_radius=sphere_radius,
+                                                         color=self.color, n_steps_x=12, n_steps_y=12, texture=True)
+        elif surface == 'quad':
+            self.stim_template = GlQuad(*corners, self.color, use_texture=True)
+        else:
+            raise ValueError('Unknown surface: {}'.format(surface))
+
+    def eval_at(self, t, fly_position=[0, 0, 0], fly_heading=[0, 0]):
+        self.stream.use(int(np.floor(t*self.frame_rate)), loop=self.loop)
+
+        theta = return_for_time_t(self.theta, t)
+        phi = return_for_time_t(self.phi, t)
+        angle = return_for_time_t(self.angle, t)
+        self.stim_object = copy.copy(self.stim_template).rotate(np.radians(theta), np.radians(phi), np.radians(angle))
+
+    def release(self):
+        self.stream.release()
+        super().release()
+
+
 class Forest(BaseProgram):
     def __init__(self, screen):
-        super().__init__(screen=screen, num_tri=1000)
+        super().__init__(screen=screen)
 
     def configure(self, color=[1, 1, 1, 1], cylinder_radius=0.5, cylinder_height=0.5, n_faces=16, cylinder_locations=[[+5, 0, 0]]):
         """
@@ -780,11 +851,237 @@ class Forest(BaseProgram):
         pass
 
 
-class CoherentMotionDotField(BaseProgram):
+class DotField(BaseProgram):
     def __init__(self, screen):
-        super().__init__(screen=screen, num_tri=10000)
+        super().__init__(screen=screen)
         self.draw_mode = 'POINTS'
 
+        # dots cover the whole sphere, so there is nothing to cull
+        self.frustum_culling = False
+
+        self.n_dots = 0
+        self.dot_vbo = None
+
+    def configure(self, n_dots=1000, point_size=4, sphere_radius=1, color=[1, 1, 1, 1], speed=60, axis=[0, 0, 1],
+                  coherence=1.0, lifetime=None, seed=0, positions=None):
+        """
+        Field of points on a sphere around the fly, moved entirely on the GPU.
+
+        Dot states are not stored or uploaded per frame: the vertex shader computes each dot position from the stimulus
+        time, the dot index and the seed, so any number of dots costs the CPU nothing per frame, and get_dot_positions
+        reproduces the same positions offline. Each dot lives for lifetime seconds (lifetimes are staggered across
+        dots), then respawns at a new random location. During each life, a fraction "coherence" of the dots rotates
+        about the shared axis and the rest about random axes, all at the same speed.
+
+        :param n_dots: number of dots
+        :param point_size: pixels on screen
+        :param sphere_radius: meters
+        :param color: [r,g,b,a] or single value for monochrome, alpha = 1
+        :param speed: degrees/sec of rotation along the sphere
+        :param axis: (x, y, z) rotation axis of the coherent dots. (0, 0, 1) is rotation in the azimuthal plane
+        :param coherence: fraction of dots moving coherently, drawn independently for each dot and life
+        :param lifetime: seconds, or None for dots that never respawn
+        :param seed: random seed for dot locations, lifetimes and coherence
+        :param positions: optional 3 x n_dots array of initial dot positions. Default is uniformly random on the sphere.
+        """
+        if type(color) is not list:
+            if type(color) is tuple:
+                color = list(color)
+            else:
+                color = [color, color, color, 1]
+
+        self.point_size = point_size
+        self.sphere_radius = sphere_radius
+        self.color = color
+        self.speed = speed
+        self.axis = np.array(axis, dtype=float) / np.linalg.norm(axis)
+        self.coherence = coherence
+        self.lifetime = lifetime
+        self.seed = int(seed)
+
+        if positions is not None:
+            positions = np.array(positions, dtype=float)
+            n_dots = positions.shape[1]
+        self.positions = positions
+        self.n_dots = int(n_dots)
+
+        # per-dot attributes: index and initial position
+        dot_data = np.zeros((self.n_dots, 4), dtype='f4')
+        dot_data[:, 0] = np.arange(self.n_dots)
+        if self.positions is not None:
+            dot_data[:, 1:] = self.positions.T
+
+        if self.dot_vbo is not None:
+            self.vao.release()
+            self.dot_vbo.release()
+        self.dot_vbo = self.ctx.buffer(dot_data.tobytes())
+        self.vao = self.ctx.simple_vertex_array(self.prog, self.dot_vbo, 'in_id', 'in_pos')
+
+        self.prog['seed'].value = self.seed
+        self.prog['lifetime'].value = 0 if self.lifetime is None else self.lifetime
+        self.prog['coherence'].value = self.coherence
+        self.prog['speed'].value = np.radians(self.speed)
+        self.prog['axis'].value = tuple(self.axis)
+        self.prog['explicit_positions'].value = self.positions is not None
+        self.prog['sphere_radius'].value = self.sphere_radius
+        self.prog['color'].value = tuple(self.color)
+        self.set_rotation(np.eye(3))
+
+    def set_rotation(self, rotation):
+        """
+        :param rotation: 3 x 3 rotation matrix applied to the whole dot field
+        """
+        self.rotation = rotation
+        self.prog['rotation'].write(np.array(rotation, dtype='f4').T.tobytes())  # GLSL matrices are column-major
+
+    def eval_at(self, t, fly_position=[0, 0, 0], fly_heading=[0, 0]):
+        self.center = fly_position
+        self.prog['t'].value = t
+        self.prog['center'].value = tuple(self.center)
+
+    def update_vertex_objects(self):
+        # the dot VBO and VAO persist from configure
+        pass
+
+    def write_vertex_objects(self):
+        return self.n_dots
+
+    def release_vertex_objects(self):
+        pass
+
+    def release(self):
+        if self.dot_vbo is not None:
+            self.vao.release()
+            self.dot_vbo.release()
+        super().release()
+
+    def get_dot_positions(self, t, center=(0, 0, 0)):
+        """
+        Computes the dot positions drawn at time t, using the same arithmetic as the vertex shader.
+
+        :param t: stimulus time, seconds
+        :param center: (x, y, z) center of the dot field, meters
+        :return: 3 x n_dots array of dot positions, meters
+        """
+        ids = np.arange(self.n_dots, dtype=np.uint32)
+        seed_hash = hash_uint32(self.seed)
+
+        def rand(cycle, k):
+            h = hash_uint32(ids + hash_uint32(cycle*np.uint32(8) + np.uint32(k) + seed_hash))
+            return h.astype(np.float32) / np.float32(4294967296.0)
+
+        def rand_direction(cycle, k):
+            z = 2*rand(cycle, k) - 1
+            a = 2*np.pi*rand(cycle, k + 1)
+            r = np.sqrt(np.maximum(0, 1 - z**2))
+            return np.stack((r*np.cos(a), r*np.sin(a), z))
+
+        if self.lifetime:
+            s = t + rand(np.zeros(self.n_dots, dtype=np.uint32), 5)*self.lifetime
+            cycle = np.floor(s / self.lifetime).astype(np.uint32)
+            age = s - cycle*self.lifetime
+        else:
+            cycle = np.zeros(self.n_dots, dtype=np.uint32)
+            age = t*np.ones(self.n_dots)
+
+        if self.positions is not None:
+            p = self.positions / np.linalg.norm(self.positions, axis=0)
+        else:
+            p = rand_direction(cycle, 0)
+
+        coherent = rand(cycle, 4) < self.coherence
+        k = np.where(coherent, self.axis[:, np.newaxis], rand_direction(cycle, 2))
+
+        # Rodrigues rotation of each dot about its axis
+        angle = np.radians(self.speed)*age
+        p = p*np.cos(angle) + np.cross(k, p, axis=0)*np.sin(angle) + k*np.sum(k*p, axis=0)*(1 - np.cos(angle))
+
+        return np.array(center, dtype=float)[:, np.newaxis] + self.sphere_radius*(self.rotation @ p)
+
+    def get_vertex_shader(self):
+        vertex_shader = '''
+            #version 330
+
+            in float in_id;
+            in vec3 in_pos;
+
+            out vec4 v_color;
+            out vec2 v_tex_coord;
+            ''' + PROJECTION_SHADER + '''
+            uniform float t;
+            uniform uint seed;
+            uniform float lifetime;
+            uniform float coherence;
+            uniform float speed;
+            uniform vec3 axis;
+            uniform bool explicit_positions;
+            uniform mat3 rotation;
+            uniform vec3 center;
+            uniform float sphere_radius;
+            uniform vec4 color;
+
+            // lowbias32 integer hash, see flystim.util.hash_uint32
+            uint hash(uint x) {
+                x ^= x >> 16;
+                x *= 0x7feb352dU;
+                x ^= x >> 15;
+                x *= 0x846ca68bU;
+                x ^= x >> 16;
+                return x;
+            }
+
+            float rand(uint id, uint cycle, uint k) {
+                return float(hash(id + hash(cycle*8u + k + hash(seed)))) / 4294967296.0;
+            }
+
+            vec3 rand_direction(uint id, uint cycle, uint k) {
+                float z = 2.0*rand(id, cycle, k) - 1.0;
+                float a = 6.28318530718*rand(id, cycle, k + 1u);
+                float r = sqrt(max(0.0, 1.0 - z*z));
+                return vec3(r*cos(a), r*sin(a), z);
+            }
+
+            void main() {
+                uint id = uint(in_id);
+
+                // staggered lives: each dot respawns every lifetime seconds
+                uint cycle = 0u;
+                float age = t;
+                if (lifetime > 0.0) {
+                    float s = t + rand(id, 0u, 5u)*lifetime;
+                    cycle = uint(floor(s/lifetime));
+                    age = s - float(cycle)*lifetime;
+                }
+
+                vec3 p = explicit_positions ? normalize(in_pos) : rand_direction(id, cycle, 0u);
+                vec3 k = (rand(id, cycle, 4u) < coherence) ? axis : rand_direction(id, cycle, 2u);
+
+                // Rodrigues rotation of the dot about its axis
+                float angle = speed*age;
+                p = p*cos(angle) + cross(k, p)*sin(angle) + k*dot(k, p)*(1.0 - cos(angle));
+
+                v_color = color;
+                v_tex_coord = vec2(0.0, 0.0);
+
+                gl_Position = project(center + sphere_radius*(rotation*p));
+            }
+        '''
+        return vertex_shader
+
+
+class RandomDotKinematogram(DotField):
+    def configure(self, n_dots=5000, point_size=4, sphere_radius=1, color=[1, 1, 1, 1], speed=60, axis=[0, 0, 1],
+                  coherence=0.5, lifetime=0.25, seed=0):
+        """
+        Limited-lifetime random dots on a sphere around the fly, a fraction of which move coherently.
+
+        See DotField.configure for parameters.
+        """
+        super().configure(n_dots=n_dots, point_size=point_size, sphere_radius=sphere_radius, color=color, speed=speed,
+                          axis=axis, coherence=coherence, lifetime=lifetime, seed=seed)
+
+
+class CoherentMotionDotField(DotField):
     def configure(self, point_size=20, sphere_radius=1, color=[1, 1, 1, 1], theta_locations=[0], phi_locations=[0], theta_trajectory=0, phi_trajectory=0):
         """
         Collection of moving points created with a single shader.
@@ -792,21 +1089,22 @@ class CoherentMotionDotField(BaseProgram):
         Each point can have a distinct offset (center), and all move with a single coherent motion trajectory along a sphere
         Note that points are all the same size, so no area correction is made for perspective
         """
-        self.point_size = point_size
-        self.sphere_radius = sphere_radius
-        self.color = color
         self.theta_locations = theta_locations
         self.phi_locations = phi_locations
         self.theta_trajectory = make_as_trajectory(theta_trajectory)
         self.phi_trajectory = make_as_trajectory(phi_trajectory)
 
-        self.stim_object_template = GlSphericalPoints(sphere_radius=self.sphere_radius,
-                                                      color=self.color,
-                                                      theta=self.theta_locations,
-                                                      phi=self.phi_locations)
+        # points are uploaded once, the trajectory only changes the rotation of the field
+        points = GlSphericalPoints(sphere_radius=1,
+                                   theta=self.theta_locations,
+                                   phi=self.phi_locations)
+
+        super().configure(point_size=point_size, sphere_radius=sphere_radius, color=color, speed=0,
+                          positions=points.vertices)
 
     def eval_at(self, t, fly_position=[0, 0, 0], fly_heading=[0, 0]):
         theta = return_for_time_t(self.theta_trajectory, t)
         phi = return_for_time_t(self.phi_trajectory, t)
 
-        self.stim_object = copy.copy(self.stim_object_template).rotate(np.radians(theta), np.radians(phi), 0)
+        self.set_rotation(rotate(np.eye(3), np.radians(theta), np.radians(phi), 0))
+        super().eval_at(t, fly_position=[0, 0, 0], fly_heading=fly_heading)
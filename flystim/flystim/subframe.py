@@ -0,0 +1,135 @@
+# Packs several temporal sub-frames into the color channels / bit-planes of one video frame, for use with
+# DLPC350 (Lightcrafter 4500) pattern sequences that display each channel or bit-plane as a separate pattern.
+
+import moderngl
+import numpy as np
+
+
+class SubframeProgram:
+    # pattern bit depths supported by the DLPC350 for 24-bit video input
+    bits_per_subframe = {1: 24, 3: 8, 6: 4, 12: 2, 24: 1}
+
+    def __init__(self, screen):
+        # save settings
+        self.screen = screen
+
+        # initialize settings
+        self.n_subframes = 1
+        self.channel_order = 'RGB'
+        self.size = None
+
+    def initialize(self, ctx):
+        """
+        :param ctx: ModernGL context
+        """
+
+        # save context
+        self.ctx = ctx
+
+        # create OpenGL program
+        self.prog = self.create_prog()
+
+        # create VBO to represent vertex positions
+        pts = np.array([-1, -1, 1, -1, -1, 1, 1, 1]) # fill the viewport
+        vbo = self.ctx.buffer(pts.astype('f4').tobytes())
+
+        # create vertex array object
+        self.vao = self.ctx.simple_vertex_array(self.prog, vbo, 'pos')
+
+    def configure(self, n_subframes=1, channel_order='RGB'):
+        """
+        :param n_subframes: number of temporal sub-frames per video frame. 3 packs one 8-bit sub-frame into each color
+        channel, 24 packs one 1-bit sub-frame into each bit-plane. 1 disables packing.
+        :param channel_order: order in which the pattern sequence displays the color channels, e.g. 'RGB' or 'GRB'.
+        Within a channel, bit-planes are filled starting from the least significant bit.
+        """
+        assert n_subframes in self.bits_per_subframe, 'n_subframes must be one of {}'.format(sorted(self.bits_per_subframe))
+        assert sorted(channel_order.upper()) == ['B', 'G', 'R'], 'Invalid channel order: {}'.format(channel_order)
+
+        self.n_subframes = n_subframes
+        self.channel_order = channel_order.upper()
+
+    @property
+    def enabled(self):
+        return self.n_subframes > 1
+
+    def create_prog(self):
+        return self.ctx.program(
+            vertex_shader='''
+                #version 330
+
+                in vec2 pos;
+                out vec2 uv;
+
+                void main() {
+                    uv = 0.5*(pos + 1.0);
+                    gl_Position = vec4(pos, 0.0, 1.0);
+                }
+            ''',
+            fragment_shader='''
+                #version 330
+
+                in vec2 uv;
+
+                uniform sampler2D scene;
+                uniform float levels;
+                uniform vec4 channel_weight;
+
+                out vec4 out_color;
+
+                void main() {
+                    // quantize sub-frame intensity to the bit depth of one pattern
+                    vec3 rgb = texture(scene, uv).rgb;
+                    float value = floor(max(rgb.r, max(rgb.g, rgb.b))*levels + 0.5);
+
+                    // shift into the target bits of the target channel, accumulated with additive blending
+                    out_color = value*channel_weight;
+                }
+            '''
+        )
+
+    def use_scene_fbo(self, display_width, display_height):
+        """
+        Binds (and clears) the offscreen framebuffer into which a single sub-frame is rendered.
+        """
+        size = (int(display_width), int(display_height))
+        if size != self.size:
+            if self.size is not None:
+                self.scene_fbo.release()
+                self.scene_texture.release()
+                self.scene_depth.release()
+            self.scene_texture = self.ctx.texture(size=size, components=4)
+            self.scene_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+            self.scene_depth = self.ctx.depth_renderbuffer(size)
+            self.scene_fbo = self.ctx.framebuffer(color_attachments=[self.scene_texture], depth_attachment=self.scene_depth)
+            self.size = size
+
+        self.scene_fbo.use()
+        self.scene_fbo.clear(0, 0, 0, 1)
+
+    def pack(self, subframe, display_width, display_height):
+        """
+        Adds the sub-frame in the scene framebuffer to its channel / bit-plane of the screen framebuffer.
+        The screen framebuffer must be cleared to black before packing the first sub-frame.
+        """
+        bits = self.bits_per_subframe[self.n_subframes]
+        subframes_per_channel = 8 // bits if bits < 8 else 1
+        channel = 'RGB'.index(self.channel_order[subframe // subframes_per_channel])
+        shift = bits * (subframe % subframes_per_channel)
+
+        channel_weight = [0.0, 0.0, 0.0, 0.0]
+        channel_weight[channel] = (2**shift)/255
+        self.prog['channel_weight'].value = tuple(channel_weight)
+        self.prog['levels'].value = min(2**bits, 256) - 1
+
+        self.ctx.screen.use()
+        self.ctx.viewport = (0, 0, display_width, display_height)
+        # sample the sub-frame from texture unit 1, so that stimulus textures bound to unit 0 are left in place
+        self.prog['scene'].value = 1
+        self.scene_texture.use(location=1)
+
+        self.ctx.disable(moderngl.DEPTH_TEST)
+        self.ctx.blend_func = moderngl.ONE, moderngl.ONE
+        self.vao.render(mode=moderngl.TRIANGLE_STRIP)
+        self.ctx.blend_func = moderngl.DEFAULT_BLENDING
+        self.ctx.enable(moderngl.DEPTH_TEST)
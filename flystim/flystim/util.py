@@ -64,6 +64,68 @@ def translate(pts, amt):
     elif len(pts.shape) == 2:
         return pts + amt[:, np.newaxis]
 
+def tessellation_steps(arc_length, curvature_radius, max_error=0.1, min_steps=4, max_steps=256):
+    """
+    Number of straight segments needed to approximate a curve, as seen from the viewer, within an angular error.
+
+    The curve is an arc of a circle on the viewing sphere around the viewer (e.g. the outline of a spot, or the rim of
+    a cylinder seen from its axis). Each segment deviates from the arc by at most
+    curvature_radius * (1 - cos(half angle subtended by the segment at the circle center)), so larger circles and
+    smaller errors need more segments.
+
+    :param arc_length: degrees, angle subtended by the arc at the center of its circle (360 for a full circle)
+    :param curvature_radius: degrees, angular radius of the circle the arc lies on (90 for a great circle)
+    :param max_error: degrees, maximum deviation of the segments from the arc
+    :param min_steps: lower bound on the number of segments
+    :param max_steps: upper bound on the number of segments
+    """
+    if curvature_radius <= max_error:
+        return min_steps
+
+    half_angle = np.arccos(1 - max_error/curvature_radius)
+    n = int(np.ceil(np.radians(arc_length) / (2*half_angle)))
+
+    return int(np.clip(n, min_steps, max_steps))
+
+def hash_uint32(x):
+    """
+    Integer hash of uint32 values (lowbias32), identical to the hash used in GLSL shaders so that random values drawn
+    on the GPU can be reproduced offline.
+    """
+    x = np.array(x, dtype=np.uint32)
+    x ^= x >> np.uint32(16)
+    x *= np.uint32(0x7feb352d)
+    x ^= x >> np.uint32(15)
+    x *= np.uint32(0x846ca68b)
+    x ^= x >> np.uint32(16)
+    return x
+
+def frustum_planes(mvp):
+    """
+    :param mvp: perspective matrix as generated by perspective.GenPerspective (column-major f4 bytes) or 4x4 array
+    :return: 6x4 array of normalized (a, b, c, d) planes (left, right, bottom, top, near, far), inside where a*x+b*y+c*z+d >= 0
+    ref: Gribb & Hartmann, Fast extraction of viewing frustum planes from the world-view-projection matrix
+    """
+    if isinstance(mvp, bytes):
+        mvp = np.frombuffer(mvp, dtype='f4').reshape((4, 4), order='F')
+    m = np.array(mvp, dtype=float)
+
+    planes = np.array([m[3] + m[0], m[3] - m[0],
+                       m[3] + m[1], m[3] - m[1],
+                       m[3] + m[2], m[3] - m[2]])
+
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, np.newaxis]
+
+def sphere_in_frustum(planes, center, radius):
+    """
+    :param planes: output of frustum_planes
+    :param center: (x, y, z) center of bounding sphere
+    :param radius: radius of bounding sphere
+    :return: False if the sphere lies entirely outside the frustum, True otherwise
+    """
+    distances = planes[:, :3].dot(center) + planes[:, 3]
+    return bool(np.all(distances >= -radius))
+
 def get_rgba(val, def_alpha=1):
     # interpret string as RGB
     if isinstance(val, str):
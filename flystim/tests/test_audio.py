@@ -0,0 +1,237 @@
+import wave
+from time import sleep, time
+
+import numpy as np
+import pytest
+
+from flystim import audio
+from flystim.audio import SoundCache, Track, GeneratorTrack, Mixer, VirtualStream, AudioPlay, sine_song, pulse_song, sine_blocks
+
+
+def constant_sound(n, value=1000):
+    return np.full(n, value, dtype=np.int16)
+
+
+def mix_once(tracks, frame_count, channels=2):
+    mixer = Mixer(channels=channels, frames_per_buffer=frame_count)
+    mixer.start(tracks)
+    mixer.clear(frame_count)
+    mixer.fill(0, frame_count)
+    return mixer.output(frame_count)
+
+
+def test_center_pan_plays_mono_on_both_channels():
+    out = mix_once([Track(constant_sound(64), sr=1000)], 64)
+
+    assert np.all(out == 1000)
+
+
+@pytest.mark.parametrize('pan, left, right', [(-1.0, 1000, 0), (1.0, 0, 1000), (0.5, 500, 1000)])
+def test_pan(pan, left, right):
+    out = mix_once([Track(constant_sound(64), sr=1000, pan=pan)], 64)
+
+    assert np.all(out[:, 0] == left)
+    assert np.all(out[:, 1] == right)
+
+
+def test_mono_output():
+    out = mix_once([Track(constant_sound(64), sr=1000, pan=1.0, gain=0.5, channels=1)], 64, channels=1)
+
+    assert out.shape == (64, 1)
+    assert np.all(out == 500)
+
+
+def test_fades():
+    sr = 1000
+    out = mix_once([Track(constant_sound(100), sr=sr, fade_in=0.01, fade_out=0.02)], 100)[:, 0]
+
+    assert out[0] == 0
+    assert out[5] == 500
+    assert np.all(out[10:80] == 1000)
+    assert out[90] == 500
+
+
+def test_offset_and_sum_of_tracks():
+    tracks = [Track(constant_sound(20), sr=1000), Track(constant_sound(20), sr=1000, offset=0.01)]
+    out = mix_once(tracks, 40)[:, 0]
+
+    assert np.all(out[:10] == 1000)
+    assert np.all(out[10:20] == 2000)
+    assert np.all(out[20:30] == 1000)
+    assert np.all(out[30:] == 0)
+
+
+def test_mix_is_clipped():
+    out = mix_once([Track(constant_sound(10, 30000), sr=1000), Track(constant_sound(10, 30000), sr=1000)], 10)
+
+    assert np.all(out == 2**15 - 1)
+
+
+def test_queued_tracks_follow_without_gap():
+    mixer = Mixer(channels=2, frames_per_buffer=30)
+    mixer.queue([Track(constant_sound(10, 100), sr=1000)])
+    mixer.queue([Track(constant_sound(10, 200), sr=1000)])
+    mixer.clear(30)
+    mixer.fill(0, 30)
+    out = mixer.output(30)[:, 0]
+
+    assert np.all(out[:10] == 100)
+    assert np.all(out[10:20] == 200)
+    assert np.all(out[20:] == 0)
+
+
+def test_callback_returns_preallocated_buffer():
+    audio = AudioPlay(sample_rate=8000, frames_per_buffer=64, channels=1, device='null')
+    audio.stream.stop_stream()
+    try:
+        audio.load_stim('sine_song', duration=0.1, pan=0.5)
+        audio.start_stim()
+
+        time_info = {'current_time': 0, 'output_buffer_dac_time': 0}
+        first, _ = audio.callback(None, 64, time_info, 0)
+        second, _ = audio.callback(None, 64, time_info, 0)
+
+        assert first.shape == (64, 1)
+        assert np.shares_memory(first, second)
+        assert np.any(second != 0)
+    finally:
+        audio.close()
+
+
+def test_close_after_failed_init(monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('no output device')
+
+    monkeypatch.setattr(audio, 'VirtualStream', fail)
+    with pytest.raises(RuntimeError):
+        AudioPlay(device='null')
+
+
+def test_sound_cache_hits_and_misses():
+    cache = SoundCache()
+    a = cache.get('sine_song', sr=8000, duration=0.1, freq=200.0)
+    b = cache.get('sine_song', sr=8000, freq=200.0, duration=0.1)
+    c = cache.get('sine_song', sr=8000, duration=0.1, freq=300.0)
+
+    assert a is b
+    assert c is not a
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert np.array_equal(a, sine_song(sr=8000, duration=0.1, freq=200.0))
+
+
+def test_sound_cache_sounds_are_read_only():
+    sound = SoundCache().get('pulse_song', sr=8000, duration=0.2)
+
+    assert not sound.flags.writeable
+
+
+def test_sound_cache_evicts_least_recently_used():
+    nbytes = sine_song(sr=8000, duration=0.1).nbytes
+    cache = SoundCache(max_bytes=2*nbytes)
+
+    cache.get('sine_song', sr=8000, duration=0.1, freq=100.0)
+    cache.get('sine_song', sr=8000, duration=0.1, freq=200.0)
+    cache.get('sine_song', sr=8000, duration=0.1, freq=100.0)
+    cache.get('sine_song', sr=8000, duration=0.1, freq=300.0)
+
+    freqs = [key[1] for key in cache.sounds]
+    assert len(freqs) == 2
+    assert cache.n_bytes == 2*nbytes
+    assert any('100.0' in f for f in freqs) and not any('200.0' in f for f in freqs)
+
+
+def test_sound_cache_keeps_sound_over_budget():
+    cache = SoundCache(max_bytes=1)
+    sound = cache.get('sine_song', sr=8000, duration=0.1)
+
+    assert len(cache.sounds) == 1
+    assert cache.n_bytes == sound.nbytes
+
+
+def test_pulse_song_length_and_range():
+    sr, pcycle, ncycle = 10000, 0.016, 0.020
+    samples = pulse_song(sr=sr, duration=1.0, pcycle=pcycle, ncycle=ncycle)
+    seg = int((pcycle + ncycle)*sr)
+
+    assert samples.dtype == np.int16
+    assert len(samples) == round(1.0/(pcycle + ncycle))*seg - seg//4
+    assert np.max(np.abs(samples.astype(int))) <= 2**15
+
+
+def test_sine_blocks_match_continuous_sine():
+    sr, freq = 8000, 200.0
+    samples = np.concatenate([block.copy() for block in sine_blocks(sr, block_size=64, duration=0.1, freq=freq)])
+    t = np.arange(1, len(samples) + 1) / sr
+
+    assert len(samples) == 800
+    assert np.allclose(samples, np.sin(2*np.pi*freq*t), atol=1e-9)
+
+
+def test_generator_track_plays_for_its_duration():
+    sr = 8000
+    track = GeneratorTrack(sine_blocks(sr, block_size=50, freq=200.0), sr=sr, duration=0.01, gain=0.5)
+    out = mix_once([track], 128)[:, 0]
+
+    assert np.any(out[:80] != 0)
+    assert np.all(out[80:] == 0)
+    assert np.max(np.abs(out.astype(int))) <= 2**14
+
+
+def test_generator_track_ends_with_its_generator():
+    sr = 8000
+    track = GeneratorTrack(sine_blocks(sr, block_size=32, duration=0.005), sr=sr)
+    mixer = Mixer(channels=2, frames_per_buffer=64)
+    mixer.start([track])
+    mixer.clear(64)
+    mixer.fill(0, 64)
+
+    assert track.length == 40
+    assert mixer.tracks == []
+
+
+def test_virtual_stream_records_onsets_and_wav(tmp_path):
+    sr, frames_per_buffer = 8000, 80
+    calls = []
+
+    def callback(in_data, frame_count, time_info, status):
+        out = np.zeros((frame_count, 2), dtype=np.int16)
+        if len(calls) == 2:
+            out[10:] = 1000
+        calls.append(time_info)
+        return out, 0
+
+    file_path = str(tmp_path / 'out.wav')
+    stream = VirtualStream(callback, sr=sr, channels=2, frames_per_buffer=frames_per_buffer, file_path=file_path,
+                           latency=0.02)
+    t_start = time()
+    stream.start_stream()
+    sleep(0.1)
+    stream.stop_stream()
+    sleep(0.05)
+    stream.close()
+
+    # one onset: the first nonzero sample of the third buffer, 2 buffer periods after the start
+    assert len(stream.onsets) == 1
+    expected = t_start + 2*frames_per_buffer/sr + 0.02 + 10/sr
+    assert abs(stream.onsets[0] - expected) < 0.02
+
+    # buffers are requested at the real-time rate
+    assert 5 <= len(calls) <= 12
+
+    with wave.open(file_path, 'rb') as wav:
+        assert wav.getnchannels() == 2
+        assert wav.getframerate() == sr
+        assert wav.getnframes() == len(calls)*frames_per_buffer
+
+
+def test_null_device_plays_loaded_sound():
+    audio = AudioPlay(sample_rate=8000, frames_per_buffer=80, device='null')
+    try:
+        audio.load_stim('sine_song', duration=0.05)
+        audio.start_stim(t=time())
+        sleep(0.1)
+
+        assert len(audio.stream.onsets) == 1
+        assert len(audio.pop_play_log()) == 1
+    finally:
+        audio.close()
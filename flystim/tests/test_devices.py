@@ -0,0 +1,96 @@
+from queue import Queue
+from time import sleep
+
+import pytest
+
+from flystim import devices
+from flystim.devices import Device, register_device_type
+
+
+class FakeClient:
+    def __init__(self):
+        self.request_lists = []
+
+    def write_request_list(self, request_list):
+        self.request_lists.append(request_list)
+
+
+@pytest.fixture
+def launches(monkeypatch):
+    # filenames passed to launch_server
+    launches = Queue()
+
+    def launch_server(filename, **kwargs):
+        launches.put(filename)
+        return FakeClient()
+
+    monkeypatch.setattr(devices, 'launch_server', launch_server)
+    register_device_type('test_ok', module='flystim.util', commands=['start_stim'])
+    register_device_type('test_missing', module='flystim.no_such_module', commands=['start_stim'])
+    yield launches
+    del devices.device_types['test_ok']
+    del devices.device_types['test_missing']
+
+
+def wait_for(queue, n):
+    return [queue.get(timeout=5) for _ in range(n)]
+
+
+def test_unknown_device_type():
+    with pytest.raises(ValueError):
+        Device(name='x', device_type='no_such_type')
+
+
+def test_launch_on_first_request(launches):
+    connected = Queue()
+    device = Device(name='ok', device_type='test_ok', on_connect=connected.put)
+    device.write_request_list([{'name': 'start_stim'}])
+    device.write_request_list([{'name': 'start_stim', 'kwargs': {'t': 1}}])
+
+    assert wait_for(connected, 1) == [device]
+    assert wait_for(launches, 1)[0].endswith('util.py')
+
+    # both request lists reach the one launched process
+    while len(device.client.request_lists) < 2:
+        sleep(0.01)
+    assert launches.empty()
+
+
+def test_failed_launch_rejects_requests(launches):
+    rejected = Queue()
+    device = Device(name='missing', device_type='test_missing',
+                    on_reject=lambda request, message: rejected.put((request, message)))
+
+    device.write_request_list([{'name': 'start_stim', 'id': 1}])
+    device.write_request_list([{'name': 'start_stim', 'id': 2}, {'name': 'start_stim', 'id': 3}])
+
+    results = wait_for(rejected, 3)
+    assert [request['id'] for request, message in results] == [1, 2, 3]
+    assert all('Could not launch device missing' in message for request, message in results)
+    assert device.client is None
+
+
+def test_failed_launch_is_retried_only_on_launch(launches):
+    rejected = Queue()
+    device = Device(name='missing', device_type='test_missing', on_reject=lambda request, message: rejected.put(request))
+
+    device.write_request_list([{'name': 'start_stim', 'id': 1}])
+    wait_for(rejected, 1)
+
+    # the module can be found now, but requests alone do not relaunch the device
+    device.device_type.module = 'flystim.util'
+    device.write_request_list([{'name': 'start_stim', 'id': 2}])
+    wait_for(rejected, 1)
+    assert launches.empty()
+
+    connected = Queue()
+    device.on_connect = connected.put
+    device.launch()
+    device.write_request_list([{'name': 'start_stim', 'id': 3}])
+
+    assert wait_for(connected, 1) == [device]
+    assert len(wait_for(launches, 1)) == 1
+    while not device.client.request_lists:
+        sleep(0.01)
+    assert device.client.request_lists == [[{'name': 'start_stim', 'id': 3}]]
+    assert rejected.empty()
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtWidgets
+
+from flystim.framework import StimDisplay
+from flystim.screen import Screen
+
+
+class FakeServer:
+    pass
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def stim_display(app):
+    stim_display = StimDisplay(screen=Screen(), server=FakeServer(), app=app)
+    stim_display.set_clock_mode('frame', refresh_rate=100.0)
+    stim_display.stim_started = True
+    return stim_display
+
+
+def test_stim_time_before_first_frame(stim_display):
+    assert stim_display.get_stim_time(t=5.0) == 0
+
+
+def test_frame_clock_counts_frames(stim_display):
+    for k in range(5):
+        stim_display.advance_frame_clock(t=1.0 + k*0.01)
+
+    assert stim_display.get_stim_time(t=123.0) == pytest.approx(0.04)
+    assert stim_display.missed_frames == 0
+
+
+def test_compensate_missed_frames(stim_display):
+    for t in [1.0, 1.01, 1.04]:
+        stim_display.advance_frame_clock(t=t)
+
+    assert stim_display.missed_frames == 2
+    assert stim_display.get_stim_time(t=0) == pytest.approx(0.04)
+
+
+def test_skip_missed_frames(stim_display):
+    stim_display.set_clock_mode('frame', refresh_rate=100.0, missed_frame_policy='skip')
+    for t in [1.0, 1.01, 1.04]:
+        stim_display.advance_frame_clock(t=t)
+
+    assert stim_display.missed_frames == 2
+    assert stim_display.get_stim_time(t=0) == pytest.approx(0.02)
+
+
+def test_refresh_rate_from_display(stim_display):
+    stim_display.set_clock_mode('frame')
+
+    assert stim_display.get_refresh_rate() > 0
+    assert stim_display.frame_period == pytest.approx(1.0/stim_display.get_refresh_rate())
@@ -0,0 +1,116 @@
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from flystim import images
+from flystim.images import ImageCache, load_image, sidecar_path
+
+
+@pytest.fixture
+def image_path(tmp_path, monkeypatch):
+    # keep the fallback sidecar directory inside the test directory
+    fallback_dir = tmp_path / 'tmp'
+    fallback_dir.mkdir()
+    monkeypatch.setattr(tempfile, 'gettempdir', lambda: str(fallback_dir))
+
+    source_dir = tmp_path / 'images'
+    source_dir.mkdir()
+    path = str(source_dir / 'imk00001.iml')
+    write_iml(path, seed=0)
+    return path
+
+
+def write_iml(path, seed):
+    rng = np.random.default_rng(seed)
+    rng.integers(0, 2**16, size=(1024, 1536)).astype('>u2').tofile(path)
+
+
+def no_decode(*args, **kwargs):
+    raise AssertionError('image decoded again')
+
+
+def test_sidecar_reused(image_path, monkeypatch):
+    img = load_image(image_path)
+
+    assert img.dtype == np.uint8
+    assert img.shape == (1024, 1024)
+    assert os.path.isfile(sidecar_path(image_path))
+
+    monkeypatch.setattr(images, 'decode_iml', no_decode)
+    assert np.array_equal(load_image(image_path), img)
+
+
+def test_sidecar_leaves_no_temporary_files(image_path):
+    load_image(image_path)
+
+    assert sorted(os.listdir(os.path.dirname(image_path))) == ['imk00001.iml', 'imk00001.u8.npy']
+
+
+def test_stale_sidecar_decoded_again(image_path):
+    old = load_image(image_path)
+
+    write_iml(image_path, seed=1)
+    mtime = os.path.getmtime(sidecar_path(image_path)) + 10
+    os.utime(image_path, (mtime, mtime))
+
+    new = load_image(image_path)
+    assert not np.array_equal(new, old)
+    assert np.array_equal(np.load(sidecar_path(image_path)), new)
+
+
+def test_corrupt_sidecar_decoded_again(image_path):
+    img = load_image(image_path)
+
+    with open(sidecar_path(image_path), 'wb') as f:
+        f.write(b'\x93NUMPY truncated')
+
+    assert np.array_equal(load_image(image_path), img)
+    assert np.array_equal(np.load(sidecar_path(image_path)), img)
+
+
+def test_unwritable_directory_falls_back_to_tempdir(image_path, monkeypatch):
+    source_dir = os.path.dirname(image_path)
+    mkstemp = tempfile.mkstemp
+
+    def read_only_mkstemp(*args, dir=None, **kwargs):
+        if dir == source_dir:
+            raise PermissionError(13, 'Permission denied', dir)
+        return mkstemp(*args, dir=dir, **kwargs)
+
+    monkeypatch.setattr(tempfile, 'mkstemp', read_only_mkstemp)
+    img = load_image(image_path)
+
+    fallback = os.path.join(tempfile.gettempdir(), 'flystim_images', 'imk00001.u8.npy')
+    assert not os.path.exists(sidecar_path(image_path))
+    assert np.array_equal(np.load(fallback), img)
+
+    monkeypatch.setattr(images, 'decode_iml', no_decode)
+    assert np.array_equal(load_image(image_path), img)
+
+
+def test_image_cache_evicts_least_recently_used(monkeypatch):
+    # 100 x 100 uint8 images, 13333 bytes each with mipmaps: the budget holds two
+    monkeypatch.setattr(images, 'load_image', lambda image_path: np.zeros((100, 100), dtype=np.uint8))
+    ctx = mock.MagicMock()
+    ctx.texture.side_effect = lambda **kwargs: mock.MagicMock()
+    cache = ImageCache(ctx, max_bytes=30000)
+
+    a = cache.get_texture('a.iml')
+    b = cache.get_texture('b.iml')
+    assert cache.get_texture('a.iml') is a
+    c = cache.get_texture('c.iml')
+
+    b.release.assert_called_once()
+    a.release.assert_not_called()
+    c.release.assert_not_called()
+    assert [os.path.basename(key) for key in cache.textures] == ['a.iml', 'c.iml']
+    assert cache.n_bytes == 2*(10000*4//3)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # b is decoded and uploaded again, evicting a
+    cache.get_texture('b.iml')
+    a.release.assert_called_once()
+    assert cache.misses == 4
@@ -0,0 +1,90 @@
+import numpy as np
+
+from flystim.movie import MovieStream
+
+
+class FakeBuffer:
+    def __init__(self, reserve):
+        self.data = None
+
+    def orphan(self):
+        self.data = None
+
+    def write(self, data):
+        self.data = bytes(data)
+
+    def release(self):
+        pass
+
+
+class FakeTexture:
+    def __init__(self, size, components):
+        self.size = size
+        self.filter = None
+        self.data = None
+
+    def write(self, pbo):
+        self.data = pbo.data
+
+    def use(self, location=0):
+        FakeContext.bound = self
+
+    def release(self):
+        pass
+
+
+class FakeContext:
+    bound = None
+
+    def texture(self, size, components):
+        return FakeTexture(size, components)
+
+    def buffer(self, reserve):
+        return FakeBuffer(reserve)
+
+
+def make_movie(n_frames=10, height=4, width=6):
+    movie = np.zeros((n_frames, height, width), dtype=np.uint8)
+    for k in range(n_frames):
+        movie[k] = k
+    return movie
+
+
+def bound_frame():
+    return FakeContext.bound.data[0]
+
+
+def test_init_fills_ring():
+    stream = MovieStream(FakeContext(), make_movie(), frames_ahead=2)
+
+    assert sorted(stream.slot_frames) == [0, 1, 2]
+    assert stream.late_uploads == 0
+    assert bound_frame() == 0
+
+
+def test_frames_ahead_are_uploaded_before_use():
+    stream = MovieStream(FakeContext(), make_movie(), frames_ahead=2)
+
+    for frame in range(10):
+        stream.use(frame)
+        assert bound_frame() == frame
+
+    assert stream.late_uploads == 0
+
+
+def test_skipped_frames_count_as_late():
+    stream = MovieStream(FakeContext(), make_movie(), frames_ahead=2)
+    stream.use(6)
+
+    assert bound_frame() == 6
+    assert stream.late_uploads == 1
+
+
+def test_hold_last_frame_and_loop():
+    stream = MovieStream(FakeContext(), make_movie(), frames_ahead=2)
+
+    stream.use(25)
+    assert bound_frame() == 9
+
+    stream.use(11, loop=True)
+    assert bound_frame() == 1
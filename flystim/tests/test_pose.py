@@ -0,0 +1,99 @@
+import struct
+from threading import Thread
+from time import sleep, time
+
+import pytest
+
+from flystim.pose import PoseChannel, launch_simulated_tracker
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'pose')
+
+
+def test_nothing_written(path):
+    channel = PoseChannel(path=path)
+
+    assert channel.read() is None
+    channel.close()
+
+
+def test_write_then_read(path):
+    writer = PoseChannel(path=path)
+    reader = PoseChannel(path=path)
+
+    writer.write(x=0.1, y=0.2, z=0.0, heading=45.0, timestamp=123.0)
+    assert reader.read() == (2, 0.1, 0.2, 0.0, 45.0, 123.0)
+
+    writer.write(x=0.3, y=0.4, z=0.0, heading=90.0, timestamp=124.0)
+    assert reader.read() == (4, 0.3, 0.4, 0.0, 90.0, 124.0)
+
+    writer.close()
+    reader.close()
+
+
+def test_writer_resumes_sequence(path):
+    PoseChannel(path=path).write(x=0, y=0, z=0, heading=0)
+    writer = PoseChannel(path=path)
+    writer.write(x=1, y=0, z=0, heading=0)
+
+    assert PoseChannel(path=path).read()[0] == 4
+
+
+def test_read_during_write_returns_last_complete_pose(path):
+    writer = PoseChannel(path=path)
+    reader = PoseChannel(path=path, max_read_attempts=10)
+
+    writer.write(x=0.1, y=0.2, z=0.0, heading=45.0, timestamp=123.0)
+    complete = reader.read()
+
+    # writer interrupted after marking the record as being written, with half of the new pose in place
+    struct.pack_into('<Q', writer.buf, 0, writer.seq + 1)
+    struct.pack_into('<d', writer.buf, 8, 9.9)
+
+    assert reader.read() == complete
+    assert PoseChannel(path=path, max_read_attempts=10).read() is None
+
+
+def test_concurrent_reads_are_consistent(path):
+    writer = PoseChannel(path=path)
+    reader = PoseChannel(path=path)
+    done = []
+
+    def write():
+        for k in range(20000):
+            writer.write(x=k, y=2*k, z=3*k, heading=4*k, timestamp=5*k)
+        done.append(True)
+
+    thread = Thread(target=write)
+    thread.start()
+    while not done:
+        record = reader.read()
+        if record is not None:
+            seq, x, y, z, heading, timestamp = record
+            assert (y, z, heading, timestamp) == (2*x, 3*x, 4*x, 5*x)
+    thread.join()
+
+
+def test_simulated_tracker(path):
+    radius = 0.05
+    proc = launch_simulated_tracker(path=path, rate=200, duration=2, radius=radius, angular_velocity=90)
+    reader = PoseChannel(path=path)
+
+    try:
+        t0 = time()
+        records = []
+        while (time() - t0 < 10) and (len(records) < 2):
+            record = reader.read()
+            if (record is not None) and (not records or record[0] > records[-1][0]):
+                records.append(record)
+            sleep(0.05)
+
+        assert len(records) == 2
+        for seq, x, y, z, heading, timestamp in records:
+            assert x**2 + y**2 == pytest.approx(radius**2)
+            assert z == 0
+    finally:
+        proc.terminate()
+        proc.wait()
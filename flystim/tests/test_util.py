@@ -0,0 +1,133 @@
+import numpy as np
+
+from flystim.util import tessellation_steps, hash_uint32, frustum_planes, sphere_in_frustum
+from flystim.perspective import GenPerspective
+from flystim.shapes import GlVertices, GlTri, GlCube
+
+
+def test_tessellation_steps_grow_with_radius():
+    steps = [tessellation_steps(360, radius, max_steps=10000) for radius in [5, 10, 20, 45, 90]]
+
+    assert steps == sorted(steps)
+    assert steps[0] < steps[-1]
+
+
+def test_tessellation_steps_grow_as_error_shrinks():
+    steps = [tessellation_steps(360, 30, max_error=max_error, max_steps=10000) for max_error in [1, 0.3, 0.1, 0.03]]
+
+    assert steps == sorted(steps)
+    assert steps[0] < steps[-1]
+
+
+def test_tessellation_steps_meet_max_error():
+    radius, max_error = 20, 0.1
+    n = tessellation_steps(360, radius, max_error=max_error, max_steps=10000)
+
+    # deviation of each chord from the circle, and one step fewer exceeds it
+    assert radius*(1 - np.cos(np.pi/n)) <= max_error
+    assert radius*(1 - np.cos(np.pi/(n-1))) > max_error
+
+
+def test_tessellation_steps_bounds():
+    assert tessellation_steps(360, 0.05) == 4
+    assert tessellation_steps(360, 1, min_steps=16) == 16
+    assert tessellation_steps(360, 90, max_error=1e-4, max_steps=128) == 128
+
+
+def lowbias32(x):
+    # reference implementation with Python integers
+    mask = 0xffffffff
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & mask
+    x ^= x >> 15
+    x = (x * 0x846ca68b) & mask
+    x ^= x >> 16
+    return x
+
+
+def test_hash_uint32_matches_reference():
+    values = [0, 1, 2, 12345, 2**31, 2**32 - 1]
+    hashes = hash_uint32(values)
+
+    assert hashes.dtype == np.uint32
+    assert [int(h) for h in hashes] == [lowbias32(v) for v in values]
+
+
+def test_hash_uint32_scalar_and_shape():
+    assert int(hash_uint32(7)) == lowbias32(7)
+    assert hash_uint32(np.arange(12, dtype=np.uint32).reshape(3, 4)).shape == (3, 4)
+
+
+def test_hash_uint32_does_not_modify_input():
+    ids = np.arange(100, dtype=np.uint32)
+    hash_uint32(ids)
+
+    assert np.array_equal(ids, np.arange(100, dtype=np.uint32))
+
+
+def test_hash_uint32_spreads_consecutive_ids():
+    u = hash_uint32(np.arange(100000, dtype=np.uint32)) / 2**32
+
+    assert len(np.unique(u)) == len(u)
+    assert abs(np.mean(u) - 0.5) < 0.01
+
+
+def front_perspective():
+    # 90 degree view along +y, through a 2 x 2 screen at y = 1
+    return GenPerspective(pa=(-1, 1, -1), pb=(1, 1, -1), pc=(-1, 1, 1)).matrix
+
+
+def test_frustum_planes_from_bytes_and_array():
+    mvp = front_perspective()
+    planes = frustum_planes(mvp)
+
+    assert planes.shape == (6, 4)
+    assert np.allclose(np.linalg.norm(planes[:, :3], axis=1), 1)
+    assert np.allclose(planes, frustum_planes(np.frombuffer(mvp, dtype='f4').reshape((4, 4), order='F')))
+
+    # a point ahead of the screen is inside all planes, a point behind the fly is not
+    assert np.all(planes[:, :3].dot((0, 5, 0)) + planes[:, 3] > 0)
+    assert np.any(planes[:, :3].dot((0, -5, 0)) + planes[:, 3] < 0)
+
+
+def test_sphere_in_frustum_inside_outside_straddling():
+    planes = frustum_planes(front_perspective())
+
+    assert sphere_in_frustum(planes, (0, 5, 0), 0.1)
+    assert not sphere_in_frustum(planes, (0, -5, 0), 0.1)
+    assert not sphere_in_frustum(planes, (20, 5, 0), 1)
+
+    # center 1 m above the top edge of the frustum at y = 5, i.e. 1/sqrt(2) m from the top plane
+    assert sphere_in_frustum(planes, (0, 5, 6), 1)
+    assert not sphere_in_frustum(planes, (0, 5, 6), 0.5)
+
+
+def test_bounding_sphere():
+    cube = GlCube(center=(1, 2, 3), side_length=2)
+    center, radius = cube.bounding_sphere
+
+    assert np.allclose(center, (1, 2, 3))
+    assert np.isclose(radius, np.sqrt(3))
+    assert np.all(np.linalg.norm(cube.vertices - center[:, np.newaxis], axis=0) <= radius + 1e-9)
+
+
+def test_bounding_sphere_empty():
+    assert GlVertices().bounding_sphere is None
+    assert GlVertices().visible_parts([frustum_planes(front_perspective())]).shape == (0, 1)
+
+
+def test_visible_parts_culls_each_added_object():
+    planes = [frustum_planes(front_perspective())]
+    color = (1, 1, 1, 1)
+
+    obj = GlVertices()
+    obj.add(GlTri((-0.1, 5, 0), (0.1, 5, 0), (0, 5, 0.1), color))  # ahead
+    obj.add(GlTri((-0.1, -5, 0), (0.1, -5, 0), (0, -5, 0.1), color))  # behind
+    obj.add(GlTri((0, 5, 4.9), (0, 5, 5.5), (0.1, 5, 5.5), color))  # straddling the top plane
+
+    visible = obj.visible_parts(planes)
+    assert visible.tolist() == [[True], [False], [True]]
+
+    kept = obj.select_parts(np.any(visible, axis=1))
+    assert np.array_equal(kept.vertices, np.concatenate((obj.vertices[:, :3], obj.vertices[:, 6:]), axis=1))
+    assert np.array_equal(kept.colors, np.concatenate((obj.colors[:, :3], obj.colors[:, 6:]), axis=1))
@@ -46,9 +46,24 @@ class Client():
             draw_screens(aux_screen)
             self.manager = launch_stim_server(aux_screen)
 
+        # epoch timing reports sent back by the display servers, one per screen (see BaseProtocol.startStimuli)
+        self.epoch_timing = []
+        self.manager.register_function(self.report_epoch_timing)
+        self.screen_names = self.manager.call('get_screen_names', timeout=10)
+
+        # scheduled and actual output times of sounds, sent back by the speaker server (see yh_audio_protocol)
+        self.audio_timing = []
+        self.manager.register_function(self.report_audio_timing)
+
         self.manager.black_corner_square()
         self.manager.set_idle_background(0)
 
+    def report_epoch_timing(self, **kwargs):
+        self.epoch_timing.append(kwargs)
+
+    def report_audio_timing(self, **kwargs):
+        self.audio_timing.append(kwargs)
+
 
 class Client_Stim_Regeneration():
     def __init__(self, cfg, screen):
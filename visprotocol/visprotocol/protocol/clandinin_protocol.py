@@ -11,7 +11,8 @@ Protocol parent class. Override any methods in here in the user protocol subclas
                      *saved as attributes at the individual epoch level
 """
 import numpy as np
-from time import sleep
+from time import sleep, time
+from uuid import uuid4
 
 import os.path
 import yaml
@@ -27,6 +28,7 @@ class BaseProtocol():
         self.num_epochs_completed = 0
         self.parameter_preset_directory = os.path.curdir
         self.send_ttl = False
+        self.server_schedule = False  # if True, the display server runs pre/stim/tail timing (see startStimuli)
         self.convenience_parameters = {}
         self.getRunParameterDefaults()
         self.getParameterDefaults()
@@ -96,6 +98,10 @@ class BaseProtocol():
         multicall()
 
     def startStimuli(self, client, append_stim_frames=False, print_profile=True):
+        if self.server_schedule:
+            self.startStimuliOnServer(client, append_stim_frames=append_stim_frames, print_profile=print_profile)
+            return
+
         sleep(self.run_parameters['pre_time'])
         multicall = flyrpc.multicall.MyMultiCall(client.manager)
         # stim time
@@ -112,6 +118,55 @@ class BaseProtocol():
 
         sleep(self.run_parameters['tail_time'])
 
+    def startStimuliOnServer(self, client, append_stim_frames=False, print_profile=True, report_timeout=2.0):
+        """
+        Send the whole pre/stim/tail schedule in one message. The display server starts and stops the stimulus on
+        frame boundaries and reports the frame indices it used, which are kept in self.epoch_timing.
+
+        :param report_timeout: seconds to wait for the timing reports after the end of the epoch
+        """
+        # reports are matched to this epoch by its id, so that a late report of an earlier epoch is not counted here
+        epoch_id = uuid4().hex
+        client.epoch_timing = []
+
+        client.manager.run_epoch(pre_time=self.run_parameters['pre_time'],
+                                 stim_time=self.run_parameters['stim_time'],
+                                 tail_time=self.run_parameters['tail_time'],
+                                 append_stim_frames=append_stim_frames,
+                                 print_profile=print_profile,
+                                 epoch_id=epoch_id)
+
+        sleep(self.run_parameters['pre_time'] + self.run_parameters['stim_time'] + self.run_parameters['tail_time'])
+
+        self.epoch_timing = self.collectEpochTiming(client, epoch_id, timeout=report_timeout)
+        if print_profile:
+            for report in self.epoch_timing:
+                print('{}: stim frames {}-{}, duration {:.4f} sec'.format(report['screen_name'],
+                                                                          report['stim_start_frame'],
+                                                                          report['stim_stop_frame'],
+                                                                          report['stim_stop_time'] - report['stim_start_time']))
+
+    def collectEpochTiming(self, client, epoch_id, timeout=2.0):
+        """
+        Wait for the timing reports of one epoch, one from each screen in client.screen_names, or until timeout. Screens
+        that have not reported by then are named in a warning.
+
+        :return: list of report dicts with the given epoch_id
+        """
+        reports = []
+        deadline = time() + timeout
+        while (len(reports) < len(client.screen_names)) and (time() < deadline):
+            client.manager.process_queue(timeout=max(0, deadline - time()))
+            reports.extend(report for report in client.epoch_timing if report.get('epoch_id') == epoch_id)
+            client.epoch_timing = []
+
+        missing = [name for name in client.screen_names if name not in [report['screen_name'] for report in reports]]
+        if missing:
+            print('Warning: no epoch timing report from {} within {} sec of the end of the epoch'.format(
+                ', '.join(missing), timeout))
+
+        return reports
+
     # Convenience functions shared across protocols...
     def selectParametersFromLists(self, parameter_list, all_combinations=True, randomize_order=False):
         """
@@ -21,6 +21,9 @@ class BaseProtocol(clandinin_protocol.BaseProtocol):
 
 
     def startStimuli(self, client, append_stim_frames=False, print_profile=True):
+        # output times reported by the speaker during this epoch are kept in self.audio_timing
+        client.audio_timing = []
+
         sleep(self.run_parameters['pre_time'])
         client.manager.start_stim(device='speaker')
         sleep(self.run_parameters['stim_time'])
@@ -30,6 +33,13 @@ class BaseProtocol(clandinin_protocol.BaseProtocol):
 
         sleep(self.run_parameters['tail_time'])
 
+        client.manager.process_queue()
+        self.audio_timing = client.audio_timing
+        client.audio_timing = []
+        if print_profile:
+            for report in self.audio_timing:
+                print('speaker output {:.2f} ms after the command'.format(1e3*(report['output_time'] - report['command_time'])))
+
 
 class SineSongProtocol(BaseProtocol):
     def __init__(self, cfg):